@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+#
+# Build the command table used by frr-reload.py --mark-table
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; see the file COPYING; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""
+Marking a configuration ("vtysh -m") needs to know which commands exist in
+which CLI node, what the parent of each node is, and which commands make
+vtysh change nodes.  The first comes from the "cli" section of frr.xref (for
+the vtysh binary), the others are read from the sources:
+
+- the node numbering from enum node_type in lib/command.h
+- the parent nodes from the struct cmd_node definitions vtysh uses
+- the node changes from the DEFUN* bodies in vtysh/*.c
+
+Run after building, like vtysh-cmd-check.py.  With --verify, the table is
+checked against "vtysh -m" on the given configuration files, with
+--verify-topotests on those of all topotests.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import glob
+import argparse
+import subprocess
+
+frr_top_src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(frr_top_src, "tools"))
+
+from frr_reload_marker import ConfigMarker, MarkException
+
+comment_re = re.compile(r"/\*.*?\*/|//[^\n]*", re.S)
+enum_re = re.compile(r"enum\s+node_type\s*\{(.*?)\}", re.S)
+cmd_node_re = re.compile(r"struct\s+cmd_node\s+(\w+)\s*=\s*\{(.*?)\};", re.S)
+extern_node_re = re.compile(r"extern\s+struct\s+cmd_node\s+(\w+)\s*;")
+defun_re = re.compile(r"^(DEF[A-Z_]*)\s*\(", re.M)
+
+switch_re = re.compile(r"switch\s*\(\s*vty->node\s*\)\s*\{(.*?)\n\t\}", re.S)
+case_re = re.compile(
+    r"case\s+(\w+)\s*:|(default)\s*:|vty->node\s*=\s*(\w+)\s*;|(break)\s*;"
+)
+if_re = re.compile(r"if\s*\(([^{};]*)\)\s*\{?\s*vty->node\s*=\s*(\w+)\s*;\s*\}?")
+cond_re = re.compile(r"vty->node\s*==\s*(\w+)")
+assign_re = re.compile(r"vty->node\s*=\s*(\w+)\s*;")
+exit_re = re.compile(r"\bvtysh_exit\s*\(\s*vty\s*\)")
+call_re = re.compile(r"\breturn\s+(\w+)\s*\(\s*self\s*,\s*vty\s*,")
+
+
+def read_source(*path):
+    with open(os.path.join(frr_top_src, *path), "r") as fd:
+        return comment_re.sub("", fd.read())
+
+
+def node_types(text):
+    """
+    Names of the CLI nodes in the order of enum node_type
+    """
+    body = enum_re.search(text).group(1)
+    return [name.strip() for name in body.split(",") if name.strip()]
+
+
+def cmd_nodes(text):
+    """
+    The struct cmd_node definitions in a source file, by variable name
+    """
+    nodes = {}
+    for m in cmd_node_re.finditer(text):
+        fields = dict(re.findall(r"\.(\w+)\s*=\s*(\w+)", m.group(2)))
+        nodes[m.group(1)] = (fields.get("node"), fields.get("parent_node"))
+    return nodes
+
+
+def skip_balanced(text, pos, opening, closing):
+    """
+    Return the position after the bracket closing the one at `pos`,
+    stepping over C strings and character constants
+    """
+    depth = 0
+    while pos < len(text):
+        char = text[pos]
+        if char in "\"'":
+            pos += 1
+            while text[pos] != char:
+                pos += 2 if text[pos] == "\\" else 1
+        elif char == opening:
+            depth += 1
+        elif char == closing:
+            depth -= 1
+            if depth == 0:
+                return pos + 1
+        pos += 1
+    raise ValueError("unbalanced %s%s" % (opening, closing))
+
+
+def defun_bodies(text):
+    """
+    The function bodies of the DEFUN* macros in a source file, by function
+    name
+    """
+    bodies = {}
+    for m in defun_re.finditer(text):
+        macro = m.group(1)
+        if not macro.startswith(("DEFUN", "DEFPY")):
+            continue
+        args_end = skip_balanced(text, m.end() - 1, "(", ")")
+        names = re.findall(r"\w+", text[m.end() : args_end])
+        funcname = names[1] if macro.startswith("DEFUNSH") else names[0]
+
+        start = text.index("{", args_end)
+        bodies[funcname] = text[start : skip_balanced(text, start, "{", "}")]
+    return bodies
+
+
+class MarkTable(object):
+    def __init__(self, xref):
+        self.names = node_types(read_source("lib", "command.h"))
+
+        # vtysh installs the basic nodes from lib/command.c and a few others
+        # from lib/ that it declares extern, all the others are its own
+        lib_nodes = {}
+        for filename in sorted(os.listdir(os.path.join(frr_top_src, "lib"))):
+            if filename.endswith(".c"):
+                lib_nodes.update(cmd_nodes(read_source("lib", filename)))
+
+        self.parents = {}
+        for (node, parent) in cmd_nodes(read_source("lib", "command.c")).values():
+            self.parents[node] = parent
+
+        self.bodies = {}
+        vtysh_dir = os.path.join(frr_top_src, "vtysh")
+        for filename in sorted(os.listdir(vtysh_dir)):
+            if not filename.endswith(".c"):
+                continue
+            text = read_source("vtysh", filename)
+            for name in extern_node_re.findall(text):
+                (node, parent) = lib_nodes[name]
+                self.parents[node] = parent
+            for (node, parent) in cmd_nodes(text).values():
+                self.parents[node] = parent
+            self.bodies.update(defun_bodies(text))
+
+        self.commands = {}
+        self.funcs = {}
+        for defs in xref["cli"].values():
+            for binary, clidef in defs.items():
+                if os.path.basename(binary) != "vtysh":
+                    continue
+                for install in clidef.get("nodes", []):
+                    node = self.names[install["node"]]
+                    strings = self.commands.setdefault(node, [])
+                    if clidef["string"] not in strings:
+                        strings.append(clidef["string"])
+                    self.funcs.setdefault(node, {})[clidef["string"]] = clidef[
+                        "defun"
+                    ]["func"]
+
+    def node_change(self, func, node, depth=0):
+        """
+        The node vtysh is in after running `func` in `node`, or None if the
+        function does not change it
+        """
+        body = self.bodies.get(func)
+        if body is None or depth > 8:
+            return None
+
+        m = switch_re.search(body)
+        if m:
+            labels = []
+            cases = {}
+            for case in case_re.finditer(m.group(1)):
+                (label, default, target, brk) = case.groups()
+                if label or default:
+                    labels.append(label or "default")
+                elif target:
+                    for label in labels:
+                        cases.setdefault(label, target)
+                else:
+                    labels = []
+            return cases.get(node, cases.get("default"))
+
+        for m in if_re.finditer(body):
+            if node in cond_re.findall(m.group(1)):
+                return m.group(2)
+        body = if_re.sub("", body)
+
+        m = assign_re.search(body)
+        if m:
+            return m.group(1)
+        if exit_re.search(body):
+            parent = self.parents.get(node)
+            if parent and parent != "0":
+                return parent
+            return None
+        m = call_re.search(body)
+        if m:
+            return self.node_change(m.group(1), node, depth + 1)
+        return None
+
+    def table(self):
+        nodes = {}
+        for (index, name) in enumerate(self.names):
+            if name == "NODE_TYPE_MAX":
+                continue
+            nodes[name] = {"index": index}
+            parent = self.parents.get(name)
+            if parent and parent != "0":
+                nodes[name]["parent"] = parent
+
+        transitions = {}
+        for (node, funcs) in sorted(self.funcs.items()):
+            for (string, func) in funcs.items():
+                target = self.node_change(func, node)
+                if target and target != node:
+                    transitions.setdefault(node, {})[string] = target
+
+        return {
+            "nodes": nodes,
+            "commands": dict(sorted(self.commands.items())),
+            "transitions": transitions,
+        }
+
+
+def topotest_configs():
+    """
+    The configuration files of the topotests, to verify the table with
+    """
+    pattern = os.path.join(frr_top_src, "tests", "topotests", "**", "*.conf")
+    return sorted(glob.glob(pattern, recursive=True))
+
+
+def verify(table, vtysh, filenames):
+    """
+    Mark each file with "vtysh -m" and with the table, report differences
+    and how long each took, then the totals.  Files that vtysh rejects must
+    be rejected with the table too.
+    """
+    start = time.time()
+    marker = ConfigMarker(table)
+    total_table = time.time() - start
+    total_vtysh = 0
+    failed = 0
+
+    for filename in filenames:
+        start = time.time()
+        proc = subprocess.run(
+            [vtysh, "-m", "-f", filename],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        vtysh_time = time.time() - start
+        total_vtysh += vtysh_time
+        expected = proc.stdout.decode("UTF-8")
+        expected_error = proc.returncode != 0
+
+        start = time.time()
+        try:
+            with open(filename, "r", newline="") as fd:
+                marked = "".join(marker.mark(fd))
+            error = False
+        except MarkException as e:
+            marked = ""
+            error = str(e)
+        table_time = time.time() - start
+        total_table += table_time
+
+        if bool(error) != expected_error:
+            failed += 1
+            sys.stderr.write(
+                "%s: vtysh %s, table %s\n"
+                % (
+                    filename,
+                    proc.stderr.decode("UTF-8").strip() if expected_error else "ok",
+                    error or "ok",
+                )
+            )
+        elif not error and marked != expected:
+            failed += 1
+            sys.stderr.write("%s: marked configs differ\n" % filename)
+            for (lineno, (a, b)) in enumerate(
+                zip(expected.splitlines(), marked.splitlines()), 1
+            ):
+                if a != b:
+                    sys.stderr.write(
+                        "  line %d: vtysh %r, table %r\n" % (lineno, a, b)
+                    )
+                    break
+        else:
+            sys.stdout.write(
+                "%s: ok (vtysh %.3fs, table %.3fs)\n"
+                % (filename, vtysh_time, table_time)
+            )
+
+    sys.stdout.write(
+        "%d files, %d differ: vtysh %.3fs, table %.3fs (with loading it), %.1fx\n"
+        % (
+            len(filenames),
+            failed,
+            total_vtysh,
+            total_table,
+            total_vtysh / total_table if total_table else 0,
+        )
+    )
+    return failed == 0
+
+
+def main():
+    argp = argparse.ArgumentParser(description="FRR config mark table builder")
+    argp.add_argument(
+        "--xref",
+        type=str,
+        default=os.path.join(frr_top_src, "frr.xref"),
+        help="xref data (default: frr.xref in the top of the build)",
+    )
+    argp.add_argument("-o", dest="output", type=str, help="write table to file")
+    argp.add_argument(
+        "--table", type=str, help="verify an existing table instead of building it"
+    )
+    argp.add_argument(
+        "--vtysh",
+        type=str,
+        default=os.path.join(frr_top_src, "vtysh", "vtysh"),
+        help="vtysh binary to verify against",
+    )
+    argp.add_argument(
+        "--verify", nargs="+", metavar="FILE", help="configs to verify with"
+    )
+    argp.add_argument(
+        "--verify-topotests",
+        action="store_true",
+        help="verify with the configs of all topotests",
+    )
+    args = argp.parse_args()
+
+    if args.verify_topotests:
+        args.verify = (args.verify or []) + topotest_configs()
+
+    if args.table:
+        with open(args.table, "r") as fd:
+            table = json.load(fd)
+    else:
+        with open(args.xref, "r") as fd:
+            table = MarkTable(json.load(fd)).table()
+
+    if args.output:
+        with open(args.output + ".tmp", "w") as fd:
+            json.dump(table, fd, indent=1, sort_keys=True)
+        os.rename(args.output + ".tmp", args.output)
+
+    if args.verify and not verify(table, args.vtysh, args.verify):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
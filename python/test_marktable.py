@@ -0,0 +1,107 @@
+# tests for the frr-reload.py mark table builder
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; see the file COPYING; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import sys
+import os
+import json
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(root, "python"))
+
+import marktable
+
+def clidef(string, func, *nodes):
+    return {"vtysh/vtysh": {
+        "string": string,
+        "defun": {"file": "vtysh/vtysh.c", "line": 1, "func": func},
+        "nodes": [{"node": node} for node in nodes],
+    }}
+
+def test_marktable():
+    names = marktable.node_types(marktable.read_source("lib", "command.h"))
+    node = names.index
+
+    xref = {"cli": {
+        "router_bgp_cmd": clidef("router bgp [(1-4294967295) [<view|vrf> WORD]]",
+                                 "router_bgp", node("CONFIG_NODE")),
+        "exit_address_family_cmd": clidef("exit-address-family",
+                                          "exit_address_family",
+                                          node("BGP_IPV4_NODE"),
+                                          node("BGP_EVPN_VNI_NODE")),
+        "vtysh_quit_bgpd_cmd": clidef("quit", "vtysh_quit_bgpd",
+                                      node("BGP_NODE"), node("BGP_IPV4_NODE")),
+        "ldp_interface_ifname_cmd": clidef("interface IFNAME",
+                                           "ldp_interface_ifname",
+                                           node("LDP_IPV6_NODE")),
+        "neighbor_remote_as_cmd": clidef("neighbor WORD remote-as ASNUM",
+                                         "NULL", node("BGP_NODE")),
+    }}
+    table = marktable.MarkTable(xref).table()
+
+    assert table["nodes"]["CONFIG_NODE"] == {
+        "index": node("CONFIG_NODE"), "parent": "ENABLE_NODE"}
+    assert table["nodes"]["BGP_IPV4_NODE"]["parent"] == "BGP_NODE"
+    assert table["commands"]["BGP_NODE"] == [
+        "quit", "neighbor WORD remote-as ASNUM"]
+    assert table["transitions"] == {
+        "CONFIG_NODE": {
+            "router bgp [(1-4294967295) [<view|vrf> WORD]]": "BGP_NODE"},
+        "BGP_NODE": {"quit": "CONFIG_NODE"},
+        "BGP_IPV4_NODE": {"exit-address-family": "BGP_NODE",
+                          "quit": "BGP_NODE"},
+        "LDP_IPV6_NODE": {"interface IFNAME": "LDP_IPV6_IFACE_NODE"},
+    }
+
+def test_verify(tmp_path, capsys):
+    table = {
+        "nodes": {"ENABLE_NODE": {"index": 3},
+                  "CONFIG_NODE": {"index": 4, "parent": "ENABLE_NODE"},
+                  "INTERFACE_NODE": {"index": 16, "parent": "CONFIG_NODE"}},
+        "commands": {"CONFIG_NODE": ["interface IFNAME", "hostname WORD"],
+                     "INTERFACE_NODE": ["description LINE..."]},
+        "transitions": {"CONFIG_NODE": {"interface IFNAME": "INTERFACE_NODE"}},
+    }
+    config = tmp_path / "frr.conf"
+    config.write_text("interface eth0\n description up\nhostname r1\n")
+    # a "vtysh -m" that marks the config like vtysh would, or not
+    vtysh = tmp_path / "vtysh"
+    marked = tmp_path / "marked"
+    vtysh.write_text("#!/bin/sh\ncat %s\n" % marked)
+    vtysh.chmod(0o755)
+
+    marked.write_text("interface eth0\n description up\nexit\nhostname r1\n\nend\n")
+    assert marktable.verify(table, str(vtysh), [str(config)])
+    out = capsys.readouterr()
+    assert out.out.splitlines()[-1].startswith("1 files, 0 differ: vtysh ")
+
+    marked.write_text("interface eth0\n description up\nhostname r1\n\nend\n")
+    assert not marktable.verify(table, str(vtysh), [str(config)])
+    out = capsys.readouterr()
+    assert "line 3" in out.err
+    assert out.out.splitlines()[-1].startswith("1 files, 1 differ: ")
+
+def test_verify_topotests():
+    # needs a build: checks the table against "vtysh -m" on every topotest
+    # config, see --verify-topotests
+    xref = os.path.join(marktable.frr_top_src, "frr.xref")
+    vtysh = os.path.join(marktable.frr_top_src, "vtysh", "vtysh")
+    if not os.path.exists(xref) or not os.access(vtysh, os.X_OK):
+        pytest.skip("frr.xref and vtysh/vtysh are not built")
+
+    with open(xref, "r") as fd:
+        table = marktable.MarkTable(json.load(fd)).table()
+    assert marktable.verify(table, vtysh, marktable.topotest_configs())
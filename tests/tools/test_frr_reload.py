@@ -0,0 +1,1321 @@
+#
+# Tests for tools/frr-reload.py
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; see the file COPYING; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import os
+import re
+import sys
+import argparse
+import json
+import time
+import socket
+import threading
+import subprocess
+import importlib.util
+from ipaddress import ip_network
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# frr-reload.py is not a valid module name, load it by path
+_spec = importlib.util.spec_from_file_location(
+    "frr_reload", os.path.join(root, "tools", "frr-reload.py")
+)
+frr_reload = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(frr_reload)
+
+sys.path.append(os.path.join(root, "tools"))
+import frr_reload_marker
+
+
+def make_config(lines):
+    config = frr_reload.Config(None)
+    config.load_contexts(lines)
+    return config
+
+
+def generate(count, changed):
+    """
+    Generate a config of roughly `count` lines, half of it prefix-list
+    entries and half of it BGP neighbor lines.  With `changed`, every 10th
+    entry of each kind is different.
+    """
+    lines = []
+    half = count // 2
+    for i in range(half):
+        seq = i * 5
+        if changed and i % 10 == 0:
+            seq += 1
+        lines.append(
+            "ip prefix-list PL%d seq %d permit 10.%d.%d.0/24"
+            % (i // 1000, seq, (i // 250) % 250, i % 250)
+        )
+
+    lines.append("router bgp 65000")
+    for i in range(count - half - 2):
+        desc = "new" if changed and i % 10 == 0 else "peer"
+        lines.append(
+            " neighbor 10.%d.%d.%d description %s"
+            % ((i // 62500) % 250, (i // 250) % 250, i % 250, desc)
+        )
+    lines.append("exit")
+    return lines
+
+
+def timed_compare(count):
+    newconf = make_config(generate(count, True))
+    running = make_config(generate(count, False))
+
+    start = time.time()
+    (lines_to_add, lines_to_del) = frr_reload.compare_context_objects(
+        newconf, running
+    )
+    elapsed = time.time() - start
+
+    # one changed prefix-list entry and one changed neighbor line per 10
+    assert len(lines_to_add) == 3 * (count // 20)
+    assert len(lines_to_del) == count // 20
+    return elapsed
+
+
+def test_config_lines():
+    lines = frr_reload.ConfigLines()
+    lines.append((("router bgp 1",), " neighbor 1.1.1.1 remote-as 1"))
+    lines.append((("router bgp 1",), " neighbor 1.1.1.1 timers 1 3"))
+    lines.append((("interface eth0",), None))
+    lines.append((("router bgp 1",), " neighbor 1.1.1.1 remote-as 1"))
+
+    assert len(lines) == 3
+    assert lines.exists(("router bgp 1",), " neighbor 1.1.1.1 timers 1 3")
+    assert lines.exists(("router bgp 1",), " neighbor 1.1.1.1 timers", False)
+    assert not lines.exists(("router bgp 2",), " neighbor", False)
+    assert not lines.exists(("interface eth0",), "", False)
+    assert lines.has_context(("interface eth0",))
+
+    lines.move_to_end((("router bgp 1",), " neighbor 1.1.1.1 remote-as 1"))
+    assert list(lines)[-1][1] == " neighbor 1.1.1.1 remote-as 1"
+
+    lines.discard((("interface eth0",), None))
+    assert not lines.has_context(("interface eth0",))
+    with pytest.raises(ValueError):
+        lines.remove((("interface eth0",), None))
+
+
+def test_exit_vrf():
+    running = make_config(
+        [
+            "vrf red",
+            " ip route 10.0.0.0/24 Null0",
+            "exit-vrf",
+            "exit",
+        ]
+    )
+    newconf = make_config(
+        [
+            "vrf red",
+            " ip route 10.0.1.0/24 Null0",
+            "exit-vrf",
+            "exit",
+            "interface eth0",
+            " ip address 10.1.1.1/24",
+            "exit",
+        ]
+    )
+    (lines_to_add, lines_to_del) = frr_reload.compare_context_objects(
+        newconf, running
+    )
+    assert list(lines_to_add) == [
+        (("vrf red",), " ip route 10.0.1.0/24 Null0"),
+        (("vrf red",), "exit-vrf"),
+        (("interface eth0",), None),
+        (("interface eth0",), " ip address 10.1.1.1/24"),
+    ]
+    assert list(lines_to_del) == [(("vrf red",), " ip route 10.0.0.0/24 Null0")]
+
+
+def test_load_streamed():
+    consumed = []
+
+    def marked():
+        for line in [
+            "ip route 10.0.0.0/24 10.1.1.1 vrf red\n",
+            "router bgp 1\n",
+            " neighbor 1.1.1.1   remote-as 1\n",
+            " neighbor 1.1.1.1 remote-as 1\n",
+            "end\n",
+        ]:
+            consumed.append(line)
+            yield line
+
+    config = frr_reload.Config(None)
+    lines = config.file_lines(marked())
+    assert not consumed
+    config.load_contexts(lines)
+    assert len(consumed) == 5
+
+    assert list(config.contexts) == [("vrf red",), ("router bgp 1",)]
+    assert list(config.contexts[("vrf red",)].lines) == [
+        "ip route 10.0.0.0/24 10.1.1.1"
+    ]
+    bgp = config.contexts[("router bgp 1",)]
+    assert list(bgp.lines) == ["neighbor 1.1.1.1 remote-as 1"]
+    assert "neighbor 1.1.1.1 remote-as 1" in bgp.dlines
+
+
+def test_context_daemon():
+    config = make_config(
+        [
+            "interface eth0",
+            "ip ospf area 0",
+            "exit",
+            "router ospf6",
+            "exit",
+            "router ospf",
+            "exit",
+            "router bgp 1",
+            "address-family ipv4 unicast",
+            "network 10.0.0.0/8",
+            "exit-address-family",
+            "exit",
+            "bgp community-list standard C1 seq 5 permit 1:1",
+            "ip route 10.0.0.0/8 Null0",
+            "ip prefix-list L1 seq 5 permit 10.0.0.0/8",
+        ]
+    )
+    owners = [frr_reload.context_daemon(ctx_keys) for ctx_keys in config.contexts]
+    assert owners == [None, "ospf6d", "ospfd", "bgpd", "bgpd", "bgpd", "staticd", None]
+
+    bgp = config.filtered(["bgpd"])
+    assert list(bgp.contexts) == [
+        ("router bgp 1",),
+        ("router bgp 1", "address-family ipv4 unicast"),
+        ("bgp community-list standard C1 seq 5 permit 1:1",),
+    ]
+    shared = config.filtered([None])
+    assert list(shared.contexts) == [
+        ("interface eth0",),
+        ("ip prefix-list L1 seq 5 permit 10.0.0.0/8",),
+    ]
+
+
+def test_config_digests():
+    lines = [
+        "router bgp 1",
+        "address-family ipv4 unicast",
+        "network 10.0.0.0/8",
+        "exit-address-family",
+        "exit",
+        "ip prefix-list L1 seq 5 permit 10.0.0.0/8",
+    ]
+    old = frr_reload.config_digests(make_config(lines))
+    assert sorted(old) == [
+        "ip prefix-list L1 seq 5 permit 10.0.0.0/8",
+        "router bgp 1",
+        "router bgp 1\naddress-family ipv4 unicast",
+    ]
+    assert old == frr_reload.config_digests(make_config(lines))
+
+    lines[2] = "network 10.1.0.0/16"
+    new = frr_reload.config_digests(make_config(lines))
+    assert [key for key in old if old[key] != new[key]] == [
+        "router bgp 1\naddress-family ipv4 unicast"
+    ]
+
+    subset = make_config(lines).subset(["router bgp 1"])
+    assert list(subset.contexts) == [
+        ("router bgp 1",),
+        ("router bgp 1", "address-family ipv4 unicast"),
+    ]
+
+
+def test_compare_marked_text():
+    running = """Building configuration...
+
+Current configuration:
+frr version 8.1
+hostname r1
+router bgp 1
+ neighbor 10.0.0.2 remote-as 2
+ address-family ipv4 unicast
+  network 10.1.0.0/16
+ exit-address-family
+exit
+ip prefix-list L1 seq 5 permit 10.0.0.0/8
+end
+"""
+    new = """frr version 8.1
+hostname r1
+router bgp 1
+ neighbor 10.0.0.2 remote-as 3
+ address-family ipv4 unicast
+  network 10.1.0.0/16
+ exit-address-family
+exit
+end
+"""
+    diff = frr_reload.compare_marked_text(new, running)
+    assert diff
+    assert list(diff.lines_to_del) == [
+        (("router bgp 1",), "neighbor 10.0.0.2 remote-as 2")
+    ]
+    assert diff.commands() == [
+        "router bgp 1\n no neighbor 10.0.0.2 remote-as 2",
+        "router bgp 1\n neighbor 10.0.0.2 remote-as 3",
+        # prefix-list entries are removed through the additions
+        "no ip prefix-list L1 seq 5 permit 10.0.0.0/8",
+    ]
+    assert diff.to_dict()["commands"] == diff.commands()
+
+    assert not frr_reload.compare_marked_text(new, new)
+
+
+class FakeSession(object):
+    def __init__(self, reject):
+        self.reject = reject
+        self.sent = []
+        self.executed = 0
+        self.failed = 0
+
+    def __call__(self, cmd, stdouts=None):
+        self.sent.append(list(cmd))
+        if cmd[-1].strip() in self.reject:
+            self.failed += 1
+            raise frr_reload.VtyshException("% Unknown command.")
+        self.executed += 1
+
+    def close(self):
+        pass
+
+
+class FakeVtysh(object):
+    def __init__(self, reject=(), marker=None):
+        self.sess = FakeSession(reject)
+        self.files = []
+        self.marker = marker
+
+    def session(self):
+        return self.sess
+
+    def exec_file(self, filename):
+        with open(filename) as fd:
+            self.files.append(fd.read().splitlines())
+
+
+class FakeRunning(FakeVtysh):
+    """
+    A FakeVtysh whose running configuration is each of `running` in turn,
+    the last one once they are all shown
+    """
+
+    def __init__(self, running, reject=(), marker=None, fail=False):
+        super(FakeRunning, self).__init__(reject, marker)
+        self.running = list(running)
+        self.transactions = []
+        self.fail = fail
+        self.shown = []
+
+    def show_running(self, daemon=None):
+        return self.running[0]
+
+    def mark_show_run_lines(self, daemon):
+        self.shown.append(daemon)
+        text = self.running.pop(0) if len(self.running) > 1 else self.running[0]
+        return text.splitlines(True)
+
+    def transaction(self, filename):
+        with open(filename) as fd:
+            self.transactions.append(fd.read().splitlines())
+        if self.fail:
+            raise frr_reload.VtyshException("commit failed")
+        return {}
+
+
+def test_config_patch(tmp_path):
+    running = """router bgp 1
+ neighbor 10.0.0.2 remote-as 2
+ neighbor 10.0.0.2 password secret
+ neighbor 10.0.0.2 timers 10 30
+exit
+end
+"""
+    new = """router bgp 1
+ neighbor 10.0.0.2 remote-as 3
+ neighbor 10.0.0.2 timers 10 30
+ address-family ipv4 unicast
+  network 10.1.0.0/16
+ exit-address-family
+exit
+end
+"""
+    generation = frr_reload.config_generation(running)
+    diff = frr_reload.compare_marked_text(new, running)
+    patch = json.loads(json.dumps(diff.to_patch(generation)))
+    assert patch["version"] == 2
+    assert patch["generation"] == generation
+    assert [(c["op"], c["line"]) for c in patch["changes"]] == [
+        ("delete", "neighbor 10.0.0.2 password secret"),
+        ("delete", "neighbor 10.0.0.2 remote-as 2"),
+        ("add", "neighbor 10.0.0.2 remote-as 3"),
+        ("add", None),
+        ("add", "network 10.1.0.0/16 "),
+        ("readd", "neighbor 10.0.0.2 timers 10 30"),
+    ]
+    assert patch["commands"]["delete"] == diff.deletes()
+    assert patch["commands"]["add"] == [
+        "router bgp 1",
+        " neighbor 10.0.0.2 remote-as 3",
+        " address-family ipv4 unicast",
+        "  network 10.1.0.0/16 ",
+    ]
+    # the second pass puts back what the deletions may have removed, and
+    # makes the additions again
+    assert patch["commands"]["readd"] == [
+        "router bgp 1",
+        " neighbor 10.0.0.2 timers 10 30",
+        " neighbor 10.0.0.2 remote-as 3",
+        " address-family ipv4 unicast",
+        "  network 10.1.0.0/16 ",
+    ]
+
+    loaded = frr_reload.ConfigDiff.from_patch(patch)
+    assert list(loaded.lines_to_add) == list(diff.lines_to_add)
+    assert list(loaded.lines_to_del) == list(diff.lines_to_del)
+    assert loaded.lines_to_readd == diff.lines_to_readd
+
+    with pytest.raises(ValueError):
+        frr_reload.ConfigDiff.from_patch(dict(patch, version=1))
+    with pytest.raises(ValueError):
+        frr_reload.ConfigDiff.from_patch(dict(patch, generation=None))
+
+    # the header of "show running-config" does not change the generation
+    header = "Building configuration...\n\nCurrent configuration:\n"
+    assert frr_reload.config_generation(header + running) == generation
+
+    # the patch is refused if the running config is not the one it was
+    # computed from
+    vtysh = FakeRunning([new])
+    assert not frr_reload.apply_patch(vtysh, patch, str(tmp_path))
+    assert vtysh.sess.sent == [] and vtysh.files == []
+
+    # otherwise the recorded commands are sent without looking at the
+    # running config, deletions that are rejected are retried like with
+    # --reload
+    patch["commands"]["delete"][1] = ["router bgp 1", " no neighbor 10.0.0.2"]
+    vtysh = FakeRunning([running], reject=("no neighbor 10.0.0.2 password secret",))
+    assert frr_reload.apply_patch(vtysh, patch, str(tmp_path))
+    assert vtysh.sess.sent == [
+        ["router bgp 1", " no neighbor 10.0.0.2 password secret"],
+        ["router bgp 1", " no neighbor 10.0.0.2 password"],
+        ["router bgp 1", " no neighbor 10.0.0.2"],
+    ]
+    assert vtysh.files == [patch["commands"]["add"], patch["commands"]["readd"]]
+    assert not os.listdir(str(tmp_path))
+
+
+def test_compare_scaling():
+    # The diff used to be quadratic in the number of changed prefix-list
+    # entries; a 500k line config now has to diff in about 10x the time of
+    # a 50k line one rather than 100x.
+    small = timed_compare(50000)
+    large = timed_compare(500000)
+
+    assert large < 60
+    assert large < max(small, 0.05) * 30
+
+
+def test_normalize():
+    lines = frr_reload.Config.file_lines(
+        [
+            "ip prefix-list L1 seq 5 permit 10.1.1.1/8 le 32 ge 24",
+            "ip prefix-list L1 seq 10 permit any",
+            "ip route 10.1.1.1/24 null0",
+            "ipv6 route 2001:DB8::1/32 Null0",
+            "router bgp 65000",
+            " address-family ipv4 unicast",
+            "  network 10.1.1.1",
+            "  network 10.2.2.2/16 route-map RM",
+            " exit-address-family",
+            "exit",
+            "vrf red",
+            " ip route 10.3.0.0/16 null0",
+            " ipv6 route 2001:db8::/32 Null0",
+            "exit-vrf",
+            "end",
+        ]
+    )
+    config = make_config(lines)
+    assert list(config.contexts) == [
+        ("ip prefix-list L1 seq 5 permit 10.0.0.0/8 ge 24 le 32",),
+        ("ip prefix-list L1 seq 10 permit any",),
+        ("ip route 10.1.1.0/24 Null0",),
+        ("ipv6 route 2001:db8::/32 Null0",),
+        ("router bgp 65000",),
+        ("router bgp 65000", "address-family ipv4 unicast"),
+        ("vrf red",),
+    ]
+    assert list(
+        config.contexts[("router bgp 65000", "address-family ipv4 unicast")].lines
+    ) == ["network 10.0.0.0/8 ", "network 10.2.0.0/16  route-map RM"]
+    assert list(config.contexts[("vrf red",)].lines) == [
+        "ip route 10.3.0.0/16 blackhole",
+        "ipv6 route 2001:db8::/32 blackhole",
+    ]
+
+    assert frr_reload.normalize_prefix("10.1.1.1/33") is None
+    assert frr_reload.normalize_prefix("010.1.1.1/8") is None
+    assert frr_reload.normalize_prefix("2001:DB8::1/32") == "2001:db8::/32"
+    assert (
+        frr_reload.get_normalized_ipv6_line("ipv6 address 2001:DB8:0::1/64 65000:1")
+        == "ipv6 address 2001:db8::/64 65000:1"
+    )
+
+
+def test_normalize_cached():
+    # A reload parses the running configuration twice, and most of its lines
+    # are also in the new configuration: only the first parse of a line has
+    # to normalize it.
+    lines = []
+    for i in range(20000):
+        addr = "10.%d.%d.1/24" % (i // 250, i % 250)
+        lines.append("ip prefix-list PL seq %d permit %s le 32" % (i * 5, addr))
+        lines.append("ip route %s null0" % addr)
+    lines.append("router bgp 65000")
+    lines.extend(" network 10.%d.%d.1/24" % (i // 250, i % 250) for i in range(20000))
+    lines.extend(["exit", "end"])
+    lines = list(frr_reload.Config.file_lines(lines))
+
+    normalizers = (
+        frr_reload.normalize_prefix,
+        frr_reload.normalize_context_key,
+        frr_reload.normalize_bgp_network,
+    )
+    for normalizer in normalizers:
+        normalizer.cache_clear()
+
+    config = make_config(lines)
+    assert len(config.contexts) == 40001
+    first = [normalizer.cache_info() for normalizer in normalizers]
+    # each distinct prefix, context key and network is normalized once
+    assert [info.misses for info in first] == [20000, 40001, 20000]
+
+    for parse in (1, 2):
+        config = make_config(lines)
+        assert len(config.contexts) == 40001
+        for (normalizer, info) in zip(normalizers, first):
+            now = normalizer.cache_info()
+            assert now.misses == info.misses
+            if normalizer is not frr_reload.normalize_prefix:
+                # the later parses only hit the cache
+                assert now.hits == info.hits + parse * info.misses
+
+
+
+class OldConfig(frr_reload.Config):
+    """
+    A Config with the normalizations as they were before they were compiled
+    and cached, to compare their speed with
+    """
+
+    def save_contexts(self, key, lines):
+        if not key:
+            return
+
+        re_key_rt = re.match(r"(ip|ipv6)\s+route\s+([A-Fa-f:.0-9/]+)(.*)$", key[0])
+        if re_key_rt:
+            addr = re_key_rt.group(2)
+            if "/" in addr:
+                try:
+                    newaddr = ip_network(addr, strict=False)
+                    key[0] = "%s route %s/%s%s" % (
+                        re_key_rt.group(1),
+                        str(newaddr.network_address),
+                        newaddr.prefixlen,
+                        re_key_rt.group(3),
+                    )
+                except ValueError:
+                    pass
+
+        re_key_rt = re.match(
+            r"(ip|ipv6)\s+prefix-list(.*)(permit|deny)\s+([A-Fa-f:.0-9/]+)(.*)$", key[0]
+        )
+        if re_key_rt:
+            addr = re_key_rt.group(4)
+            if "/" in addr:
+                try:
+                    network_addr = ip_network(addr, strict=False)
+                    newaddr = "%s/%s" % (
+                        str(network_addr.network_address),
+                        network_addr.prefixlen,
+                    )
+                except ValueError:
+                    newaddr = addr
+            else:
+                newaddr = addr
+
+            legestr = re_key_rt.group(5)
+            re_lege = re.search(r"(.*)le\s+(\d+)\s+ge\s+(\d+)(.*)", legestr)
+            if re_lege:
+                legestr = "%sge %s le %s%s" % (
+                    re_lege.group(1),
+                    re_lege.group(3),
+                    re_lege.group(2),
+                    re_lege.group(4),
+                )
+
+            key[0] = "%s prefix-list%s%s %s%s" % (
+                re_key_rt.group(1),
+                re_key_rt.group(2),
+                re_key_rt.group(3),
+                newaddr,
+                legestr,
+            )
+
+        if lines and key[0].startswith("router bgp"):
+            newlines = []
+            for line in lines:
+                re_net = re.match(r"network\s+([A-Fa-f:.0-9/]+)(.*)$", line)
+                if re_net:
+                    addr = re_net.group(1)
+                    if "/" not in addr:
+                        addr = addr + "/8"
+                    try:
+                        network_addr = ip_network(addr, strict=False)
+                        line = "network %s/%s %s" % (
+                            str(network_addr.network_address),
+                            network_addr.prefixlen,
+                            re_net.group(2),
+                        )
+                    except ValueError:
+                        pass
+                newlines.append(line)
+            lines = newlines
+
+        if (
+            key[0].startswith("ip route")
+            or key[0].startswith("ipv6 route")
+            and "null0" in key[0]
+        ):
+            key[0] = re.sub(r"\s+null0(\s*$)", " Null0", key[0])
+
+        if lines and key[0].startswith("vrf "):
+            newlines = []
+            for line in lines:
+                if line.startswith("ip route ") or line.startswith("ipv6 route "):
+                    if "null0" in line:
+                        line = re.sub(r"\s+null0(\s*$)", " blackhole", line)
+                    elif "Null0" in line:
+                        line = re.sub(r"\s+Null0(\s*$)", " blackhole", line)
+                newlines.append(line)
+            lines = newlines
+
+        key = tuple(key)
+        ctx = self.contexts.get(key)
+        if ctx is None:
+            self.contexts[key] = frr_reload.Context(key, lines)
+        elif lines:
+            ctx.add_lines(lines)
+
+
+def test_normalize_speedup():
+    # A config of prefix-lists, static routes and BGP networks, parsed three
+    # times as in a reload, with the old and the current normalizations.
+    # The request aimed at 5x; the normalizations were measured at about 2x
+    # for the first parse and 2.5-3x for the three, and are checked here
+    # with some margin for noisy machines.
+    lines = []
+    for i in range(10000):
+        addr = "10.%d.%d.1/24" % (i // 250, i % 250)
+        lines.append("ip prefix-list PL seq %d permit %s le 32" % (i * 5, addr))
+        lines.append("ip route %s null0" % addr)
+    lines.append("router bgp 65000")
+    lines.extend(" network 10.%d.%d.1/24" % (i // 250, i % 250) for i in range(10000))
+    lines.extend(["exit", "end"])
+    lines = list(frr_reload.Config.file_lines(lines))
+
+    for normalizer in (
+        frr_reload.normalize_prefix,
+        frr_reload.normalize_ipv6_word,
+        frr_reload.normalize_context_key,
+        frr_reload.normalize_bgp_network,
+    ):
+        normalizer.cache_clear()
+
+    times = {}
+    configs = {}
+    for cls in (OldConfig, frr_reload.Config):
+        times[cls] = []
+        for _ in range(3):
+            start = time.perf_counter()
+            config = cls(None)
+            config.load_contexts(lines)
+            times[cls].append(time.perf_counter() - start)
+        configs[cls] = config
+
+    old = configs[OldConfig].contexts
+    new = configs[frr_reload.Config].contexts
+    assert list(new) == list(old)
+    assert all(list(new[key].lines) == list(old[key].lines) for key in old)
+
+    assert times[frr_reload.Config][0] < times[OldConfig][0]
+    assert sum(times[frr_reload.Config]) * 1.5 < sum(times[OldConfig])
+
+mark_table = {
+    "nodes": {
+        "ENABLE_NODE": {"index": 3},
+        "CONFIG_NODE": {"index": 4, "parent": "ENABLE_NODE"},
+        "VRF_NODE": {"index": 15, "parent": "CONFIG_NODE"},
+        "INTERFACE_NODE": {"index": 16, "parent": "CONFIG_NODE"},
+        "BGP_NODE": {"index": 50, "parent": "CONFIG_NODE"},
+        "BGP_IPV4_NODE": {"index": 52, "parent": "BGP_NODE"},
+    },
+    "commands": {
+        "CONFIG_NODE": [
+            "frr version VERSION...",
+            "hostname WORD",
+            "no hostname [WORD]",
+            "hostmaster WORD",
+            "interface IFNAME [vrf NAME]",
+            "router bgp [(1-4294967295) [<view|vrf> VIEWVRFNAME]]",
+            "ip prefix-list WORD [seq (1-4294967295)] <deny|permit> <any|A.B.C.D/M [{ge (0-32)|le (0-32)}]>",
+            "ip route A.B.C.D/M <A.B.C.D|Null0>",
+            "vrf NAME",
+        ],
+        "VRF_NODE": ["ip route A.B.C.D/M <A.B.C.D|Null0>", "exit-vrf", "exit"],
+        "INTERFACE_NODE": [
+            "ip address A.B.C.D/M",
+            "description LINE...",
+            "[no] shutdown",
+            "ip ospf authentication message-digest [A.B.C.D]",
+            "no ip ospf authentication",
+            "exit",
+        ],
+        "BGP_NODE": [
+            "neighbor <A.B.C.D|X:X::X:X|WORD> remote-as <(1-4294967295)|internal|external>",
+            "address-family <ipv4|ipv6> [unicast]",
+            "exit",
+        ],
+        "BGP_IPV4_NODE": ["network A.B.C.D/M", "exit-address-family", "exit"],
+    },
+    "transitions": {
+        "CONFIG_NODE": {
+            "interface IFNAME [vrf NAME]": "INTERFACE_NODE",
+            "router bgp [(1-4294967295) [<view|vrf> VIEWVRFNAME]]": "BGP_NODE",
+            "vrf NAME": "VRF_NODE",
+        },
+        "VRF_NODE": {"exit-vrf": "CONFIG_NODE", "exit": "CONFIG_NODE"},
+        "INTERFACE_NODE": {"exit": "CONFIG_NODE"},
+        "BGP_NODE": {
+            "address-family <ipv4|ipv6> [unicast]": "BGP_IPV4_NODE",
+            "exit": "CONFIG_NODE",
+        },
+        "BGP_IPV4_NODE": {"exit-address-family": "BGP_NODE", "exit": "BGP_NODE"},
+    },
+}
+
+
+def test_match_token():
+    def match(kind, word):
+        return frr_reload_marker.match_token(frr_reload_marker.CommandToken(kind), word)
+
+    assert match("ipv4", "10.0.0.1") == frr_reload_marker.EXACT_MATCH
+    assert match("ipv4", "10.0.0") == frr_reload_marker.PARTLY_MATCH
+    assert match("ipv4", "10.0.0.256") == frr_reload_marker.NO_MATCH
+    assert match("ipv4_prefix", "10.0.0.0/8") == frr_reload_marker.EXACT_MATCH
+    assert match("ipv4_prefix", "10.0.0.0/33") == frr_reload_marker.NO_MATCH
+    assert match("ipv6", "2001:db8::1") == frr_reload_marker.EXACT_MATCH
+    assert match("ipv6", "2001:db8::1/64") == frr_reload_marker.NO_MATCH
+    assert match("ipv6_prefix", "2001:db8::/32") == frr_reload_marker.EXACT_MATCH
+    assert match("mac", "00:11:22:33:44:55") == frr_reload_marker.EXACT_MATCH
+    assert match("mac_prefix", "00:11:22:33:44:55/49") == frr_reload_marker.NO_MATCH
+
+
+def test_config_marker():
+    marker = frr_reload_marker.ConfigMarker(mark_table)
+    config = [
+        "frr version 8.1 with extras\n",
+        "hostn r1\n",
+        "!\n",
+        "interface eth0\n",
+        " ip address 10.0.0.1/24\n",
+        " description uplink to core\n",
+        " no shutdown\n",
+        "router bgp 65000\n",
+        " neighbor 10.0.0.2 remote-as external\n",
+        " address-family ipv4 unicast\n",
+        "  network 10.1.0.0/16\n",
+        " exit-address-family\n",
+        "exit\n",
+        "vrf red\n",
+        " ip route 10.2.0.0/16 Null0\n",
+        "exit-vrf\n",
+        "ip prefix-list L1 seq 5 permit 10.0.0.0/8 le 24\n",
+        "end\n",
+    ]
+    marked = list(marker.mark(config))
+    assert marked == config[:7] + ["exit\n"] + config[7:16] + [
+        "end\n",
+        config[16],
+        "\nend\n",
+    ]
+
+    for (line, error) in [
+        ("router bgp 65000 foo\n", "line 1: % Unknown command"),
+        ("router\n", "line 1: % Command incomplete"),
+        ("host r1\n", "line 1: % Ambiguous command"),
+    ]:
+        with pytest.raises(frr_reload_marker.MarkException) as e:
+            list(marker.mark([line]))
+        assert str(e.value).startswith(error)
+
+    # errors in a child node are reported for the line as it was given
+    with pytest.raises(frr_reload_marker.MarkException) as e:
+        list(marker.mark(["interface eth0\n", " ip addr 10.0.0.256/24\n"]))
+    assert str(e.value) == "line 2: % Unknown command:  ip addr 10.0.0.256/24\n"
+
+
+def test_deletion_lookup():
+    marker = frr_reload_marker.ConfigMarker(mark_table)
+    intf = ("interface eth0",)
+    auth = "ip ospf authentication message-digest 1.1.1.1"
+
+    def deletion(ctx_keys, line):
+        return marker.deletion(frr_reload.lines_to_config(ctx_keys, line, True))
+
+    assert deletion(intf, auth) == (
+        ["interface eth0", " no ip ospf authentication"],
+        2,
+    )
+    assert deletion(intf, "shutdown") == (["interface eth0", " no shutdown"], 0)
+    # found in the parent node, like vtysh does
+    assert deletion(intf, "hostname r1") == (["interface eth0", " no hostname r1"], 0)
+    # unknown contexts and commands are left to vtysh
+    assert deletion(("interface",), "shutdown") is None
+    assert deletion(intf, "mtu 9000") is None
+
+    # the deletion is sent as it is first, and if vtysh rejects it, retried
+    # in the form vtysh accepts, without the retries in between
+    vtysh = FakeVtysh(reject=("no " + auth,), marker=marker)
+    frr_reload.timer.enabled = True
+    frr_reload.timer.reset()
+    try:
+        assert frr_reload.delete_lines(vtysh, [(intf, auth), (intf, "shutdown")])
+        report = frr_reload.timer.report()
+    finally:
+        frr_reload.timer.enabled = False
+    assert vtysh.sess.sent == [
+        ["interface eth0", " no " + auth],
+        ["interface eth0", " no ip ospf authentication"],
+        ["interface eth0", " no shutdown"],
+    ]
+    assert report["counts"]["delete_retries_saved"] == 1
+    assert report["counts"]["delete_retries"] == 1
+
+    # a command that is accepted as it is needs no retry
+    vtysh = FakeVtysh(marker=marker)
+    assert frr_reload.delete_lines(vtysh, [(intf, auth)])
+    assert vtysh.sess.sent == [["interface eth0", " no " + auth]]
+
+
+def test_reload_transaction(tmp_path):
+    running = """interface eth0
+ ip ospf authentication message-digest 1.1.1.1
+exit
+router bgp 1
+ neighbor 10.0.0.2 remote-as 2
+exit
+end
+"""
+    new = """interface eth0
+ description uplink
+exit
+router bgp 1
+ neighbor 10.0.0.2 remote-as 3
+exit
+end
+"""
+    newconf = make_config([line.strip() for line in new.splitlines()])
+    auth = ["interface eth0", " no ip ospf authentication message-digest 1.1.1.1"]
+    neighbor = ["router bgp 1", " no neighbor 10.0.0.2 remote-as 2"]
+    additions = [
+        "interface eth0",
+        " description uplink",
+        "router bgp 1",
+        " neighbor 10.0.0.2 remote-as 3",
+    ]
+
+    # without a command table, the deletions are run one by one, so that
+    # they can be retried, and only the additions are in the transaction
+    vtysh = FakeRunning([running, new])
+    assert frr_reload.reload_transaction(vtysh, newconf, str(tmp_path))
+    assert vtysh.sess.sent == [auth, neighbor]
+    assert vtysh.transactions == [additions]
+    assert vtysh.files == []
+
+    # with it, deletions that vtysh accepts as they are can be part of the
+    # transaction, others are still run one by one
+    marker = frr_reload_marker.ConfigMarker(mark_table)
+    running = running.replace(" neighbor 10.0.0.2 remote-as 2\n", "")
+    vtysh = FakeRunning([running, new], marker=marker)
+    assert frr_reload.reload_transaction(vtysh, newconf, str(tmp_path))
+    assert vtysh.sess.sent == [auth]
+    assert vtysh.transactions == [additions]
+
+    shutdown = ["interface eth0", " no shutdown"]
+    running = running.replace(auth[1][4:], " shutdown")
+    vtysh = FakeRunning([running, new], marker=marker)
+    assert frr_reload.reload_transaction(vtysh, newconf, str(tmp_path))
+    assert vtysh.sess.sent == []
+    assert vtysh.transactions == [shutdown + additions[1:]]
+
+    # a failed transaction may be partly applied: the fallback compares with
+    # the running configuration again and only applies what is missing
+    partial = new.replace(" description uplink\n", " shutdown\n")
+    vtysh = FakeRunning([running, partial, new], marker=marker, fail=True)
+    assert frr_reload.reload_transaction(vtysh, newconf, str(tmp_path))
+    assert len(vtysh.transactions) == 1
+    assert vtysh.sess.sent == [shutdown]
+    # the neighbor was already changed by the transaction
+    assert vtysh.files
+    assert all(lines == additions[:2] for lines in vtysh.files)
+    assert not os.listdir(str(tmp_path))
+
+
+def test_reload_incremental(tmp_path):
+    running = """interface eth0
+ description uplink
+exit
+router bgp 1
+ neighbor 10.0.0.2 remote-as 2
+exit
+end
+"""
+    new = running.replace("remote-as 2", "remote-as 3")
+
+    def config(text):
+        return make_config([line.strip() for line in text.splitlines()])
+
+    # without a state, everything is compared
+    state = {}
+    vtysh = FakeRunning([running])
+    assert frr_reload.reload_incremental(vtysh, config(running), str(tmp_path), state)
+    assert vtysh.shown == ["", ""]
+    assert vtysh.sess.sent == [] and vtysh.files == []
+    assert set(state) == {"generation", "contexts"}
+
+    # only the running configuration of bgpd is fetched to reload its context
+    vtysh = FakeRunning([running, new])
+    assert frr_reload.reload_incremental(vtysh, config(new), str(tmp_path), state)
+    assert vtysh.shown == ["bgpd", "bgpd"]
+    assert vtysh.sess.sent == [["router bgp 1", " no neighbor 10.0.0.2 remote-as 2"]]
+    assert vtysh.files[0] == ["router bgp 1", " neighbor 10.0.0.2 remote-as 3"]
+
+    # nothing changed, nothing is fetched but the generation
+    vtysh = FakeRunning([new])
+    assert frr_reload.reload_incremental(vtysh, config(new), str(tmp_path), state)
+    assert vtysh.shown == []
+
+    # the running configuration was changed since, everything is compared
+    vtysh = FakeRunning([running, new])
+    assert frr_reload.reload_incremental(vtysh, config(new), str(tmp_path), state)
+    assert vtysh.shown == ["", ""]
+    assert vtysh.files[0] == ["router bgp 1", " neighbor 10.0.0.2 remote-as 3"]
+
+    # the state is saved between runs, and removed after a failed reload
+    state_file = str(tmp_path / "frr-reload.state")
+    frr_reload.save_reload_state(state_file, state)
+    assert frr_reload.load_reload_state(state_file) == state
+    frr_reload.save_reload_state(state_file, {})
+    assert frr_reload.load_reload_state(state_file) == {}
+
+    # with the running configuration kept, the first pass compares with it,
+    # and only the changed contexts are fetched again afterwards
+    state = {}
+    vtysh = FakeRunning([running])
+    assert frr_reload.reload_incremental(
+        vtysh, config(running), str(tmp_path), state, keep_running=True
+    )
+    assert vtysh.shown == ["", "", ""]
+    vtysh = FakeRunning([running, new])
+    assert frr_reload.reload_incremental(
+        vtysh, config(new), str(tmp_path), state, keep_running=True
+    )
+    assert vtysh.shown == ["bgpd", "bgpd"]
+    assert vtysh.sess.sent == [["router bgp 1", " no neighbor 10.0.0.2 remote-as 2"]]
+    assert list(state["running"].contexts) == [("interface eth0",), ("router bgp 1",)]
+    assert list(state["running"].contexts[("router bgp 1",)].lines) == [
+        "neighbor 10.0.0.2 remote-as 3"
+    ]
+
+
+def test_reload_parallel(tmp_path):
+    running = """ip prefix-list L1 seq 5 permit 10.0.0.0/8
+router bgp 1
+ neighbor 10.0.0.2 prefix-list L1 in
+exit
+end
+"""
+    new = running.replace("L1", "L2")
+
+    class Daemons(FakeRunning):
+        def daemons(self):
+            return ["zebra", "bgpd"]
+
+    reloaded = []
+
+    def reload(vtysh, newconf, rundir, daemon, daemons, contexts, running):
+        reloaded.append((daemons, vtysh.files[:]))
+        return True
+
+    config = make_config([line.strip() for line in new.splitlines()])
+    vtysh = Daemons([running])
+    assert frr_reload.reload_parallel(vtysh, config, str(tmp_path), reload=reload)
+
+    # the new prefix-list is added before bgpd refers to it, the old one is
+    # only deleted once bgpd no longer does
+    added = [["ip prefix-list L2 seq 5 permit 10.0.0.0/8"]]
+    assert vtysh.sess.sent == []
+    assert reloaded == [(["bgpd"], added), ([None], added)]
+
+
+def test_config_file_lines():
+    bgp = ("router bgp 65000",)
+    af = bgp + ("address-family ipv4 unicast",)
+    changes = [
+        (bgp, "neighbor 10.0.0.2 remote-as external", True),
+        (bgp, "neighbor 10.0.0.3 remote-as external", False),
+        (bgp, "neighbor 10.0.0.4 remote-as external", False),
+        (af, None, False),
+        (af, "network 10.1.0.0/16", False),
+        (af, "network 10.2.0.0/16", False),
+        (bgp, "bgp router-id 1.1.1.1", False),
+        (("vrf red",), "ip route 10.3.0.0/16 Null0", False),
+        (("vrf red",), "exit-vrf", False),
+        (("vrf red",), "ip route 10.4.0.0/16 Null0", False),
+        (("ip prefix-list L1 seq 5 permit any",), None, False),
+    ]
+    assert frr_reload.config_file_lines(changes) == [
+        "router bgp 65000",
+        " no neighbor 10.0.0.2 remote-as external",
+        " neighbor 10.0.0.3 remote-as external",
+        " neighbor 10.0.0.4 remote-as external",
+        " address-family ipv4 unicast",
+        "  network 10.1.0.0/16",
+        "  network 10.2.0.0/16",
+        # going back to the parent node enters it again from the top
+        "router bgp 65000",
+        " bgp router-id 1.1.1.1",
+        "vrf red",
+        " ip route 10.3.0.0/16 Null0",
+        " exit-vrf",
+        "vrf red",
+        " ip route 10.4.0.0/16 Null0",
+        "ip prefix-list L1 seq 5 permit any",
+    ]
+
+    # one node entry for all neighbors instead of one for each
+    count = 50000
+    changes = [
+        (bgp, "neighbor 10.%d.%d.1 remote-as external" % divmod(i, 256), False)
+        for i in range(count)
+    ]
+    assert len(frr_reload.config_file_lines(changes)) == count + 1
+
+
+def test_reload_timer():
+    timer = frr_reload.ReloadTimer()
+    with timer.phase("parse"):
+        pass
+    assert not timer.phases
+
+    timer.enabled = True
+
+    def lines():
+        for line in ("a", "b"):
+            time.sleep(0.01)
+            yield line
+
+    with timer.phase("parse"):
+        assert list(timer.iterate("mark", lines())) == ["a", "b"]
+        timer.count("retries")
+        timer.count("retries", 2)
+
+    report = timer.report()
+    assert list(report["phases"]) == ["mark", "parse"]
+    assert report["phases"]["mark"]["calls"] == 1
+    assert report["phases"]["mark"]["wall"] >= 0.02
+    # the nested phase is not counted again in the outer one
+    assert report["phases"]["parse"]["wall"] < 0.01
+    assert report["counts"] == {"retries": 3}
+
+
+class FakeVty(threading.Thread):
+    """
+    A daemon's vty socket, replying to each command with the status that
+    `reply` returns for it
+    """
+
+    def __init__(self, path, reply):
+        super(FakeVty, self).__init__()
+        self.daemon = True
+        self.reply = reply
+        self.commands = []
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+        self.start()
+
+    def run(self):
+        conn = self.server.accept()[0]
+        buf = b""
+        while True:
+            data = conn.recv(4096)
+            if not data:
+                break
+            buf += data
+            while b"\0" in buf:
+                (command, buf) = buf.split(b"\0", 1)
+                command = command.decode("UTF-8")
+                self.commands.append(command)
+                (status, output) = self.reply(command)
+                conn.sendall(output.encode("UTF-8") + b"\0\0\0" + bytes([status]))
+        conn.close()
+
+
+def test_vty_transaction(tmp_path):
+    common = (
+        "enable",
+        "configure",
+        "XFRR_start_configuration",
+        "XFRR_end_configuration",
+    )
+
+    def zebra(command):
+        if command in common or command.startswith("ip route"):
+            return (0, "")
+        return (2, "")
+
+    def bgpd(command, commit_status=0):
+        if command == "XFRR_end_configuration" and commit_status:
+            return (commit_status, "% Configuration failed.\n")
+        if command in common or command.startswith(("router bgp", "neighbor")):
+            return (0, "")
+        return (2, "")
+
+    lines = [
+        "ip route 10.0.0.0/8 Null0",
+        "router bgp 65000",
+        " neighbor 10.0.0.2 remote-as external",
+    ]
+
+    servers = [
+        FakeVty(str(tmp_path / "zebra.vty"), zebra),
+        FakeVty(str(tmp_path / "bgpd.vty"), bgpd),
+    ]
+    with frr_reload.VtyClient(str(tmp_path)) as client:
+        client.connect()
+        commits = client.transaction(lines)
+    assert sorted(commits) == ["bgpd", "zebra"]
+    for server in servers:
+        server.join(5)
+        assert server.commands[-1] == "XFRR_end_configuration"
+        assert "XFRR_start_configuration" in server.commands
+
+    # a rejected commit fails the whole transaction
+    for name in ("zebra.vty", "bgpd.vty"):
+        os.unlink(str(tmp_path / name))
+    FakeVty(str(tmp_path / "zebra.vty"), zebra)
+    FakeVty(str(tmp_path / "bgpd.vty"), lambda command: bgpd(command, 13))
+    with frr_reload.VtyClient(str(tmp_path)) as client:
+        client.connect()
+        with pytest.raises(frr_reload.VtyshException) as e:
+            client.transaction(lines)
+    assert str(e.value) == "vty (transaction) failed for 0 lines and 1 commits"
+
+
+def test_file_watcher(tmp_path):
+    filename = tmp_path / "frr.conf"
+    filename.write_text("hostname r1\n")
+
+    watcher = frr_reload.FileWatcher(str(filename), poll_interval=0.05)
+    poller = frr_reload.FileWatcher(str(filename), poll_interval=0.05)
+    poller.close()
+    try:
+        for w in (watcher, poller):
+            assert w.wait(0.1) == 0
+
+        # other files in the directory are not reported
+        (tmp_path / "other.conf").write_text("hostname r2\n")
+        assert watcher.wait(0.1) == 0
+
+        # files are usually replaced rather than written in place
+        (tmp_path / "frr.conf.tmp").write_text("hostname r3\n")
+        os.rename(str(tmp_path / "frr.conf.tmp"), str(filename))
+        for w in (watcher, poller):
+            assert w.wait(1) >= 1
+    finally:
+        watcher.close()
+
+
+def test_watch_status(tmp_path):
+    path = str(tmp_path / "status.sock")
+    status = frr_reload.WatchStatus()
+    status.serve(path)
+
+    def query():
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        data = b""
+        while not data.endswith(b"\n"):
+            data += sock.recv(4096)
+        sock.close()
+        return json.loads(data.decode("UTF-8"))
+
+    try:
+        status.queued(3)
+        assert query()["queue_depth"] == 3
+
+        status.applied(False, 0.5, "some of the changes could not be applied")
+        reply = query()
+        assert reply["queue_depth"] == 0
+        assert (reply["applies"], reply["failures"]) == (1, 1)
+        assert reply["last_apply_latency"] == 0.5
+    finally:
+        status.close()
+    assert not os.path.exists(path)
+
+
+def test_watch_config_errors(monkeypatch):
+    # an unexpected error is reported, and does not stop watching
+    class Watcher(object):
+        waits = 0
+
+        def __init__(self, filename):
+            pass
+
+        def wait(self, timeout=None):
+            Watcher.waits += 1
+            if Watcher.waits > 3:
+                raise KeyboardInterrupt()
+            return 1 if timeout is None else 0
+
+        def close(self):
+            pass
+
+    states = []
+
+    def reload_with_args(vtysh, newconf, args, incremental=False, state=None):
+        states.append(state)
+        if len(states) == 1:
+            state["generation"] = "1"
+            raise KeyError("router bgp 1")
+        return True
+
+    monkeypatch.setattr(frr_reload, "FileWatcher", Watcher)
+    monkeypatch.setattr(frr_reload, "reload_with_args", reload_with_args)
+    monkeypatch.setattr(frr_reload.Config, "load_from_file", lambda self, name: None)
+
+    status = frr_reload.WatchStatus()
+    args = argparse.Namespace(filename="frr.conf", debounce=0)
+    with pytest.raises(KeyboardInterrupt):
+        frr_reload.watch_config(None, args, status)
+    assert (status.applies, status.failures) == (2, 1)
+    assert status.last_error == "'router bgp 1'"
+    # the same state is used by every apply, and emptied after a failure
+    assert states[0] is states[1] and states[0] == {}
+
+
+def test_reload_pathspaces(tmp_path):
+    # the options given to the process of each pathspace
+    args = argparse.Namespace(
+        **dict(
+            (option.lstrip("-").replace("-", "_"), None)
+            for option in frr_reload.forwarded_options
+        )
+    )
+    args.reload = True
+    args.daemon = ""
+    args.profile = "-"
+    args.profile_json = "/tmp/{pathspace}.json"
+    args.jobs = 4
+    assert frr_reload.forward_args(args, "r1") == [
+        "--reload",
+        "--profile-json",
+        "/tmp/r1.json",
+        "--profile",
+        "-",
+    ]
+    assert (
+        frr_reload.pathspace_log_file("/var/log/frr/frr-reload.log", "r1")
+        == "/var/log/frr/frr-reload-r1.log"
+    )
+    assert frr_reload.pathspace_log_file("/tmp/reload.log", "r1") == (
+        "/tmp/frr-reload-r1.log"
+    )
+    assert frr_reload.pathspace_log_file("/tmp/{pathspace}.log", "r1") == (
+        "/tmp/r1.log"
+    )
+
+    # a vtysh that only marks configurations, and logs how it was called
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    vtysh = bindir / "vtysh"
+    vtysh.write_text(
+        "#!/bin/sh\n"
+        'echo "$*" >> %s\n'
+        'eval f=\\${$#}; cat "$f"; echo end\n' % (tmp_path / "vtysh.log")
+    )
+    vtysh.chmod(0o755)
+
+    confdir = tmp_path / "etc"
+    for name in ("r1", "r2", "r3"):
+        (confdir / name).mkdir(parents=True)
+        (confdir / name / "frr.conf").write_text("hostname %s\n" % name)
+    (confdir / "other").mkdir()
+    running = tmp_path / "running.conf"
+    running.write_text("hostname old\n")
+
+    def reload(*argv):
+        return subprocess.run(
+            [sys.executable, os.path.join(root, "tools", "frr-reload.py"), "--test"]
+            + ["--bindir", str(bindir), "--confdir", str(confdir)]
+            + ["--input", str(running), "--jobs", "2"]
+            + list(argv),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+
+    proc = reload("--pathspace-glob", "r*")
+    assert proc.returncode == 0, proc.stderr
+    # in the order of the pathspaces, whichever finished first
+    assert proc.stdout.split("\n=== ")[1:] == [
+        "%s\n\nLines To Delete\n===============\nno hostname old\n\n"
+        "Lines To Add\n============\nhostname %s\n" % (name, name)
+        for name in ("r1", "r2", "r3")
+    ]
+    assert "Finished 3 pathspaces, 0 failed" in proc.stderr
+    log = (tmp_path / "vtysh.log").read_text()
+    assert "-N r2 -m -f %s" % (confdir / "r2" / "frr.conf") in log
+    assert "other" not in log
+
+    # the config of each pathspace from a template, r4 has none
+    (tmp_path / "vtysh.log").unlink()
+    proc = reload("-N", "r1", "-N", "r4", str(confdir / "{pathspace}" / "frr.conf"))
+    assert proc.returncode == 1
+    assert "Pathspace r1: ok" in proc.stderr
+    assert "Pathspace r4: failed" in proc.stderr
+    assert "Finished 2 pathspaces, 1 failed: r4" in proc.stderr
@@ -0,0 +1,248 @@
+#
+# Tests for tools/generate_support_bundle.py
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; see the file COPYING; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import os
+import gzip
+import json
+import time
+import subprocess
+import importlib.util
+
+root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_spec = importlib.util.spec_from_file_location(
+    "generate_support_bundle", os.path.join(root, "tools", "generate_support_bundle.py")
+)
+bundle = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(bundle)
+
+# a vtysh that prints the command, a lot of output or nothing for a while
+fake_vtysh = """#!/bin/sh
+case "$2" in
+"show big") yes "line of output" | head -c 100000;;
+"show slow") echo partial; exec sleep 10;;
+*) echo "output of $2";;
+esac
+"""
+
+
+def test_read_commands():
+    proc_cmds = bundle.read_commands(
+        os.path.join(root, "tools", "etc", "frr", "support_bundle_commands.conf")
+    )
+    assert "bgp" in proc_cmds and "zebra" in proc_cmds
+    assert proc_cmds["bgp"][0] == "show bgp summary"
+    assert all(cmd and not cmd.startswith("#") for cmd in proc_cmds["bgp"])
+
+
+def test_collect(tmp_path):
+    vtysh = tmp_path / "vtysh"
+    vtysh.write_text(fake_vtysh)
+    vtysh.chmod(0o755)
+    log_dir = tmp_path / "logs"
+    log_dir.mkdir()
+
+    proc_cmds = {
+        "bgp": ["show bgp summary", "show big", "show slow", "show bgp nexthop"],
+        "zebra": ["show ip route"],
+    }
+    start = time.time()
+    manifest = bundle.collect(
+        proc_cmds,
+        str(log_dir),
+        [str(vtysh)],
+        jobs=4,
+        timeout=0.5,
+        max_bytes=1000,
+        compress="gzip",
+    )
+    # the other commands do not wait for the one that is stuck
+    assert time.time() - start < 5
+
+    with gzip.open(str(log_dir / "bgp_support_bundle.log.gz"), "rt") as fd:
+        output = fd.read()
+    # the output of each command in order, whichever finished first
+    positions = [output.index(cmd + "\n") for cmd in proc_cmds["bgp"]]
+    assert positions == sorted(positions)
+    assert "output of show bgp nexthop\n" in output
+    assert "% Truncated at 1000 bytes\n" in output
+    assert "partial\n\n% Timed out after 0.5s\n" in output
+
+    with open(str(log_dir / bundle.MANIFEST)) as fd:
+        assert json.load(fd) == json.loads(json.dumps(manifest))
+    bgp = manifest["daemons"]["bgp"]
+    assert bgp["file"] == "bgp_support_bundle.log.gz"
+    assert [(e["bytes"], e["truncated"], e["timed_out"]) for e in bgp["commands"]] == [
+        (27, False, False),
+        (1000, True, False),
+        (8, False, True),
+        (27, False, False),
+    ]
+    assert manifest["daemons"]["zebra"]["commands"][0]["returncode"] == 0
+
+    # the previous bundle is kept, uncompressed files have no suffix
+    bundle.collect({"zebra": ["show ip route"]}, str(log_dir), [str(vtysh)])
+    assert (log_dir / "zebra_support_bundle.log").read_text().endswith(
+        "output of show ip route\n"
+    )
+    assert (log_dir / "zebra_support_bundle.log.gz").exists()
+    assert (log_dir / (bundle.MANIFEST + ".prev")).exists()
+    assert sorted(os.listdir(str(log_dir))) == sorted(
+        [
+            "bgp_support_bundle.log.gz",
+            "zebra_support_bundle.log",
+            "zebra_support_bundle.log.gz",
+            bundle.MANIFEST,
+            bundle.MANIFEST + ".prev",
+        ]
+    )
+
+
+def test_max_file_bytes(tmp_path):
+    vtysh = tmp_path / "vtysh"
+    vtysh.write_text(fake_vtysh)
+    vtysh.chmod(0o755)
+    log_dir = tmp_path / "logs"
+    log_dir.mkdir()
+
+    # the output that would not fit is skipped, the ones after it still fit
+    proc_cmds = {"bgp": ["show bgp summary", "show big", "show bgp nexthop"]}
+    manifest = bundle.collect(
+        proc_cmds, str(log_dir), [str(vtysh)], max_file_bytes=1000
+    )
+    output = (log_dir / "bgp_support_bundle.log").read_text()
+    assert len(output) < 1000
+    assert "% Skipped, bgp_support_bundle.log reached 1000 bytes\n" in output
+    assert "output of show bgp nexthop\n" in output
+    bgp = manifest["daemons"]["bgp"]["commands"]
+    assert [entry["skipped"] for entry in bgp] == [False, True, False]
+    assert manifest["max_file_bytes"] == 1000
+
+    # a skipped output is not diffed against, and is rebuilt as the note
+    for max_file_bytes in (1000, None):
+        manifest = bundle.collect(
+            proc_cmds,
+            str(log_dir),
+            [str(vtysh)],
+            delta=True,
+            max_file_bytes=max_file_bytes,
+        )
+    bgp = manifest["daemons"]["bgp"]["commands"]
+    assert [entry["delta"] for entry in bgp] == ["unchanged", "full", "unchanged"]
+    for run in (1, 2):
+        bundle.rebuild(str(log_dir), run)
+    with open(str(log_dir / "bgp_support_bundle.1.full.log")) as fd:
+        assert "% Skipped" in fd.read()
+    with open(str(log_dir / "bgp_support_bundle.2.full.log")) as fd:
+        assert fd.read().count("line of output\n") == 100000 // 15
+
+
+def test_delta(tmp_path):
+    # the routes change between bundles, the neighbors do not
+    state = tmp_path / "state"
+    state.write_text("1")
+    vtysh = tmp_path / "vtysh"
+    vtysh.write_text(
+        "#!/bin/sh\n"
+        'case "$2" in\n'
+        '"show ip route") seq 1 200; echo "route $(cat %s)";;\n'
+        '"show bgp neighbors") seq 1000 1100;;\n'
+        '"show version") cat %s;;\n'
+        "esac\n" % (state, state)
+    )
+    vtysh.chmod(0o755)
+    log_dir = tmp_path / "logs"
+    log_dir.mkdir()
+
+    proc_cmds = {
+        "bgp": ["show bgp neighbors", "show version"],
+        "zebra": ["show ip route"],
+    }
+    expected = {}
+    for run in (1, 2, 3):
+        state.write_text(str(run))
+        manifest = bundle.collect(
+            proc_cmds, str(log_dir), [str(vtysh)], compress="gzip", delta=True
+        )
+        assert manifest["run"] == run
+        deltas = [
+            entry["delta"]
+            for daemon in manifest["daemons"].values()
+            for entry in daemon["commands"]
+        ]
+        # a diff of a one line output is bigger than the output
+        if run == 1:
+            assert deltas == ["full", "full", "full"]
+        else:
+            assert deltas == ["unchanged", "full", "diff"]
+
+        expected[run] = {}
+        for (proc, commands) in proc_cmds.items():
+            expected[run][proc] = [
+                subprocess.check_output([str(vtysh), "-c", cmd]) for cmd in commands
+            ]
+
+    assert delta_size(log_dir, 3, "zebra") < delta_size(log_dir, 1, "zebra") / 5
+    # only the outputs of the last bundle are kept to diff against
+    assert len(os.listdir(str(log_dir / bundle.OBJECTS))) == 3
+
+    out_dir = tmp_path / "rebuilt"
+    out_dir.mkdir()
+    for run in (1, 2, 3):
+        assert bundle.rebuild(str(log_dir), run, str(out_dir)) == [
+            "bgp_support_bundle.%d.full.log" % run,
+            "zebra_support_bundle.%d.full.log" % run,
+        ]
+        for (proc, outputs) in expected[run].items():
+            with open(
+                str(out_dir / ("%s_support_bundle.%d.full.log" % (proc, run))), "rb"
+            ) as fd:
+                lines = fd.read().split(b"\n")
+            # the header of each command, then its output
+            rebuilt = []
+            for line in lines:
+                if line.startswith(b"% "):
+                    rebuilt.append(b"")
+                else:
+                    rebuilt[-1] += line + b"\n"
+            rebuilt[-1] = rebuilt[-1][:-1]
+            assert rebuilt == outputs
+
+
+def test_delta_same_output(tmp_path):
+    # commands with the same output are stored once, even when run together
+    vtysh = tmp_path / "vtysh"
+    vtysh.write_text("#!/bin/sh\n")
+    vtysh.chmod(0o755)
+    log_dir = tmp_path / "logs"
+    log_dir.mkdir()
+
+    proc_cmds = {"zebra": ["show empty %d" % i for i in range(40)]}
+    for run in (1, 2):
+        manifest = bundle.collect(
+            proc_cmds, str(log_dir), [str(vtysh)], jobs=16, delta=True
+        )
+        entries = manifest["daemons"]["zebra"]["commands"]
+        assert len(set(entry["sha256"] for entry in entries)) == 1
+        assert os.listdir(str(log_dir / bundle.OBJECTS)) == [
+            entries[0]["sha256"] + ".gz"
+        ]
+
+
+def delta_size(log_dir, run, proc):
+    with gzip.open(str(log_dir / ("%s_support_bundle.%d.log.gz" % (proc, run)))) as fd:
+        return len(fd.read())
@@ -16,7 +16,7 @@ from lib import topolog
 from lib.micronet import Commander, proc_error
 from lib.micronet_cli import cli
 from lib.micronet_compat import Mininet, cleanup_current, cleanup_previous
-from lib.topogen import diagnose_env, get_topogen
+from lib.topogen import diagnose_env, get_topogen, stop_cached_topology
 from lib.topolog import logger
 from lib.topotest import g_extra_config as topotest_extra_config
 from lib.topotest import json_cmp_result
@@ -70,6 +70,12 @@ def pytest_addoption(parser):
         help="Pause after each test",
     )
 
+    parser.addoption(
+        "--persistent-shells",
+        action="store_true",
+        help="Run router commands in a shell kept running in each router",
+    )
+
     parser.addoption(
         "--pause-on-error",
         action="store_true",
@@ -87,6 +93,12 @@ def pytest_addoption(parser):
     parser.addini("rundir", rundir_help, default="/tmp/topotests")
     parser.addoption("--rundir", metavar="DIR", help=rundir_help)
 
+    parser.addoption(
+        "--reuse-topology",
+        action="store_true",
+        help="Keep JSON topologies running for the next module with the same topology",
+    )
+
     parser.addoption(
         "--shell",
         metavar="ROUTER[,ROUTER...]",
@@ -136,6 +148,12 @@ def pytest_addoption(parser):
         help="Spawn vtysh on all routers on test failure",
     )
 
+    parser.addoption(
+        "--no-vty-sessions",
+        action="store_true",
+        help="Run every vtysh_cmd() with vtysh instead of the daemons' vty sockets",
+    )
+
 
 def check_for_memleaks():
     if not topotest_extra_config["valgrind_memleaks"]:
@@ -322,6 +340,9 @@ def pytest_configure(config):
     topotest_extra_config["vtysh_on_error"] = vtysh_on_error
     assert_feature_windows(vtysh_on_error, "--vtysh-on-error")
 
+    no_vty_sessions = config.getoption("--no-vty-sessions")
+    topotest_extra_config["vty_sessions"] = not no_vty_sessions
+
     pause_on_error = vtysh or shell or config.getoption("--pause-on-error")
     if config.getoption("--no-pause-on-error"):
         pause_on_error = False
@@ -329,6 +350,12 @@ def pytest_configure(config):
     topotest_extra_config["pause_on_error"] = pause_on_error
     assert_feature_windows(pause_on_error, "--pause-on-error")
 
+    reuse_topology = config.getoption("--reuse-topology")
+    topotest_extra_config["reuse_topology"] = reuse_topology
+
+    persistent_shells = config.getoption("--persistent-shells")
+    topotest_extra_config["persistent_shells"] = persistent_shells
+
     pause = config.getoption("--pause")
     topotest_extra_config["pause"] = pause
     assert_feature_windows(pause, "--pause")
@@ -353,6 +380,7 @@ def setup_session_auto():
     if not is_worker:
         cleanup_previous()
     yield
+    stop_cached_topology()
     if not is_worker:
         cleanup_current()
     logger.debug("After the run (is_worker: %s)", is_worker)
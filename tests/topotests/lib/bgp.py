@@ -1226,15 +1226,15 @@ def verify_bgp_convergence(tgen, topo=None, dut=None, expected=True):
     result = False
     logger.debug("Entering lib API: {}".format(sys._getframe().f_code.co_name))
     tgen = get_topogen()
-    for router, rnode in tgen.routers().items():
-        if "bgp" not in topo["routers"][router]:
-            continue
-
-        if dut is not None and dut != router:
-            continue
-
+    routers = [
+        router
+        for router in tgen.routers()
+        if "bgp" in topo["routers"][router] and (dut is None or dut == router)
+    ]
+    show_bgp_all = tgen.vtysh_all("show bgp vrf all summary json", routers=routers)
+    for router in routers:
         logger.info("Verifying BGP Convergence on router %s:", router)
-        show_bgp_json = run_frr_cmd(rnode, "show bgp vrf all summary json", isjson=True)
+        show_bgp_json = show_bgp_all[router]
         # Verifying output dictionary show_bgp_json is empty or not
         if not bool(show_bgp_json):
             errormsg = "BGP is not running"
@@ -43,7 +43,7 @@ except ImportError:
 from lib.micronet import comm_error
 from lib.topogen import TopoRouter, get_topogen
 from lib.topolog import get_logger, logger
-from lib.topotest import frr_unicode, interface_set_status, version_cmp
+from lib.topotest import Waiter, frr_unicode, interface_set_status, version_cmp
 
 FRRCFG_FILE = "frr_json.conf"
 FRRCFG_BKUP_FILE = "frr_json_initial.conf"
@@ -931,7 +931,10 @@ def generate_support_bundle():
     """
     API to generate support bundle on any verification ste failure.
     it runs a python utility, /usr/lib/frr/generate_support_bundle.py,
-    which basically runs defined CLIs and dumps the data to specified location
+    which basically runs defined CLIs and dumps the data to specified location.
+    Bundles collected again for the same test only hold what changed since
+    the previous one (--delta), use "generate_support_bundle.py --rebuild N"
+    to get the full output of bundle N.
     """
 
     tgen = get_topogen()
@@ -947,6 +950,7 @@ def generate_support_bundle():
         gen_sup_cmd = [
             "/usr/lib/frr/generate_support_bundle.py",
             "--log-dir=" + dst_bundle,
+            "--delta",
         ]
         bundle_procs[rname] = tgen.net[rname].popen(gen_sup_cmd, stdin=None)
 
@@ -972,6 +976,22 @@ def start_topology(tgen, daemon=None):
     * `tgen`  : topogen object
     """
 
+    if tgen.reused:
+        # The routers are running, only start the daemons the previous test
+        # module did not need
+        started = set(tgen.started_daemons or [])
+        missing = sorted(set(daemon or []) - started)
+        for rname, router in tgen.routers().items():
+            for dname in missing:
+                rd = [k for k, v in TopoRouter.RD.items() if v == dname][0]
+                conf = "{}/{}/{}.conf".format(tgen.logdir, rname, dname)
+                router.load_config(rd, conf)
+                router.startDaemons([dname])
+        tgen.started_daemons = sorted(started.union(missing))
+        return
+
+    tgen.started_daemons = daemon
+
     # Starting topology
     tgen.start_topology()
 
@@ -1891,6 +1911,9 @@ def retry(retry_timeout, initial_wait=0, expected=True, diag_pct=0.75):
                   important diagnostic tool, and normally should not be disabled. Calls to wrapped
                   functions though, can override the `diag_pct` value to make it larger in case more
                   diagnostic retrying is appropriate.
+
+    The delay between retries starts at 50ms and doubles up to 2s. Calls to wrapped functions
+    can pass `retry_events`, a list of `lib.topotest.WaitEvent`, to retry as soon as one fires.
     """
 
     def _retry(func):
@@ -1900,13 +1923,15 @@ def retry(retry_timeout, initial_wait=0, expected=True, diag_pct=0.75):
             # longer retry timeout value.
             saved_failure = None
 
-            retry_sleep = 2
-
             # Allow the wrapped function's args to override the fixtures
             _retry_timeout = kwargs.pop("retry_timeout", retry_timeout)
             _expected = kwargs.pop("expected", expected)
             _initial_wait = kwargs.pop("initial_wait", initial_wait)
             _diag_pct = kwargs.pop("diag_pct", diag_pct)
+            _retry_events = kwargs.pop("retry_events", None)
+
+            # Sleep 50ms after the first failure, doubling up to 2s
+            waiter = Waiter(2, events=_retry_events)
 
             start_time = datetime.now()
             retry_until = datetime.now() + timedelta(
@@ -1974,17 +1999,17 @@ def retry(retry_timeout, initial_wait=0, expected=True, diag_pct=0.75):
 
                 if saved_failure:
                     logger.info(
-                        "RETRY DIAG: [failure] Sleeping %ds until next retry with %.1f retry time left - too see if timeout was too short",
-                        retry_sleep,
+                        "RETRY DIAG: [failure] Sleeping %.2fs until next retry with %.1f retry time left - too see if timeout was too short",
+                        waiter.delay,
                         seconds_left,
                     )
                 else:
                     logger.info(
-                        "Sleeping %ds until next retry with %.1f retry time left",
-                        retry_sleep,
+                        "Sleeping %.2fs until next retry with %.1f retry time left",
+                        waiter.delay,
                         seconds_left,
                     )
-                sleep(retry_sleep)
+                waiter.wait()
 
         func_retry._original = func
         return func_retry
@@ -3293,6 +3318,8 @@ def verify_rib(
     logger.debug("Entering lib API: {}".format(sys._getframe().f_code.co_name))
 
     router_list = tgen.routers()
+    # The same command is checked for every route of input_dict, run it once
+    rib_routes = {}
     additional_nexthops_in_required_nhs = []
     found_hops = []
     for routerInput in input_dict.keys():
@@ -3332,7 +3359,9 @@ def verify_rib(
 
                     cmd = "{} json".format(cmd)
 
-                    rib_routes_json = run_frr_cmd(rnode, cmd, isjson=True)
+                    if cmd not in rib_routes:
+                        rib_routes[cmd] = run_frr_cmd(rnode, cmd, isjson=True)
+                    rib_routes_json = rib_routes[cmd]
 
                     # Verifying output dictionary rib_routes_json is not empty
                     if bool(rib_routes_json) is False:
@@ -3561,7 +3590,9 @@ def verify_rib(
                     else:
                         cmd = "{} json".format(command)
 
-                rib_routes_json = run_frr_cmd(rnode, cmd, isjson=True)
+                if cmd not in rib_routes:
+                    rib_routes[cmd] = run_frr_cmd(rnode, cmd, isjson=True)
+                rib_routes_json = rib_routes[cmd]
 
                 # Verifying output dictionary rib_routes_json is not empty
                 if bool(rib_routes_json) is False:
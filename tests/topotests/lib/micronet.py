@@ -22,12 +22,15 @@ import datetime
 import logging
 import os
 import re
+import select
 import shlex
 import subprocess
 import sys
 import tempfile
+import threading
 import time as time_mod
 import traceback
+import uuid
 
 root_hostname = subprocess.check_output("hostname")
 
@@ -103,6 +106,13 @@ class Commander(object):  # pylint: disable=R0205
         self.pre_cmd = []
         self.pre_cmd_str = ""
 
+        # See _shell_cmd_status()
+        self.persistent_shell = False
+        self.shell = None
+        self.shell_env = None
+        self.shell_lock = threading.Lock()
+        self.shell_token = "__micronet_{}__".format(uuid.uuid4().hex).encode()
+
         if not logger:
             self.logger = logging.getLogger(__name__ + ".commander." + name)
         else:
@@ -224,8 +234,86 @@ class Commander(object):  # pylint: disable=R0205
         p, _ = self._popen("popen", cmd, **kwargs)
         return p
 
+    def _start_shell(self):
+        self.shell, _ = self._popen(
+            "shell",
+            ["/bin/bash", "--noprofile", "--norc"],
+            stdin=subprocess.PIPE,
+            encoding=None,
+        )
+        self.shell_env = dict(os.environ)
+
+    def _stop_shell(self):
+        if self.shell is not None:
+            self.shell.stdin.close()
+            self.shell.kill()
+            self.shell.wait()
+            self.shell = None
+
+    def _shell_cmd_status(self, cmd, joined):
+        """Run `cmd` in the persistent shell of this commander.
+
+        The command is run in a subshell, so that it cannot change the state of the
+        shell, and is followed by a token on stdout and stderr telling where its
+        output ends. Returns None if the shell is busy or fails, the command must
+        then be run in a new process.
+        """
+        if not self.shell_lock.acquire(False):
+            return None
+        try:
+            if self.shell is not None and (
+                self.shell.poll() is not None or self.shell_env != os.environ
+            ):
+                self._stop_shell()
+            if self.shell is None:
+                self._start_shell()
+
+            script = "( cd {} || exit 1; eval {}\n) </dev/null{}\n".format(
+                shell_quote(self.cwd), shell_quote(cmd), " 2>&1" if joined else ""
+            )
+            script += "printf '%s %d\\n' {0} $?; printf '%s\\n' {0} >&2\n".format(
+                self.shell_token.decode()
+            )
+            try:
+                self.shell.stdin.write(script.encode("utf-8"))
+                self.shell.stdin.flush()
+            except (IOError, OSError):
+                self._stop_shell()
+                return None
+
+            bufs = {self.shell.stdout.fileno(): b"", self.shell.stderr.fileno(): b""}
+            pending = list(bufs)
+            while pending:
+                ready, _, _ = select.select(pending, [], [])
+                for fd in ready:
+                    data = os.read(fd, 65536)
+                    if not data:
+                        # The shell died while running the command
+                        self._stop_shell()
+                        return None
+                    bufs[fd] += data
+                    if bufs[fd].endswith(b"\n") and self.shell_token in bufs[fd]:
+                        pending.remove(fd)
+
+            token = self.shell_token
+            stdout, status = bufs[self.shell.stdout.fileno()].rsplit(token, 1)
+            stderr = bufs[self.shell.stderr.fileno()].rsplit(token, 1)[0]
+            return (
+                int(status),
+                stdout.decode("utf-8", "replace"),
+                stderr.decode("utf-8", "replace"),
+            )
+        finally:
+            self.shell_lock.release()
+
     def cmd_status(self, cmd, raises=False, warn=True, stdin=None, **kwargs):
-        """Execute a command."""
+        """Execute a command.
+
+        With `persistent_shell` set, commands that do not need their own process are
+        run in a shell kept running in the namespace instead of a new `nsenter`.
+        Commands with `stdin`, popen-style keyword arguments or run in the
+        background always get a new process.
+        """
 
         # We are not a shell like mininet, so we need to intercept this
         chdir = False
@@ -246,15 +334,37 @@ class Commander(object):  # pylint: disable=R0205
             # If we are going to run under bash then we don't need shell=True!
             cmds = ["/bin/bash", "-c", cmd]
 
-        pinput = None
+        result = None
+        joined = kwargs == {"stderr": subprocess.STDOUT}
+        if (
+            self.persistent_shell
+            and stdin is None
+            and not chdir
+            and (not kwargs or joined)
+        ):
+            if is_string(cmd):
+                shell_cmd = cmd
+            else:
+                shell_cmd = " ".join(shell_quote(str(x)) for x in cmd)
+            # A lone "&" puts a command in the background, which would keep the
+            # output of the shell open
+            if not re.search(r"(?<![&>|])&(?![&>])", shell_cmd):
+                result = self._shell_cmd_status(shell_cmd, joined)
+
+        if result is not None:
+            p = None
+            rc, stdout, stderr = result
+            actual_cmd = self.pre_cmd_str + shell_cmd
+        else:
+            pinput = None
 
-        if is_string(stdin) or isinstance(stdin, bytes):
-            pinput = stdin
-            stdin = subprocess.PIPE
+            if is_string(stdin) or isinstance(stdin, bytes):
+                pinput = stdin
+                stdin = subprocess.PIPE
 
-        p, actual_cmd = self._popen("cmd_status", cmds, stdin=stdin, **kwargs)
-        stdout, stderr = p.communicate(input=pinput)
-        rc = p.wait()
+            p, actual_cmd = self._popen("cmd_status", cmds, stdin=stdin, **kwargs)
+            stdout, stderr = p.communicate(input=pinput)
+            rc = p.wait()
 
         # For debugging purposes.
         self.last = (rc, actual_cmd, cmd, stdout, stderr)
@@ -262,7 +372,11 @@ class Commander(object):  # pylint: disable=R0205
         if rc:
             if warn:
                 self.logger.warning(
-                    "%s: proc failed: %s:", self, proc_error(p, stdout, stderr)
+                    "%s: proc failed: %s:",
+                    self,
+                    proc_error(p, stdout, stderr)
+                    if p is not None
+                    else cmd_error(rc, stdout, stderr),
                 )
             if raises:
                 # error = Exception("stderr: {}".format(stderr))
@@ -414,7 +528,7 @@ class Commander(object):  # pylint: disable=R0205
         return pane_info
 
     def delete(self):
-        pass
+        self._stop_shell()
 
 
 class LinuxNamespace(Commander):
@@ -438,6 +552,7 @@ class LinuxNamespace(Commander):
         set_hostname=True,
         private_mounts=None,
         logger=None,
+        persistent_shell=False,
     ):
         """
         Create a new linux namespace.
@@ -458,6 +573,8 @@ class LinuxNamespace(Commander):
                 tmpfs is mounted on the internal path. Any paths specified are first
                 passed to `mkdir -p`.
             logger: Passed to superclass.
+            persistent_shell: Run commands in a shell kept running in the namespace,
+                see `Commander.cmd_status()`.
         """
         super(LinuxNamespace, self).__init__(name, logger)
 
@@ -582,6 +699,8 @@ class LinuxNamespace(Commander):
         # Doing this here messes up all_protocols ipv6 check
         self.cmd_raises("ip link set lo up")
 
+        self.persistent_shell = persistent_shell
+
     def __str__(self):
         return "LinuxNamespace({})".format(self.name)
 
@@ -656,12 +775,14 @@ class LinuxNamespace(Commander):
         # Set pre-command based on our namespace proc
         self.logger.debug("%s: new CWD %s", self, cwd)
         self.set_pre_cmd(self.base_pre_cmd + ["--wd=" + cwd])
+        self.cwd = cwd
 
     def register_interface(self, ifname):
         if ifname not in self.intfs:
             self.intfs.append(ifname)
 
     def delete(self):
+        self._stop_shell()
         if self.p and self.p.poll() is None:
             if sys.version_info[0] >= 3:
                 try:
@@ -787,6 +908,11 @@ class Micronet(LinuxNamespace):  # pylint: disable=R0205
         self.macs = {}
         self.rmacs = {}
 
+        # Commands queued by add_link() for commit_links()
+        self.link_batch = []
+        self.host_batches = {}
+        self.pending_macs = []
+
         super(Micronet, self).__init__("micronet", mount=True, net=True, uts=True)
 
         self.logger.debug("%s: Creating", self)
@@ -810,7 +936,10 @@ class Micronet(LinuxNamespace):  # pylint: disable=R0205
         self.hosts[name].tmpfs_mount("/run/netns")
 
     def add_link(self, name1, name2, if1, if2):
-        """Add a link between switch and host to micronet."""
+        """Add a link between switch and host to micronet.
+
+        The link is only queued, commit_links() creates all queued links.
+        """
         isp2p = False
         if name1 in self.switches:
             assert name2 in self.hosts
@@ -828,46 +957,77 @@ class Micronet(LinuxNamespace):  # pylint: disable=R0205
         self.logger.debug("%s: add_link %s%s", self, lname, " p2p" if isp2p else "")
         self.links[lname] = (name1, if1, name2, if2)
 
-        # And create the veth now.
+        assert len(if1) <= 16 and len(if2) <= 16  # Make sure fits in IFNAMSIZE
+
+        # Create the veth with each end directly in its namespace, so that
+        # no temporary names or renames are needed
         if isp2p:
             lhost, rhost = self.hosts[name1], self.hosts[name2]
-            lifname = "i1{:x}".format(lhost.pid)
-            rifname = "i2{:x}".format(rhost.pid)
-            self.cmd_raises(
-                "ip link add {} type veth peer name {}".format(lifname, rifname)
+            self.link_batch.append(
+                "link add {} netns {} type veth peer name {} netns {}".format(
+                    if1, lhost.pid, if2, rhost.pid
+                )
             )
-
-            self.cmd_raises("ip link set {} netns {}".format(lifname, lhost.pid))
-            lhost.cmd_raises("ip link set {} name {}".format(lifname, if1))
-            lhost.cmd_raises("ip link set {} up".format(if1))
+            self.host_batches.setdefault(name1, []).append("link set {} up".format(if1))
             lhost.register_interface(if1)
-
-            self.cmd_raises("ip link set {} netns {}".format(rifname, rhost.pid))
-            rhost.cmd_raises("ip link set {} name {}".format(rifname, if2))
-            rhost.cmd_raises("ip link set {} up".format(if2))
-            rhost.register_interface(if2)
         else:
             switch = self.switches[name1]
-            host = self.hosts[name2]
-
-            assert len(if1) <= 16 and len(if2) <= 16  # Make sure fits in IFNAMSIZE
+            rhost = self.hosts[name2]
 
-            self.logger.debug("%s: Creating veth pair for link %s", self, lname)
-            self.cmd_raises(
-                "ip link add {} type veth peer name {} netns {}".format(
-                    if1, if2, host.pid
+            self.link_batch.append(
+                "link add {} netns {} type veth peer name {} netns {}".format(
+                    if1, switch.pid, if2, rhost.pid
                 )
             )
-            self.cmd_raises("ip link set {} netns {}".format(if1, switch.pid))
+            self.link_batch.append("link set {} master {}".format(if1, switch.brid))
+            self.link_batch.append("link set {} up".format(if1))
             switch.register_interface(if1)
-            host.register_interface(if2)
-            self.cmd_raises("ip link set {} master {}".format(if1, switch.brid))
-            self.cmd_raises("ip link set {} up".format(if1))
-            host.cmd_raises("ip link set {} up".format(if2))
 
-        # Cache the MAC values, and reverse mapping
-        self.get_mac(name1, if1)
-        self.get_mac(name2, if2)
+        self.host_batches.setdefault(name2, []).append("link set {} up".format(if2))
+        rhost.register_interface(if2)
+
+        # Cache the MAC values, and reverse mapping, once created
+        self.pending_macs.append((name1, if1))
+        self.pending_macs.append((name2, if2))
+
+    def commit_links(self):
+        """Create the links queued by add_link().
+
+        The commands are run with one "ip -batch" in the micronet namespace and
+        one in each host namespace, then the MACs are read with one dump per
+        namespace.
+        """
+        if not self.link_batch:
+            return
+
+        self.logger.debug("%s: Creating %d links", self, len(self.pending_macs) // 2)
+        self.cmd_raises("ip -batch -", stdin="\n".join(self.link_batch) + "\n")
+        self.link_batch = []
+
+        for name, batch in self.host_batches.items():
+            self.hosts[name].cmd_raises("ip -batch -", stdin="\n".join(batch) + "\n")
+        self.host_batches = {}
+
+        # Switches are all in the micronet namespace
+        dumps = {}
+        for name, ifname in self.pending_macs:
+            dev = self.hosts[name] if name in self.hosts else self.switches[name]
+            if dev.pid not in dumps:
+                _, output, _ = dev.cmd_status("ip -o link show")
+                dumps[dev.pid] = dict(
+                    (m.group(1), m.group(2))
+                    for m in re.finditer(
+                        r"^\d+: ([^:@\s]+)[^\n]*link/(?:loopback|ether) "
+                        r"([0-9a-fA-F:]+)",
+                        output,
+                        re.M,
+                    )
+                )
+            mac = dumps[dev.pid].get(ifname)
+            if mac is not None:
+                self.macs[(name, ifname)] = mac
+                self.rmacs[mac] = (name, ifname)
+        self.pending_macs = []
 
     def add_switch(self, name):
         """Add a switch to micronet."""
@@ -881,6 +1041,9 @@ class Micronet(LinuxNamespace):  # pylint: disable=R0205
         else:
             dev = self.switches[name]
 
+        if (name, ifname) not in self.macs:
+            self.commit_links()
+
         if (name, ifname) not in self.macs:
             _, output, _ = dev.cmd_status("ip -o link show " + ifname)
             m = re.match(".*link/(loopback|ether) ([0-9a-fA-F:]+) .*", output)
@@ -895,6 +1058,12 @@ class Micronet(LinuxNamespace):  # pylint: disable=R0205
 
         self.logger.debug("%s: Deleting.", self)
 
+        # Create the links not committed yet, so all links can be deleted
+        try:
+            self.commit_links()
+        except Exception as error:
+            self.logger.error("%s: error while creating links: %s", self, error)
+
         for lname, (_, _, rname, rif) in self.links.items():
             host = self.hosts[rname]
 
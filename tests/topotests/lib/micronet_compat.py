@@ -142,7 +142,12 @@ class Node(LinuxNamespace):
 
         logger = kwargs.get("logger")
 
-        super(Node, self).__init__(name, logger=logger, private_mounts=private_mounts)
+        super(Node, self).__init__(
+            name,
+            logger=logger,
+            private_mounts=private_mounts,
+            persistent_shell=kwargs.get("persistent_shell", False),
+        )
 
     def cmd(self, cmd, **kwargs):
         """Execute a command, joins stdout, stderr, ignores exit status."""
@@ -208,6 +213,8 @@ class Mininet(Micronet):
         This function can be called multiple times if routers are added to the topology
         later.
         """
+        self.commit_links()
+
         if not self.hosts:
             return
 
@@ -249,7 +256,8 @@ class Mininet(Micronet):
 
     def start(self):
         """Start the micronet topology."""
-        self.logger.debug("%s: Starting (no-op).", self)
+        self.logger.debug("%s: Starting.", self)
+        self.commit_links()
 
     def stop(self):
         """Stop the mininet topology (deletes)."""
@@ -686,18 +686,17 @@ def verify_ospf_neighbor(
     if topo is None:
         topo = tgen.json_topo
 
-    if input_dict:
-        for router, rnode in tgen.routers().items():
-            if "ospf" not in topo["routers"][router]:
-                continue
-
-            if dut is not None and dut != router:
-                continue
+    routers = [
+        router
+        for router in tgen.routers()
+        if "ospf" in topo["routers"][router] and (dut is None or dut == router)
+    ]
+    show_ospf_all = tgen.vtysh_all("show ip ospf neighbor all json", routers=routers)
 
+    if input_dict:
+        for router in routers:
             logger.info("Verifying OSPF neighborship on router %s:", router)
-            show_ospf_json = run_frr_cmd(
-                rnode, "show ip ospf neighbor all json", isjson=True
-            )
+            show_ospf_json = show_ospf_all[router]
 
             # Verifying output dictionary show_ospf_json is empty or not
             if not bool(show_ospf_json):
@@ -763,17 +762,9 @@ def verify_ospf_neighbor(
                         return errormsg
                 continue
     else:
-        for router, rnode in tgen.routers().items():
-            if "ospf" not in topo["routers"][router]:
-                continue
-
-            if dut is not None and dut != router:
-                continue
-
+        for router in routers:
             logger.info("Verifying OSPF neighborship on router %s:", router)
-            show_ospf_json = run_frr_cmd(
-                rnode, "show ip ospf neighbor  all json", isjson=True
-            )
+            show_ospf_json = show_ospf_all[router]
             # Verifying output dictionary show_ospf_json is empty or not
             if not bool(show_ospf_json):
                 errormsg = "OSPF is not running"
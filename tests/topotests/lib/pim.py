@@ -502,14 +502,13 @@ def verify_pim_neighbors(tgen, topo, dut=None, iface=None, nbr_ip=None, expected
 
     logger.debug("Entering lib API: {}".format(sys._getframe().f_code.co_name))
 
-    for router in tgen.routers():
-        if dut is not None and dut != router:
-            continue
+    routers = [router for router in tgen.routers() if dut is None or dut == router]
+    show_ip_pim_neighbor_all = tgen.vtysh_all(
+        "show ip pim neighbor json", routers=routers
+    )
 
-        rnode = tgen.routers()[router]
-        show_ip_pim_neighbor_json = rnode.vtysh_cmd(
-            "show ip pim neighbor json", isjson=True
-        )
+    for router in routers:
+        show_ip_pim_neighbor_json = show_ip_pim_neighbor_all[router]
 
         for destLink, data in topo["routers"][router]["links"].items():
             if iface is not None and iface != data["interface"]:
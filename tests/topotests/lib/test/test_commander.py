@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+#
+# test_commander.py
+# Tests for library class: Commander.
+#
+# Permission to use, copy, modify, and/or distribute this software
+# for any purpose with or without fee is hereby granted, provided
+# that the above copyright notice and this permission notice appear
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHORS DISCLAIM ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY
+# DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
+# OF THIS SOFTWARE.
+#
+
+"""
+Tests for the persistent shell of `Commander`.
+"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Save the Current Working Directory to find lib files.
+CWD = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CWD, "../../"))
+
+# pylint: disable=C0413
+from lib.micronet import Commander
+
+
+def in_shell(cmdr):
+    "Whether the last command ran in the persistent shell."
+    # New processes are run from an argument list
+    return isinstance(cmdr.last[1], str)
+
+
+@pytest.fixture
+def commander():
+    cmdr = Commander("test")
+    cmdr.persistent_shell = True
+    yield cmdr
+    cmdr.delete()
+
+
+def test_shell_output(commander):
+    "Test output and exit codes match the ones of new processes."
+
+    assert commander.cmd_status("echo one; echo two >&2; exit 3") == (
+        3,
+        "one\n",
+        "two\n",
+    )
+    shell = commander.shell
+    assert shell is not None and in_shell(commander)
+
+    # No trailing newline, joined stderr, list commands, quotes
+    assert commander.cmd_status("printf abc") == (0, "abc", "")
+    assert commander.cmd_legacy("echo out; echo err >&2") == "out\nerr\n"
+    assert commander.cmd_raises(["echo", "a b", "'c'"]) == "a b 'c'\n"
+    with pytest.raises(subprocess.CalledProcessError):
+        commander.cmd_raises("false")
+
+    # Syntax errors and state changes only affect the command
+    assert commander.cmd_status("echo 'unbalanced", warn=False)[0] != 0
+    commander.cmd_status("cd /; FOO=bar; set -e; exit 0")
+    assert commander.cmd_raises("pwd; echo x$FOO") == commander.cwd + "\nx\n"
+    assert commander.shell is shell and in_shell(commander)
+
+
+def test_shell_fallback(commander):
+    "Test commands needing their own process do not use the shell."
+
+    commander.cmd_raises("true")
+    shell = commander.shell
+
+    # Input, background and popen arguments
+    assert commander.cmd_raises("cat", stdin="input") == "input"
+    assert not in_shell(commander)
+    assert commander.cmd_raises("sleep 0 & wait") == ""
+    assert not in_shell(commander)
+    assert commander.cmd_raises("echo x", stderr=subprocess.DEVNULL) == "x\n"
+    assert not in_shell(commander)
+
+    # A busy shell
+    commander.shell_lock.acquire()
+    try:
+        assert commander.cmd_raises("echo busy") == "busy\n"
+        assert not in_shell(commander)
+    finally:
+        commander.shell_lock.release()
+
+    # The environment changed, or the shell died
+    os.environ["COMMANDER_TEST"] = "1"
+    try:
+        assert commander.cmd_raises("echo $COMMANDER_TEST") == "1\n"
+    finally:
+        del os.environ["COMMANDER_TEST"]
+    assert commander.shell is not shell
+    commander.shell.kill()
+    commander.shell.wait()
+    assert commander.cmd_raises("echo again") == "again\n"
+    assert in_shell(commander)
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main())
@@ -27,7 +27,9 @@ Tests for the `run_and_expect(_type)()` functions.
 """
 
 import os
+import subprocess
 import sys
+import time
 import pytest
 
 # Save the Current Working Directory to find lib files.
@@ -35,7 +37,7 @@ CWD = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(CWD, "../../"))
 
 # pylint: disable=C0413
-from lib.topotest import run_and_expect_type
+from lib.topotest import WaitEvent, Waiter, run_and_expect, run_and_expect_type
 
 
 def test_run_and_expect_type():
@@ -75,5 +77,63 @@ def test_run_and_expect_type():
     assert value is True
 
 
+def test_run_and_expect_backoff():
+    "Test that `run_and_expect` polls quickly at first and keeps its deadline."
+    calls = []
+
+    def third_call():
+        "Test function that returns `True` on its third call."
+        calls.append(time.time())
+        return len(calls) >= 3
+
+    start = time.time()
+    success, value = run_and_expect(third_call, True, count=2, wait=5)
+    assert success is True
+    assert len(calls) == 3
+    assert time.time() - start < 1
+
+    # The minimum tries are made, then polling goes on until count * wait.
+    del calls[:]
+    start = time.time()
+    success, value = run_and_expect(lambda: calls.append(1), True, count=2, wait=0.2)
+    assert success is False
+    assert len(calls) > 2
+    assert time.time() - start >= 0.4
+
+
+def test_run_and_expect_events():
+    "Test that a `WaitEvent` ends the wait between tries."
+    proc = subprocess.Popen(
+        ["sh", "-c", "echo ignored; sleep 0.3; echo route added; sleep 10"],
+        stdout=subprocess.PIPE,
+    )
+    with WaitEvent(proc, "route") as event:
+        state = {"tries": 0, "ready": time.time() + 0.3}
+
+        def after_event():
+            "Test function that returns `True` after the event."
+            state["tries"] += 1
+            return time.time() >= state["ready"]
+
+        start = time.time()
+        success, _ = run_and_expect(after_event, True, count=2, wait=5, events=[event])
+        assert success is True
+        assert time.time() - start < 2
+        assert state["tries"] <= 8
+
+
+def test_waiter_event_eof():
+    "Test that an event whose process exited does not end the waits."
+    proc = subprocess.Popen(["true"], stdout=subprocess.PIPE)
+    proc.wait()
+    with WaitEvent(proc) as event:
+        waiter = Waiter(0.2, initial=0.2, events=[event])
+        start = time.time()
+        assert waiter.wait() is False
+        assert time.time() - start >= 0.2
+        assert event.eof is True
+        assert waiter.events == []
+
+
 if __name__ == "__main__":
     sys.exit(pytest.main())
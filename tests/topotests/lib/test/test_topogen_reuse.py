@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+#
+# test_topogen_reuse.py
+# Tests for the --reuse-topology decisions of Topogen.
+#
+# Permission to use, copy, modify, and/or distribute this software
+# for any purpose with or without fee is hereby granted, provided
+# that the above copyright notice and this permission notice appear
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHORS DISCLAIM ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY
+# DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
+# OF THIS SOFTWARE.
+#
+
+"""
+Tests for the choice to keep, take over or stop a topology with
+--reuse-topology, without building one.
+"""
+
+import json
+import os
+import sys
+import pytest
+
+# Save the Current Working Directory to find lib files.
+CWD = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CWD, "../../"))
+
+# pylint: disable=C0413
+from lib import topogen
+
+
+class FakeTopogen(topogen.Topogen):
+    "A Topogen whose routers and memory leak check are set by the test"
+
+    def __init__(self, modname, topofile, running=True, memleak=False):
+        # pylint: disable=W0231
+        self.modname = modname
+        self.running = running
+        self.memleak = memleak
+        self.stopped = False
+        self.reuse_key = None
+        self.cached = self._reusable_topology(str(topofile))
+
+    def routers_running(self):
+        return self.running
+
+    def is_memleak_enabled(self):
+        return self.memleak
+
+    def _stop_topology(self):
+        self.stopped = True
+
+
+class FakeGear(object):
+    def __init__(self, name, logdir):
+        self.name = name
+        self.logdir = logdir
+        self.tgen = None
+
+
+@pytest.fixture
+def reuse(monkeypatch):
+    monkeypatch.setitem(topogen.g_extra_config, "reuse_topology", True)
+    monkeypatch.setattr(topogen, "cached_topology", None)
+
+
+def write_topology(path, routers):
+    path.write_text(json.dumps({"routers": {name: {} for name in routers}}))
+    return path
+
+
+def test_keep_and_take_over(tmp_path, reuse):
+    topo = write_topology(tmp_path / "a.json", ["r1", "r2"])
+    first = FakeTopogen("first", topo)
+    assert first.cached is None
+    first.stop_topology()
+    assert not first.stopped
+    assert topogen.cached_topology == (first.reuse_key, first)
+
+    # the same topology, even written differently
+    same = tmp_path / "b.json"
+    same.write_text(json.dumps(json.loads(topo.read_text()), indent=4))
+    second = FakeTopogen("second", same)
+    assert second.cached is first
+    assert topogen.cached_topology is None
+    assert not first.stopped
+
+    # the logs of the routers are linked in the log directory of the module
+    first.logdir = tmp_path / "first"
+    (first.logdir / "r1").mkdir(parents=True)
+    (first.logdir / "r1.log").write_text("")
+    first.gears = {"r1": FakeGear("r1", str(first.logdir))}
+    for name in ("net", "routern", "switchn", "peern"):
+        setattr(first, name, None)
+    second.logdir = str(tmp_path / "second")
+    os.mkdir(second.logdir)
+    second._take_over_topology(first)
+    assert second.reused and second.gears["r1"].tgen is second
+    for name in ("r1", "r1.log"):
+        link = os.path.join(second.logdir, name)
+        assert os.readlink(link) == str(first.logdir / name)
+
+
+def test_key_mismatch(tmp_path, reuse):
+    first = FakeTopogen("first", write_topology(tmp_path / "a.json", ["r1"]))
+    first.stop_topology()
+    second = FakeTopogen("second", write_topology(tmp_path / "b.json", ["r2"]))
+    assert second.cached is None
+    assert first.stopped
+    assert topogen.cached_topology is None
+
+
+def test_router_not_running(tmp_path, reuse):
+    topo = write_topology(tmp_path / "a.json", ["r1"])
+
+    # a topology whose routers stopped is not kept
+    first = FakeTopogen("first", topo, running=False)
+    first.stop_topology()
+    assert first.stopped
+    assert topogen.cached_topology is None
+
+    # nor taken over if they stopped after it was kept
+    first = FakeTopogen("first", topo)
+    first.stop_topology()
+    first.running = False
+    second = FakeTopogen("second", topo)
+    assert second.cached is None
+    assert first.stopped
+
+
+def test_memleak_enabled(tmp_path, reuse, monkeypatch):
+    topo = write_topology(tmp_path / "a.json", ["r1"])
+    first = FakeTopogen("first", topo, memleak=True)
+    first.stop_topology()
+    assert first.stopped
+    assert topogen.cached_topology is None
+
+    monkeypatch.setitem(topogen.g_extra_config, "valgrind_memleaks", True)
+    first = FakeTopogen("first", topo)
+    first.stop_topology()
+    assert first.stopped
+    assert topogen.cached_topology is None
+
+
+def test_reuse_disabled(tmp_path, reuse, monkeypatch):
+    topo = write_topology(tmp_path / "a.json", ["r1"])
+    first = FakeTopogen("first", topo)
+    first.stop_topology()
+
+    # the kept topology is stopped by the next module not reusing it
+    monkeypatch.setitem(topogen.g_extra_config, "reuse_topology", False)
+    second = FakeTopogen("second", topo)
+    assert second.cached is None
+    assert first.stopped
+    second.stop_topology()
+    assert second.stopped
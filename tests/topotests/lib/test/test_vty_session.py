@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+#
+# test_vty_session.py
+# Tests for library class: VtySession.
+#
+# Permission to use, copy, modify, and/or distribute this software
+# for any purpose with or without fee is hereby granted, provided
+# that the above copyright notice and this permission notice appear
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHORS DISCLAIM ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY
+# DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
+# OF THIS SOFTWARE.
+#
+
+"""
+Tests for the `VtySession` class, against fake daemons.
+"""
+
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+# Save the Current Working Directory to find lib files.
+CWD = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CWD, "../../"))
+
+# pylint: disable=C0413
+from lib.topotest import VtySession
+
+
+class FakeDaemon(object):
+    "A daemon vty socket answering the commands in `commands`."
+
+    def __init__(self, sockdir, name, commands):
+        self.path = os.path.join(sockdir, "{}.vty".format(name))
+        self.commands = commands
+        self.received = []
+        self.conns = []
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(4)
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                (conn, _) = self.server.accept()
+            except OSError:
+                return
+            self.conns.append(conn)
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn):
+        buf = b""
+        while True:
+            try:
+                data = conn.recv(4096)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            while b"\0" in buf:
+                (command, buf) = buf.split(b"\0", 1)
+                command = command.decode("utf-8")
+                self.received.append(command)
+                if command == "enable":
+                    (status, output) = (0, "")
+                else:
+                    (status, output) = self.commands.get(
+                        command, (2, "% Unknown command: {}\n".format(command))
+                    )
+                conn.sendall(output.encode("utf-8") + b"\0\0\0" + bytes([status]))
+
+    def stop(self):
+        self.server.close()
+        os.unlink(self.path)
+        for conn in self.conns:
+            conn.shutdown(socket.SHUT_RDWR)
+            conn.close()
+        self.conns = []
+
+
+def test_vty_session(tmpdir):
+    "Test command dispatch, fallback and reconnection."
+
+    sockdir = str(tmpdir)
+    zebra = FakeDaemon(
+        sockdir,
+        "zebra",
+        {
+            "show ip route json": (0, '{"10.0.0.0/24": []}\n'),
+            "show version": (0, "zebra version\n"),
+            "show ip route 1.1.1.1": (1, "% Network not in table\n"),
+        },
+    )
+    bgpd = FakeDaemon(sockdir, "bgpd", {"show version": (0, "bgpd version\n")})
+    session = VtySession(sockdir, timeout=5)
+
+    # Only zebra knows the command, its output is used as is
+    assert session.run("show ip route json") == '{"10.0.0.0/24": []}\n'
+    assert "show ip route json" in bgpd.received
+
+    # Running it again only asks zebra
+    del bgpd.received[:]
+    assert session.run("show ip route json") == '{"10.0.0.0/24": []}\n'
+    assert bgpd.received == []
+
+    # Warnings are output like vtysh does
+    assert session.run("show ip route 1.1.1.1") == "% Network not in table\n"
+
+    # Several daemons or none know the command, or it is not a "show"
+    # command: vtysh has to run it
+    assert session.run("show version") is None
+    assert session.run("show nothing") is None
+    assert session.run("clear ip route") is None
+    assert "clear ip route" not in zebra.received
+
+    # Commands can be sent to one daemon, like with "vtysh -d"
+    assert session.run("show version", daemon="bgpd") == "bgpd version\n"
+    assert session.run("show ip route json", daemon="bgpd") is None
+
+    # A restarted daemon is connected to again
+    zebra.stop()
+    assert session.run("show ip route json") is None
+    zebra = FakeDaemon(sockdir, "zebra", {"show ip route json": (0, "{}\n")})
+    assert session.run("show ip route json") == "{}\n"
+
+    session.close()
+    zebra.stop()
+    bgpd.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main())
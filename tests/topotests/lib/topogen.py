@@ -39,6 +39,7 @@ Basic usage instructions:
 """
 
 import grp
+import hashlib
 import inspect
 import json
 import logging
@@ -49,6 +50,7 @@ import re
 import subprocess
 import sys
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 if sys.version_info[0] > 2:
     import configparser
@@ -70,6 +72,10 @@ CWD = os.path.dirname(os.path.realpath(__file__))
 # all test functions without declaring a test local variable.
 global_tgen = None
 
+# JSON topology kept running by Topogen.stop_topology() with --reuse-topology, as a
+# (key, Topogen) tuple, for the next test module with the same topology.
+cached_topology = None
+
 
 def get_topogen(topo=None):
     """
@@ -88,6 +94,22 @@ def set_topogen(tgen):
     global_tgen = tgen
 
 
+def topology_key(topo):
+    "Returns the key of a JSON topology definition for topology reuse."
+    canonical = json.dumps(topo, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def stop_cached_topology():
+    "Stops the topology kept for reuse, if any."
+    # pylint: disable=W0603
+    global cached_topology
+    if cached_topology is not None:
+        _, tgen = cached_topology
+        cached_topology = None
+        tgen._stop_topology()
+
+
 def is_string(value):
     """Return True if value is a string."""
     try:
@@ -168,6 +190,8 @@ class Topogen(object):
         self.peern = 1
         self.cfg_gen = 0
         self.exabgp_cmd = None
+        self.reuse_key = None
+        self.reused = False
         self._init_topo(topodef)
 
         logger.info("loading topology: {}".format(self.modname))
@@ -204,6 +228,14 @@ class Topogen(object):
         # Load the default topology configurations
         self._load_config()
 
+        # Remove old twisty way of creating sub-classed topology object which has it's
+        # build method invoked which calls Topogen methods which then call Topo methods
+        # to create a topology within the Topo object, which is then used by
+        # Mininet(Micronet) to build the actual topology.
+        assert not inspect.isclass(topodef)
+
+        cached = self._reusable_topology(topodef)
+
         # Create new log directory
         self.logdir = topotest.get_logs_path(g_extra_config["rundir"])
         subprocess.check_call(
@@ -219,11 +251,9 @@ class Topogen(object):
             # Allow anyone, but set the sticky bit to avoid file deletions
             os.chmod(self.logdir, 0o1777)
 
-        # Remove old twisty way of creating sub-classed topology object which has it's
-        # build method invoked which calls Topogen methods which then call Topo methods
-        # to create a topology within the Topo object, which is then used by
-        # Mininet(Micronet) to build the actual topology.
-        assert not inspect.isclass(topodef)
+        if cached is not None:
+            self._take_over_topology(cached)
+            return
 
         self.net = Mininet(controller=None)
 
@@ -248,6 +278,75 @@ class Topogen(object):
             elif topodef:
                 self.add_topology_from_dict(topodef)
 
+    def _reusable_topology(self, topodef):
+        """
+        With --reuse-topology, returns the Topogen of the previous test module if it
+        had the same JSON topology and its routers are still running, so that
+        `_take_over_topology()` takes it over. Any other kept topology is stopped.
+        Returns None if the topology has to be built.
+        """
+        # pylint: disable=W0603
+        global cached_topology
+        if not g_extra_config.get("reuse_topology") or not is_string(topodef):
+            stop_cached_topology()
+            return None
+
+        with open(topodef, "r") as topof:
+            self.json_topo = json.load(topof)
+        self.reuse_key = topology_key(self.json_topo)
+
+        if cached_topology is None:
+            return None
+        key, cached = cached_topology
+        cached_topology = None
+        if key != self.reuse_key or not cached.routers_running():
+            cached._stop_topology()
+            return None
+        return cached
+
+    def _take_over_topology(self, cached):
+        """
+        Take over the routers of `cached`, see `_reusable_topology()`. Their
+        configuration is reset by `build_config_from_json()` instead of being
+        built again. The daemons keep logging to the log directory of the module
+        that started them, their files are linked in the log directory of this one.
+        """
+        logger.info(
+            "loading topology: {} reusing the topology of {}".format(
+                self.modname, cached.modname
+            )
+        )
+        for name in ("net", "gears", "routern", "switchn", "peern"):
+            setattr(self, name, getattr(cached, name))
+        for name in ("cfg_gen", "exabgp_cmd", "started_daemons"):
+            setattr(self, name, getattr(cached, name, None))
+        for gear in self.gears.values():
+            gear.tgen = self
+            for entry in (gear.name, gear.name + ".log"):
+                path = os.path.join(gear.logdir, entry)
+                link = os.path.join(self.logdir, entry)
+                if os.path.exists(path) and not os.path.lexists(link):
+                    os.symlink(path, link)
+        self.reused = True
+
+        # Undo interfaces brought down outside of the configuration
+        for router in self.routers().values():
+            if router.links:
+                router.run(
+                    "for i in {}; do ip link set $i up; done".format(
+                        " ".join(router.links.keys())
+                    )
+                )
+
+    def routers_running(self):
+        "Returns `True` if there are no errors and all routers are running."
+        if self.has_errors():
+            return False
+        for router in self.routers().values():
+            if router.check_router_running() != "":
+                return False
+        return True
+
     def add_topology_from_dict(self, topodef):
 
         keylist = (
@@ -435,6 +534,40 @@ class Topogen(object):
         """
         return self.get_gears(TopoExaBGP)
 
+    def vtysh_all(self, command, isjson=True, routers=None):
+        """
+        Runs `command` with vtysh_cmd() on several routers at the same time and
+        returns a dictionary of the results, keyed by router name.
+
+        * `isjson`: parse the output of the command as JSON
+        * `routers`: names of the routers to run the command on, all routers if
+          None
+
+        Usage:
+        ```py
+        tgen = get_topogen()
+        output = tgen.vtysh_all("show ip ospf neighbor json", routers=["r1", "r2"])
+        for router, neighbors in output.items():
+            # Do stuff
+        ```
+        """
+        router_dict = self.routers()
+        if routers is None:
+            routers = list(router_dict.keys())
+        else:
+            routers = list(routers)
+        if not routers:
+            return {}
+
+        with ThreadPoolExecutor(max_workers=min(len(routers), 32)) as executor:
+            futures = [
+                executor.submit(router_dict[name].vtysh_cmd, command, isjson=isjson)
+                for name in routers
+            ]
+            return dict(
+                (name, future.result()) for name, future in zip(routers, futures)
+            )
+
     def start_topology(self):
         """Starts the topology class."""
         logger.info("starting topology: {}".format(self.modname))
@@ -443,13 +576,24 @@ class Topogen(object):
     def start_router(self, router=None):
         """
         Call the router startRouter method.
-        If no router is specified it is called for all registred routers.
+        If no router is specified it is called for all registred routers, which
+        are started at the same time unless daemons are run under gdb.
         """
         if router is None:
             # pylint: disable=r1704
             # XXX should be hosts?
-            for _, router in self.routers().items():
-                router.start()
+            routers = list(self.routers().values())
+            if g_extra_config.get("gdb_routers") or g_extra_config.get("gdb_daemons"):
+                # One gdb window at a time
+                for router in routers:
+                    router.start()
+                return
+
+            # Each router starts its own daemons in order, zebra first
+            with ThreadPoolExecutor(max_workers=max(min(len(routers), 32), 1)) as ex:
+                futures = [ex.submit(router.start) for router in routers]
+                for future in futures:
+                    future.result()
         else:
             if isinstance(router, str):
                 router = self.gears[router]
@@ -463,7 +607,30 @@ class Topogen(object):
         their oportunity to do a graceful shutdown. stop() is called twice. The
         first is a simple kill with no sleep, the second will sleep if not
         killed and try with a different signal.
+
+        With --reuse-topology, a JSON topology whose routers are all running is
+        kept running for the next test module instead.
         """
+        # pylint: disable=W0603
+        global cached_topology
+        if self._keep_for_reuse():
+            logger.info("keeping topology: {} for reuse".format(self.modname))
+            stop_cached_topology()
+            cached_topology = (self.reuse_key, self)
+            return
+
+        self._stop_topology()
+
+    def _keep_for_reuse(self):
+        "Returns `True` if `stop_topology()` keeps the topology for reuse."
+        return (
+            self.reuse_key is not None
+            and not g_extra_config.get("valgrind_memleaks")
+            and not self.is_memleak_enabled()
+            and self.routers_running()
+        )
+
+    def _stop_topology(self):
         logger.info("stopping topology: {}".format(self.modname))
         errors = ""
         for gear in self.gears.values():
@@ -775,6 +942,8 @@ class TopoRouter(TopoGear):
         with open(os.path.join(self.logdir, self.name + ".pid"), "w") as f:
             f.write(str(self.net.pid) + "\n")
 
+        self._vty_session = None
+
     def __str__(self):
         gear = super(TopoRouter, self).__str__()
         gear += " TopoRouter<>"
@@ -863,6 +1032,8 @@ class TopoRouter(TopoGear):
         * Signal daemons twice, once with SIGTERM, then with SIGKILL.
         """
         self.logger.debug("stopping (no assert)")
+        if self._vty_session is not None:
+            self._vty_session.close()
         return self.net.stopRouter(False)
 
     def startDaemons(self, daemons):
@@ -909,11 +1080,29 @@ class TopoRouter(TopoGear):
         self.logger.debug("Killing daemons using SIGKILL..")
         return self.net.killRouterDaemons(daemons, wait, assertOnError)
 
+    def vty_session(self):
+        """
+        Returns the topotest.VtySession connected to the daemons of this
+        router, or None if it is disabled with --no-vty-sessions.
+        """
+        if not topotest.g_extra_config.get("vty_sessions", True):
+            return None
+        if self._vty_session is None:
+            # /var/run/frr is private to the router, reach it through the
+            # mount namespace of its process
+            sockdir = "/proc/{}/root/var/run/{}".format(self.net.pid, self.routertype)
+            self._vty_session = topotest.VtySession(sockdir)
+        return self._vty_session
+
     def vtysh_cmd(self, command, isjson=False, daemon=None):
         """
         Runs the provided command string in the vty shell and returns a string
         with the response.
 
+        "show" commands are sent to the daemons over the connections of
+        vty_session() when a single daemon implements them, other commands
+        start vtysh.
+
         This function also accepts multiple commands, but this mode does not
         return output for each command. See vtysh_multicmd() for more details.
         """
@@ -921,14 +1110,20 @@ class TopoRouter(TopoGear):
         if command.find("\n") != -1:
             return self.vtysh_multicmd(command, daemon=daemon)
 
-        dparam = ""
-        if daemon is not None:
-            dparam += "-d {}".format(daemon)
+        self.logger.info('vtysh command => "{}"'.format(command))
 
-        vtysh_command = 'vtysh {} -c "{}" 2>/dev/null'.format(dparam, command)
+        output = None
+        session = self.vty_session()
+        if session is not None:
+            output = session.run(command, daemon)
 
-        self.logger.info('vtysh command => "{}"'.format(command))
-        output = self.run(vtysh_command)
+        if output is None:
+            dparam = ""
+            if daemon is not None:
+                dparam += "-d {}".format(daemon)
+
+            vtysh_command = 'vtysh {} -c "{}" 2>/dev/null'.format(dparam, command)
+            output = self.run(vtysh_command)
 
         dbgout = output.strip()
         if dbgout:
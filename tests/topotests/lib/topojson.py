@@ -36,6 +36,7 @@ from lib.common_config import (
     create_static_routes,
     create_vrf_cfg,
     load_config_to_routers,
+    reset_config_on_routers,
     start_topology,
     topo_daemons,
     number_to_column,
@@ -341,6 +342,15 @@ def build_config_from_json(tgen, topo=None, save_bkup=True):
     if topo is None:
         topo = tgen.json_topo
 
+    if tgen.reused:
+        # The routers were configured from the same topology by the previous test
+        # module, only undo the changes it made
+        result = reset_config_on_routers(tgen)
+        if not result:
+            logger.info("build_config_from_json: failed to reset configuration")
+            pytest.exit(1)
+        return
+
     data = topo["routers"]
     for func_type in func_dict.keys():
         logger.info("Checking for {} configuration in input data".format(func_type))
@@ -374,13 +384,9 @@ def create_tgen_from_json(testfile, json_file=None):
     if not os.path.exists(json_file):
         json_file = os.path.join(thisdir, basename[5:-3] + ".json")
         assert os.path.exists(json_file)
-    with open(json_file, "r") as topof:
-        topo = json.load(topof)
 
-    # Create topology
-    tgen = Topogen(lambda tgen: build_topo_from_json(tgen, topo), basename[:-3])
-    tgen.json_topo = topo
-    return tgen
+    # Create topology, Topogen loads the file so that the topology can be reused
+    return Topogen(json_file, basename[:-3])
 
 
 def setup_module_from_json(testfile, json_file=None):
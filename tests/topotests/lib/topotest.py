@@ -32,10 +32,13 @@ import pdb
 import platform
 import re
 import resource
+import select
 import signal
+import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 from copy import deepcopy
 
@@ -333,11 +336,129 @@ def router_json_cmp(router, cmd, data, exact=False):
     return json_cmp(router.vtysh_cmd(cmd, isjson=True), data, exact)
 
 
-def run_and_expect(func, what, count=20, wait=3):
+class WaitEvent(object):
+    """
+    The output of a process that wakes a `Waiter` up, when a line of it matches
+    `pattern` (or on any output if `pattern` is None). See `log_event()` and
+    `ip_monitor_event()`. Once the process exits, `eof` is set and the event
+    never fires again.
+    """
+
+    def __init__(self, proc, pattern=None):
+        self.proc = proc
+        self.pattern = re.compile(pattern) if pattern is not None else None
+        self.partial = b""
+        self.eof = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def fileno(self):
+        return self.proc.stdout.fileno()
+
+    def check(self):
+        "Read the available output, returns True if it matches."
+        data = os.read(self.fileno(), 65536)
+        if not data:
+            self.eof = True
+            return False
+        if self.pattern is None:
+            return True
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        for line in lines:
+            if self.pattern.search(line.decode("utf-8", "replace")):
+                return True
+        return False
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        self.proc.wait()
+        self.proc.stdout.close()
+
+
+def log_event(router, daemon, pattern):
+    """
+    Returns a `WaitEvent` for new lines of the log of `daemon` on `router`
+    matching the regular expression `pattern`.
+    """
+    router = getattr(router, "net", router)
+    logfile = "{}/{}/{}.log".format(router.logdir, router.name, daemon)
+    proc = subprocess.Popen(
+        ["tail", "-F", "-n", "0", logfile],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    return WaitEvent(proc, pattern)
+
+
+def ip_monitor_event(router, objects=("link", "address", "route"), pattern=None):
+    """
+    Returns a `WaitEvent` for the changes of `objects` reported by "ip monitor"
+    in the namespace of `router`.
+    """
+    router = getattr(router, "net", router)
+    proc = router.popen(
+        ["ip", "monitor"] + list(objects),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        encoding=None,
+    )
+    return WaitEvent(proc, pattern)
+
+
+class Waiter(object):
+    """
+    Sleeps between the attempts of a polling loop. The first sleep lasts
+    `initial` seconds and each one doubles it up to `ceiling`, so conditions that
+    become true quickly are seen quickly, and long waits still poll every
+    `ceiling` seconds. A sleep ends early when one of the `events` (see
+    `WaitEvent`) fires, and the delay starts again from `initial`.
+    """
+
+    def __init__(self, ceiling, initial=0.05, events=None):
+        self.ceiling = ceiling
+        self.initial = min(initial, ceiling)
+        self.delay = self.initial
+        self.events = list(events or [])
+
+    def wait(self, limit=None):
+        """
+        Sleep for the current delay, but at most `limit` seconds. Returns True if
+        woken up by an event.
+        """
+        delay = self.delay if limit is None else max(min(self.delay, limit), 0)
+        self.delay = min(self.delay * 2, self.ceiling)
+
+        deadline = time.time() + delay
+        while True:
+            # Events whose process exited are always readable, drop them
+            self.events = [event for event in self.events if not event.eof]
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return False
+            if not self.events:
+                time.sleep(timeout)
+                return False
+            ready, _, _ = select.select(self.events, [], [], timeout)
+            if [event for event in ready if event.check()]:
+                self.delay = self.initial
+                return True
+
+
+def run_and_expect(func, what, count=20, wait=3, events=None):
     """
     Run `func` and compare the result with `what`. Do it for `count` times
-    waiting `wait` seconds between tries. By default it tries 20 times with
-    3 seconds delay between tries.
+    waiting up to `wait` seconds between tries, and for at least `count` * `wait`
+    seconds. By default it tries 20 times with up to 3 seconds delay between
+    tries.
+
+    The delay starts short and grows to `wait`, see `Waiter`, which `events`
+    can wake up early.
 
     Returns (True, func-return) on success or
     (False, func-return) on failure.
@@ -356,16 +477,20 @@ def run_and_expect(func, what, count=20, wait=3):
         func_name = func.__name__
 
     logger.info(
-        "'{}' polling started (interval {} secs, maximum {} tries)".format(
+        "'{}' polling started (interval up to {} secs, maximum {} tries)".format(
             func_name, wait, count
         )
     )
 
-    while count > 0:
+    deadline = start_time + count * wait
+    waiter = Waiter(wait, events=events)
+    while True:
         result = func()
+        count -= 1
         if result != what:
-            time.sleep(wait)
-            count -= 1
+            if count <= 0 and time.time() >= deadline:
+                break
+            waiter.wait(max(deadline - time.time(), 0) if count <= 0 else None)
             continue
 
         end_time = time.time()
@@ -383,11 +508,11 @@ def run_and_expect(func, what, count=20, wait=3):
     return (False, result)
 
 
-def run_and_expect_type(func, etype, count=20, wait=3, avalue=None):
+def run_and_expect_type(func, etype, count=20, wait=3, avalue=None, events=None):
     """
     Run `func` and compare the result with `etype`. Do it for `count` times
-    waiting `wait` seconds between tries. By default it tries 20 times with
-    3 seconds delay between tries.
+    waiting up to `wait` seconds between tries, like `run_and_expect()`. By
+    default it tries 20 times with up to 3 seconds delay between tries.
 
     This function is used when you want to test the return type and,
     optionally, the return value.
@@ -403,34 +528,34 @@ def run_and_expect_type(func, etype, count=20, wait=3, avalue=None):
         func_name = func.__name__
 
     logger.info(
-        "'{}' polling started (interval {} secs, maximum wait {} secs)".format(
+        "'{}' polling started (interval up to {} secs, maximum wait {} secs)".format(
             func_name, wait, int(wait * count)
         )
     )
 
-    while count > 0:
+    deadline = start_time + count * wait
+    waiter = Waiter(wait, events=events)
+    while True:
         result = func()
+        count -= 1
         if not isinstance(result, etype):
             logger.debug(
                 "Expected result type '{}' got '{}' instead".format(etype, type(result))
             )
-            time.sleep(wait)
-            count -= 1
-            continue
-
-        if etype != type(None) and avalue != None and result != avalue:
+        elif etype != type(None) and avalue != None and result != avalue:
             logger.debug("Expected value '{}' got '{}' instead".format(avalue, result))
-            time.sleep(wait)
-            count -= 1
-            continue
-
-        end_time = time.time()
-        logger.info(
-            "'{}' succeeded after {:.2f} seconds".format(
-                func_name, end_time - start_time
+        else:
+            end_time = time.time()
+            logger.info(
+                "'{}' succeeded after {:.2f} seconds".format(
+                    func_name, end_time - start_time
+                )
             )
-        )
-        return (True, result)
+            return (True, result)
+
+        if count <= 0 and time.time() >= deadline:
+            break
+        waiter.wait(max(deadline - time.time(), 0) if count <= 0 else None)
 
     end_time = time.time()
     logger.error(
@@ -1269,6 +1394,174 @@ def setup_node_tmpdir(logdir, name):
     return logfile
 
 
+class VtySession(object):
+    """
+    Persistent connections to the vty sockets of the daemons of a router, to
+    run "show" commands without starting a shell, nsenter and vtysh for each
+    of them.
+
+    This speaks the protocol of vtysh: a command is sent as a NUL terminated
+    string, and the daemon replies with the output of the command followed by
+    three NUL bytes and the return code of the command.
+
+    vtysh knows which daemons implement each command; here the command is
+    sent to all daemons (or to `daemon`), and the output is only used if
+    exactly one of them knows it.  Otherwise run() returns None, and the
+    caller has to run vtysh, which merges the output of several daemons and
+    implements a few commands itself.  The daemon that answered a command is
+    remembered, so running it again only queries that daemon.
+    """
+
+    # In the order of vtysh_client[] in vtysh.c
+    DAEMONS = [
+        "zebra",
+        "ripd",
+        "ripngd",
+        "ospfd",
+        "ospf6d",
+        "ldpd",
+        "bgpd",
+        "isisd",
+        "pimd",
+        "nhrpd",
+        "eigrpd",
+        "babeld",
+        "sharpd",
+        "fabricd",
+        "watchfrr",
+        "pbrd",
+        "staticd",
+        "bfdd",
+        "vrrpd",
+        "pathd",
+    ]
+
+    # Return codes of lib/command.h
+    CMD_SUCCESS = 0
+    CMD_WARNING = 1
+    CMD_ERR_NO_MATCH = 2
+    CMD_NOT_MY_INSTANCE = 14
+
+    def __init__(self, sockdir, timeout=120):
+        """
+        sockdir: the directory of the vty sockets, as seen from this process
+        timeout: seconds to wait for the reply to a command
+        """
+        self.sockdir = sockdir
+        self.timeout = timeout
+        self.socks = {}
+        self.owners = {}
+        self.lock = threading.Lock()
+
+    def _path(self, daemon):
+        return os.path.join(self.sockdir, "{}.vty".format(daemon))
+
+    def _connect(self, daemon):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self._path(daemon))
+            sock.sendall(b"enable\0")
+            self._read(sock)
+        except (OSError, socket.error):
+            sock.close()
+            return None
+        self.socks[daemon] = sock
+        return sock
+
+    def _drop(self, daemon):
+        sock = self.socks.pop(daemon, None)
+        if sock is not None:
+            sock.close()
+
+    @staticmethod
+    def _read(sock):
+        buf = bytearray()
+        while len(buf) < 4 or buf[-4:-1] != b"\0\0\0":
+            data = sock.recv(65536)
+            if not data:
+                raise socket.error(errno.ECONNRESET, "vty connection closed")
+            buf += data
+        return (buf[-1], buf[:-4].decode("utf-8", "replace"))
+
+    def _send(self, daemons, command):
+        """
+        Send `command` to each daemon, then read the replies.  A connection
+        that fails (e.g. because the daemon was restarted) is opened again
+        and the command sent once more.  Returns (daemon, status, output)
+        for each daemon that replied.
+        """
+        sent = []
+        for daemon in daemons:
+            for attempt in range(2):
+                sock = self.socks.get(daemon) or self._connect(daemon)
+                if sock is None:
+                    break
+                try:
+                    sock.sendall(command.encode("utf-8") + b"\0")
+                    sent.append(daemon)
+                    break
+                except (OSError, socket.error):
+                    self._drop(daemon)
+
+        replies = []
+        for daemon in sent:
+            try:
+                (status, output) = self._read(self.socks[daemon])
+            except (OSError, socket.error):
+                # The command may have run, only retry with a new connection
+                # since "show" commands can be run again
+                self._drop(daemon)
+                sock = self._connect(daemon)
+                if sock is None:
+                    continue
+                try:
+                    sock.sendall(command.encode("utf-8") + b"\0")
+                    (status, output) = self._read(sock)
+                except (OSError, socket.error):
+                    self._drop(daemon)
+                    continue
+            replies.append((daemon, status, output))
+        return replies
+
+    def run(self, command, daemon=None):
+        """
+        Run a "show" command and return its output, or None if it has to be
+        run with vtysh.
+        """
+        if not command.startswith("show "):
+            return None
+
+        with self.lock:
+            if daemon is not None:
+                daemons = [daemon]
+            elif command in self.owners:
+                daemons = [self.owners[command]]
+            else:
+                daemons = [d for d in self.DAEMONS if os.path.exists(self._path(d))]
+
+            replies = [
+                reply
+                for reply in self._send(daemons, command)
+                if reply[1] not in (self.CMD_ERR_NO_MATCH, self.CMD_NOT_MY_INSTANCE)
+            ]
+            if len(replies) != 1:
+                self.owners.pop(command, None)
+                return None
+
+            (owner, status, output) = replies[0]
+            if status not in (self.CMD_SUCCESS, self.CMD_WARNING):
+                return None
+            if daemon is None:
+                self.owners[command] = owner
+            return output
+
+    def close(self):
+        with self.lock:
+            for daemon in list(self.socks):
+                self._drop(daemon)
+
+
 class Router(Node):
     "A Node with IPv4/IPv6 forwarding enabled"
 
@@ -1301,6 +1594,10 @@ class Router(Node):
             l = topolog.get_logger(name, log_level="debug", target=logfile)
             params["logger"] = l
 
+        params.setdefault(
+            "persistent_shell", g_extra_config.get("persistent_shells", False)
+        )
+
         super(Router, self).__init__(name, **params)
 
         self.daemondir = None
@@ -1785,9 +2082,11 @@ class Router(Node):
                 daemons_list.remove("staticd")
 
         if "snmpd" in daemons_list:
-            # Give zerbra a chance to configure interface addresses that snmpd daemon
-            # may then use.
-            time.sleep(2)
+            # Give zebra a chance to configure interface addresses that snmpd daemon
+            # may then use: once zebra answers on its vty its config was read.
+            if "zebra" in self.daemons and self.daemons["zebra"] == 1:
+                if not self.waitForVty("zebra"):
+                    logger.warning("%s: zebra vty not answering", self)
 
             start_daemon("snmpd")
             while "snmpd" in daemons_list:
@@ -1814,11 +2113,37 @@ class Router(Node):
             return "Daemons are not running"
 
         # Update the permissions on the log files
-        self.cmd("chown frr:frr -R {}/{}".format(self.logdir, self.name))
-        self.cmd("chmod ug+rwX,o+r -R {}/{}".format(self.logdir, self.name))
+        self.cmd(
+            "chown frr:frr -R {0}/{1}; chmod ug+rwX,o+r -R {0}/{1}".format(
+                self.logdir, self.name
+            )
+        )
 
         return ""
 
+    def waitForVty(self, daemon, timeout=10):
+        """
+        Wait for `daemon` to answer a command on its vty socket, polling with
+        an increasing delay. Returns False if it did not within `timeout`
+        seconds.
+        """
+        session = VtySession(
+            "/proc/{}/root/var/run/{}".format(self.pid, self.routertype),
+            timeout=timeout,
+        )
+        deadline = time.time() + timeout
+        delay = 0.01
+        try:
+            while session.run("show version", daemon) is None:
+                now = time.time()
+                if now >= deadline:
+                    return False
+                time.sleep(min(delay, deadline - now))
+                delay = min(delay * 2, 0.5)
+            return True
+        finally:
+            session.close()
+
     def killRouterDaemons(
         self, daemons, wait=True, assertOnError=True, minErrorVersion="5.1"
     ):
@@ -30,22 +30,50 @@ This program
 
 from __future__ import print_function, unicode_literals
 import argparse
+import contextlib
+import ctypes
+import ctypes.util
+import fnmatch
+import functools
+import hashlib
+import json
 import logging
 import os, os.path
 import random
 import re
+import select
+import signal
+import socket
 import string
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from ipaddress import IPv6Address, ip_network
 from pprint import pformat
 
+# The command table matcher is installed next to this script
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from frr_reload_marker import ConfigMarker
+
+
 # Python 3
 def iteritems(d):
     return iter(d.items())
 
 
+# Plain dicts keep their insertion order from Python 3.7 on and take about
+# half the memory of an OrderedDict; either is used as an ordered set of lines
+if sys.version_info >= (3, 7):
+    LineSet = dict
+else:
+    LineSet = OrderedDict
+
+
 log = logging.getLogger(__name__)
 
 
@@ -53,11 +81,162 @@ class VtyshException(Exception):
     pass
 
 
+class ReloadTimer(object):
+    """
+    Wall and CPU time spent in each phase of a reload, and counters.
+
+    Phases nest: the time of a phase does not include the time of the phases
+    run inside it, so the phases add up to the total.  CPU time is the time of
+    the thread running the phase, vtysh's own CPU time is only in the total.
+    Nothing is recorded unless the timer is enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.phases = OrderedDict()
+        self.counts = OrderedDict()
+        self.start = (time.time(), time.process_time(), os.times())
+
+    def _enter(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        # [wall, cpu] of the phases nested in this one
+        stack.append([0.0, 0.0])
+        return (time.perf_counter(), time.thread_time())
+
+    def _leave(self, name, start, calls=1):
+        wall = time.perf_counter() - start[0]
+        cpu = time.thread_time() - start[1]
+        stack = self.local.stack
+        nested = stack.pop()
+        if stack:
+            stack[-1][0] += wall
+            stack[-1][1] += cpu
+
+        with self.lock:
+            phase = self.phases.setdefault(name, [0, 0.0, 0.0])
+            phase[0] += calls
+            phase[1] += wall - nested[0]
+            phase[2] += cpu - nested[1]
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        start = self._enter()
+        try:
+            yield
+        finally:
+            self._leave(name, start)
+
+    def timed(self, name):
+        """
+        Decorator running the function as a phase
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def iterate(self, name, iterable):
+        """
+        Record the time spent producing the items of `iterable` as a phase,
+        e.g. marking a configuration while it is being parsed
+        """
+        if not self.enabled:
+            return iterable
+        return self._iterate(name, iter(iterable))
+
+    def _iterate(self, name, iterator):
+        calls = 1
+        while True:
+            start = self._enter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._leave(name, start, calls)
+                calls = 0
+            yield item
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def report(self):
+        times = os.times()
+        phases = OrderedDict(
+            (name, {"calls": calls, "wall": wall, "cpu": cpu})
+            for (name, (calls, wall, cpu)) in iteritems(self.phases)
+        )
+        return {
+            "total": {
+                "wall": time.time() - self.start[0],
+                "cpu": time.process_time() - self.start[1],
+                "children_cpu": times[2]
+                + times[3]
+                - self.start[2][2]
+                - self.start[2][3],
+            },
+            "phases": phases,
+            "counts": dict(self.counts),
+        }
+
+    def log_report(self, report):
+        log.info(
+            "Reload took %.3fs, %.3fs CPU (%.3fs in vtysh)",
+            report["total"]["wall"],
+            report["total"]["cpu"],
+            report["total"]["children_cpu"],
+        )
+        for (name, phase) in iteritems(report["phases"]):
+            log.info(
+                "  %-16s %8.3fs %8.3fs CPU %6d calls",
+                name,
+                phase["wall"],
+                phase["cpu"],
+                phase["calls"],
+            )
+        for (name, value) in sorted(iteritems(report["counts"])):
+            log.info("  %-16s %d", name, value)
+
+
+timer = ReloadTimer()
+
+
 class Vtysh(object):
-    def __init__(self, bindir=None, confdir=None, sockdir=None, pathspace=None):
+    def __init__(
+        self,
+        bindir=None,
+        confdir=None,
+        sockdir=None,
+        pathspace=None,
+        native=False,
+        marker=None,
+    ):
         self.bindir = bindir
         self.confdir = confdir
+        self.sockdir = sockdir
         self.pathspace = pathspace
+        self.native = native
+        self.marker = marker
         self.common_args = [os.path.join(bindir or "", "vtysh")]
         if confdir:
             self.common_args.extend(["--config_dir", confdir])
@@ -74,6 +253,7 @@ class Vtysh(object):
             kwargs["stdout"] = stdout
         if stderr is not None:
             kwargs["stderr"] = stderr
+        timer.count("vtysh_calls")
         return subprocess.Popen(self.common_args + args, **kwargs)
 
     def _call_cmd(self, command, stdin=None, stdout=None, stderr=None):
@@ -83,6 +263,12 @@ class Vtysh(object):
             args = ["-c", command]
         return self._call(args, stdin, stdout, stderr)
 
+    def _vty_client(self):
+        client = VtyClient(self.sockdir, self.pathspace)
+        timer.count("vty_connections")
+        client.connect()
+        return client
+
     def __call__(self, command, stdouts=None):
         """
         Call a CLI command (e.g. "show running-config")
@@ -90,6 +276,13 @@ class Vtysh(object):
         Output text is automatically redirected, decoded and returned.
         Multiple commands may be passed as list.
         """
+        # "write" needs vtysh to merge and save the integrated config
+        if self.native and command != "write":
+            if not isinstance(command, list):
+                command = [command]
+            with self._vty_client() as client:
+                return client(command, stdouts)
+
         proc = self._call_cmd(command, stdout=subprocess.PIPE)
         stdout, stderr = proc.communicate()
         if proc.wait() != 0:
@@ -100,6 +293,31 @@ class Vtysh(object):
             )
         return stdout.decode("UTF-8")
 
+    def show_running(self, daemon=None):
+        """
+        Return the running configuration, as text that is not marked
+        """
+        if self.native:
+            with self._vty_client() as client:
+                return client.show_running_config(daemon)
+
+        cmd = "show running-config"
+        if daemon:
+            cmd += " %s" % daemon
+        cmd += " no-header"
+        return self(cmd)
+
+    def daemons(self):
+        """
+        Return the names of the daemons that are running, without watchfrr
+        """
+        if self.native:
+            with self._vty_client() as client:
+                daemons = list(client.socks)
+        else:
+            daemons = self("show daemons").split()
+        return [daemon for daemon in daemons if daemon != "watchfrr"]
+
     def is_config_available(self):
         """
         Return False if no frr daemon is running or some other vtysh session is
@@ -115,60 +333,641 @@ class Vtysh(object):
 
         return True
 
+    @timer.timed("apply")
     def exec_file(self, filename):
+        if self.native:
+            with self._vty_client() as client:
+                client.exec_file(filename)
+            return
+
         child = self._call(["-f", filename])
         if child.wait() != 0:
             raise VtyshException(
                 "vtysh (exec file) exited with status %d" % (child.returncode)
             )
 
+    @timer.timed("apply")
+    def transaction(self, filename):
+        """
+        Apply a file of commands as one configuration transaction, see
+        VtyClient.transaction().  Returns the time the commit took in each
+        daemon, which is only known when talking to them directly.
+        """
+        if self.native:
+            with self._vty_client() as client:
+                return client.transaction(client.read_file(filename))
+
+        # "vtysh -f" already wraps the file in XFRR_start_configuration and
+        # XFRR_end_configuration, but does not fail if the commit does
+        child = self._call(["-f", filename], stdout=subprocess.PIPE)
+        output = child.communicate()[0].decode("UTF-8")
+        if child.returncode != 0 or VtyClient.commit_failed in output:
+            raise VtyshException(
+                "vtysh (transaction) exited with status %d:\n%s"
+                % (child.returncode, output)
+            )
+        return {}
+
+    def _mark_lines(self, args, stdin=None, what="mark file"):
+        """
+        Run "vtysh -m" and yield its output line by line as it is produced,
+        rather than collecting all of it in memory first
+        """
+        with tempfile.TemporaryFile() as errors:
+            child = self._call(
+                args,
+                stdin=stdin or subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=errors,
+            )
+            try:
+                for line in child.stdout:
+                    yield line.decode("UTF-8")
+            finally:
+                child.stdout.close()
+
+            if child.wait() != 0:
+                errors.seek(0)
+                raise VtyshException(
+                    "vtysh (%s) exited with status %d:\n%s"
+                    % (what, child.returncode, errors.read().decode("UTF-8"))
+                )
+
+    def mark_file_lines(self, filename):
+        return self._mark_lines(["-m", "-f", filename])
+
     def mark_file(self, filename, stdin=None):
-        child = self._call(
-            ["-m", "-f", filename],
-            stdout=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+        return "".join(self.mark_file_lines(filename))
+
+    def _vtysh_conf_lines(self):
+        """
+        Return the lines of vtysh.conf that vtysh itself shows in
+        "show running-config"
+        """
+        lines = []
+        filename = os.path.join(
+            self.confdir or "/etc/frr", self.pathspace or "", "vtysh.conf"
         )
-        try:
-            stdout, stderr = child.communicate()
-        except subprocess.TimeoutExpired:
-            child.kill()
-            stdout, stderr = child.communicate()
-            raise VtyshException("vtysh call timed out!")
+        if not os.path.isfile(filename):
+            return lines
 
-        if child.wait() != 0:
-            raise VtyshException(
-                "vtysh (mark file) exited with status %d:\n%s"
-                % (child.returncode, stderr)
-            )
+        with open(filename, "r") as fh:
+            for line in fh:
+                line = line.strip()
+                if line.startswith("username ") or line.endswith(
+                    "service integrated-vtysh-config"
+                ):
+                    lines.append(line)
+        return lines
 
-        return stdout.decode("UTF-8")
+    def _show_run_native(self, daemon=None):
+        with self._vty_client() as client:
+            config_text = client.show_running_config(daemon)
+
+        if not daemon:
+            config_text = "\n".join(self._vtysh_conf_lines() + [config_text])
+        return config_text
+
+    def _mark_show_run_native(self, daemon=None):
+        config_text = self._show_run_native(daemon)
+
+        with tempfile.TemporaryFile() as show_run:
+            show_run.write(config_text.encode("UTF-8"))
+            show_run.seek(0)
+            del config_text
+
+            for line in self._mark_lines(
+                ["-m", "-f", "-"], stdin=show_run, what="mark running-config"
+            ):
+                yield line
+
+    def mark_show_run_lines(self, daemon=None):
+        if self.native:
+            for line in self._mark_show_run_native(daemon):
+                yield line
+            return
 
-    def mark_show_run(self, daemon=None):
         cmd = "show running-config"
         if daemon:
             cmd += " %s" % daemon
         cmd += " no-header"
         show_run = self._call_cmd(cmd, stdout=subprocess.PIPE)
-        mark = self._call(
-            ["-m", "-f", "-"], stdin=show_run.stdout, stdout=subprocess.PIPE
-        )
-
-        show_run.wait()
-        stdout, stderr = mark.communicate()
-        mark.wait()
+        try:
+            for line in self._mark_lines(
+                ["-m", "-f", "-"], stdin=show_run.stdout, what="mark running-config"
+            ):
+                yield line
+        finally:
+            show_run.stdout.close()
+            show_run.wait()
 
         if show_run.returncode != 0:
             raise VtyshException(
                 "vtysh (show running-config) exited with status %d:"
                 % (show_run.returncode)
             )
-        if mark.returncode != 0:
+
+    def mark_show_run(self, daemon=None):
+        return "".join(self.mark_show_run_lines(daemon))
+
+    def session(self):
+        """
+        Open a persistent configuration session, see VtyshSession and
+        VtyClient
+        """
+        if self.native:
+            client = self._vty_client()
+            client.configure()
+            return client
+
+        return VtyshSession(self)
+
+
+class VtyClient(object):
+    """
+    Talks to the daemons through their vty sockets directly, without going
+    through the vtysh binary.
+
+    This is the same protocol vtysh uses: each command is sent as a NUL
+    terminated string, the daemon replies with the command output followed
+    by three NUL bytes and the command's return code.  Several commands may
+    be sent before reading the replies.
+
+    Unlike vtysh we do not know which daemon implements a command.  Every
+    command is sent to every daemon and the daemons that do not know it
+    simply reply with CMD_ERR_NO_MATCH.  A command has failed if no daemon
+    accepted it, or if a daemon accepted but could not apply it.
+
+    Commands are given as frr-reload writes them to files: the indentation
+    of a line is its depth in the context tree.  A line is only sent to the
+    daemons that accepted all of its parent context lines, the same way
+    vtysh only sends "neighbor ..." to bgpd once "router bgp" was entered.
+    """
+
+    # In the same order as vtysh_client[] in vtysh.c
+    daemons = (
+        "zebra",
+        "ripd",
+        "ripngd",
+        "ospfd",
+        "ospf6d",
+        "ldpd",
+        "bgpd",
+        "isisd",
+        "pimd",
+        "nhrpd",
+        "eigrpd",
+        "babeld",
+        "sharpd",
+        "fabricd",
+        "watchfrr",
+        "pbrd",
+        "staticd",
+        "bfdd",
+        "vrrpd",
+        "pathd",
+    )
+
+    # Return codes from lib/command.h
+    CMD_SUCCESS = 0
+    CMD_WARNING = 1
+    CMD_ERR_NO_MATCH = 2
+    CMD_ERR_AMBIGUOUS = 3
+    CMD_ERR_INCOMPLETE = 4
+    CMD_NOT_MY_INSTANCE = 14
+
+    # Number of commands sent to a daemon before reading the replies
+    window = 512
+
+    # Printed by nb_cli_classic_commit() when a commit is rejected
+    commit_failed = "% Configuration failed."
+
+    def __init__(self, sockdir=None, pathspace=None):
+        self.sockdir = os.path.join(sockdir or "/var/run/frr", pathspace or "")
+        self.socks = OrderedDict()
+        # (line, daemons that accepted it) for each level of the current
+        # context
+        self.contexts = []
+        self.executed = 0
+        self.failed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def connect(self):
+        for daemon in self.daemons:
+            path = os.path.join(self.sockdir, "%s.vty" % daemon)
+            if not os.path.exists(path):
+                continue
+
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+            except socket.error as e:
+                log.debug("cannot connect to %s: %s", path, e)
+                sock.close()
+                continue
+            self.socks[daemon] = [sock, bytearray()]
+
+        if not self.socks:
+            raise VtyshException("no daemon is listening in %s" % self.sockdir)
+
+        self.execute(["enable"])
+
+    def close(self):
+        for sock, _ in self.socks.values():
+            sock.close()
+        self.socks.clear()
+        self.contexts = []
+
+    def _drop(self, daemon, error):
+        log.error("lost vty connection to %s: %s", daemon, error)
+        self.socks.pop(daemon)[0].close()
+        if not self.socks:
+            raise VtyshException("lost the vty connection to all daemons")
+
+    def _read_reply(self, daemon):
+        sock, buf = self.socks[daemon]
+        start = 0
+        while True:
+            end = buf.find(b"\0\0\0", start)
+            if end >= 0 and len(buf) >= end + 4:
+                output = buf[:end].decode("UTF-8", "replace")
+                status = buf[end + 3]
+                del buf[: end + 4]
+                return (status, output)
+
+            start = max(len(buf) - 3, 0)
+            data = sock.recv(65536)
+            if not data:
+                raise socket.error("connection closed")
+            buf.extend(data)
+
+    def _run(self, batch):
+        """
+        Send a batch of (index, line, daemons) to the daemons and collect
+        the replies into self.results.
+        """
+        for daemon in list(self.socks):
+            lines = [line for (_, line, daemons) in batch if daemon in daemons]
+            if not lines:
+                continue
+            data = b"".join(line.encode("UTF-8") + b"\0" for line in lines)
+            try:
+                self.socks[daemon][0].sendall(data)
+            except socket.error as e:
+                self._drop(daemon, e)
+
+        for daemon in list(self.socks):
+            for (index, _, daemons) in batch:
+                if daemon not in daemons or daemon not in self.socks:
+                    continue
+                try:
+                    self.results[index][daemon] = self._read_reply(daemon)
+                except socket.error as e:
+                    self._drop(daemon, e)
+
+        del batch[:]
+
+    def _accepted(self, index):
+        return [
+            daemon
+            for (daemon, (status, _)) in self.results[index].items()
+            if status in (self.CMD_SUCCESS, self.CMD_WARNING)
+        ]
+
+    def _result(self, index):
+        """
+        Return (ok, output) for the line with the given index
+        """
+        replies = self.results[index]
+        accepted = self._accepted(index)
+        ignored = (self.CMD_ERR_NO_MATCH, self.CMD_NOT_MY_INSTANCE)
+        if accepted:
+            ignored += (self.CMD_ERR_AMBIGUOUS, self.CMD_ERR_INCOMPLETE)
+
+        ok = bool(accepted)
+        for (status, _) in replies.values():
+            if status not in ignored and status not in (
+                self.CMD_SUCCESS,
+                self.CMD_WARNING,
+            ):
+                ok = False
+
+        # Don't bother the user with the errors of the daemons that do not
+        # implement this command, unless none does
+        outputs = [
+            output
+            for (status, output) in replies.values()
+            if status not in (self.CMD_ERR_NO_MATCH, self.CMD_NOT_MY_INSTANCE)
+        ]
+        if not outputs and replies:
+            outputs = [next(iter(replies.values()))[1]]
+
+        return (ok, "".join(outputs))
+
+    def execute(self, lines):
+        """
+        Execute the lines, return a list of (ok, output) for each of them
+        """
+        self.results = [OrderedDict() for _ in lines]
+        batch = []
+
+        for (index, line) in enumerate(lines):
+            command = line.strip()
+            depth = len(line) - len(line.lstrip(" "))
+            is_context = (
+                index + 1 < len(lines)
+                and len(lines[index + 1]) - len(lines[index + 1].lstrip(" "))
+                > depth
+            )
+
+            del self.contexts[depth + 1 :]
+            if len(self.contexts) > depth and self.contexts[depth][0] == command:
+                # Re-entering the context we are already in, we already know
+                # which daemons accept this line
+                context = self.contexts.pop()
+            else:
+                context = None
+                del self.contexts[depth:]
+
+            if self.contexts:
+                daemons = self.contexts[-1][1]
+            else:
+                daemons = list(self.socks)
+
+            batch.append((index, command, daemons))
+
+            if is_context:
+                if context is None:
+                    self._run(batch)
+                    context = (command, self._accepted(index))
+                self.contexts.append(context)
+            elif len(batch) >= self.window:
+                self._run(batch)
+
+        self._run(batch)
+        return [self._result(index) for index in range(len(lines))]
+
+    def __call__(self, cmd, stdouts=None):
+        """
+        Execute one command (a list of lines, i.e. context path and the
+        command itself).  Raises VtyshException if one of the lines failed,
+        the daemons' output is appended to stdouts if that is given.
+        """
+        results = self.execute(cmd)
+        self.executed += 1
+
+        for (line, (ok, output)) in zip(cmd, results):
+            if not ok:
+                self.failed += 1
+                if stdouts is not None:
+                    stdouts.append(output)
+                raise VtyshException(
+                    'vty command failed: "%s"' % " -- ".join(x.strip() for x in cmd)
+                )
+
+        return "".join(output for (_, output) in results)
+
+    def configure(self):
+        self(["configure"])
+
+    @staticmethod
+    def read_file(filename):
+        with open(filename, "r") as fh:
+            return [
+                line.rstrip("\n")
+                for line in fh
+                if line.strip() and not line.startswith("!")
+            ]
+
+    def exec_file(self, filename):
+        self.transaction(self.read_file(filename))
+
+    def _commit(self):
+        """
+        End the configuration transaction in every daemon at once, return
+        the number of daemons it failed in and the time each one took
+        """
+        start = time.time()
+        pending = {}
+        for (daemon, (sock, _)) in list(self.socks.items()):
+            try:
+                sock.sendall(b"XFRR_end_configuration\0")
+            except socket.error as e:
+                self._drop(daemon, e)
+                continue
+            pending[sock] = daemon
+
+        failed = 0
+        commits = {}
+        while pending:
+            for sock in select.select(list(pending), [], [])[0]:
+                daemon = pending.pop(sock)
+                try:
+                    (status, output) = self._read_reply(daemon)
+                except socket.error as e:
+                    self._drop(daemon, e)
+                    failed += 1
+                    continue
+
+                commits[daemon] = time.time() - start
+                if (
+                    status not in (self.CMD_SUCCESS, self.CMD_WARNING)
+                    or self.commit_failed in output
+                ):
+                    failed += 1
+                    log.error("vty commit failed in %s\n%s", daemon, output)
+        return (failed, commits)
+
+    def transaction(self, lines):
+        """
+        Apply the lines as one configuration transaction.
+
+        Between XFRR_start_configuration and XFRR_end_configuration the
+        daemons do not commit the changes of northbound commands one by
+        one, they group them and commit them all together at the end, or
+        when a command that is not converted to the northbound yet has to
+        be run.  The commit is validated as a whole and, if it fails, none
+        of its changes are applied.
+
+        Raises VtyshException if a line or a commit failed, returns the time
+        each daemon took to commit otherwise.
+        """
+        self.configure()
+        results = self.execute(["XFRR_start_configuration"] + lines)
+
+        failed = 0
+        for (line, (ok, output)) in zip(lines, results[1:]):
+            # a pending commit that failed is reported in the output of the
+            # command that triggered it
+            if not ok or self.commit_failed in output:
+                failed += 1
+                log.error('vty (transaction) failed for "%s"\n%s', line.strip(), output)
+
+        (commit_failed, commits) = self._commit()
+        if failed or commit_failed:
             raise VtyshException(
-                "vtysh (mark running-config) exited with status %d" % (mark.returncode)
+                "vty (transaction) failed for %d lines and %d commits"
+                % (failed, commit_failed)
             )
+        return commits
 
-        return stdout.decode("UTF-8")
+    def show_running_config(self, daemon=None):
+        """
+        Return the concatenated running configuration of the daemons, or of
+        only one of them.  Like vtysh, watchfrr is skipped.
+        """
+        if daemon and daemon not in self.socks:
+            raise VtyshException("%s is not running" % daemon)
+
+        outputs = []
+        for name in list(self.socks):
+            if name == "watchfrr" or (daemon and name != daemon):
+                continue
+            self._run_one(name, "show running-config", outputs)
+
+        return "\n".join(outputs)
+
+    def _run_one(self, daemon, line, outputs):
+        self.results = [OrderedDict()]
+        self._run([(0, line, [daemon])])
+        (status, output) = self.results[0].get(daemon, (None, ""))
+        if status not in (self.CMD_SUCCESS, self.CMD_WARNING):
+            raise VtyshException('%s failed to execute "%s"' % (daemon, line))
+        outputs.append(output)
+
+
+class VtyshSession(object):
+    """
+    A single long-lived "vtysh -f" process that configuration commands are
+    streamed into, one command at a time.
+
+    Forking vtysh for every "no" line is very slow when a reload removes
+    thousands of lines.  Instead, vtysh reads the commands from a pipe and
+    after each command we send a marker line that no daemon knows about.
+    vtysh reports every failing line as "line N: ..." on stderr, so once the
+    error for the marker line shows up we know that the command before it
+    has been fully processed, and whether it failed.
+
+    Every command is sent with its full context path (as returned by
+    lines_to_config()).  vtysh walks up the node tree by itself, just like it
+    does for "-c", so the previous command's context does not matter.
+    """
+
+    sync_marker = "frr-reload-sync-marker %d"
+
+    def __init__(self, vtysh):
+        self.vtysh = vtysh
+        self.child = None
+        self.lineno = 0
+        self.executed = 0
+        self.failed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _start(self):
+        self.child = self.vtysh._call(
+            ["-f", "/dev/stdin"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        self.lineno = 0
+
+        # vtysh -f lets the daemons group northbound changes into a single
+        # transaction that is committed at the end of the file.  Turn that
+        # off again so that every command is validated when it is sent,
+        # like it would be by "vtysh -c".
+        self._write("XFRR_end_configuration")
+
+    def _write(self, line):
+        self.child.stdin.write((line + "\n").encode("UTF-8"))
+        self.lineno += 1
+        return self.lineno
+
+    def _kill(self):
+        if self.child is None:
+            return
+        try:
+            self.child.kill()
+            self.child.wait()
+        except OSError:
+            pass
+        self.child = None
+
+    def __call__(self, cmd, stdouts=None):
+        """
+        Execute one command (a list of lines, i.e. context path and the
+        command itself) and wait for vtysh to process it.
+
+        Raises VtyshException if the command failed, the error output is
+        appended to stdouts if that is given.
+        """
+        if self.child is None:
+            self._start()
+
+        try:
+            first = self.lineno + 1
+            for line in cmd:
+                last = self._write(line)
+            marker = self._write(self.sync_marker % self.executed)
+            self.child.stdin.flush()
+        except (IOError, OSError) as e:
+            self._kill()
+            raise VtyshException("vtysh session went away: %s" % e)
+
+        self.executed += 1
+        errors = []
+        while True:
+            errline = self.child.stderr.readline().decode("UTF-8")
+            if not errline:
+                self._kill()
+                raise VtyshException(
+                    'vtysh session went away executing "%s"' % " -- ".join(cmd)
+                )
+
+            re_err = re.match(r"line (\d+): ", errline)
+            if not re_err:
+                log.debug("vtysh session: %s", errline.rstrip())
+                continue
+
+            err_lineno = int(re_err.group(1))
+            if err_lineno == marker:
+                break
+            if first <= err_lineno <= last:
+                errors.append(errline.rstrip())
+
+        if errors:
+            self.failed += 1
+            if stdouts is not None:
+                stdouts.append("\n".join(errors))
+            raise VtyshException(
+                'vtysh session failed for command "%s"' % " -- ".join(cmd)
+            )
+
+        return ""
+
+    def close(self):
+        if self.child is None:
+            return
+
+        try:
+            self.child.stdin.close()
+            self.child.stderr.read()
+        except (IOError, OSError):
+            pass
+
+        # The exit status is meaningless, every marker line is an error
+        self.child.wait()
+        self.child = None
 
 
 class Context(object):
@@ -190,36 +989,216 @@ class Context(object):
 
     def __init__(self, keys, lines):
         self.keys = keys
-        self.lines = lines
 
-        # Keep a dictionary of the lines, this is to make it easy to tell if a
-        # line exists in this Context
-        self.dlines = OrderedDict()
+        # The lines are only stored once, in an insertion-ordered set; this
+        # keeps them in config order and makes it easy to tell if a line
+        # exists in this Context
+        self.dlines = LineSet.fromkeys(lines)
 
-        for ligne in lines:
-            self.dlines[ligne] = True
+    @property
+    def lines(self):
+        return self.dlines.keys()
 
     def add_lines(self, lines):
         """
         Add lines to specified context
         """
 
-        self.lines.extend(lines)
-
         for ligne in lines:
-            self.dlines[ligne] = True
+            self.dlines[ligne] = None
+
+    def digest(self):
+        """
+        Return a hash of the keys and lines of this context
+        """
+        digest = hashlib.sha256()
+        for line in self.keys:
+            digest.update(line.encode("UTF-8") + b"\n")
+        digest.update(b"\n")
+        for line in self.lines:
+            digest.update(line.encode("UTF-8") + b"\n")
+        return digest.hexdigest()
+
+
+# The results of the normalizations are cached: a reload parses the running
+# configuration twice and most of its lines are also in the new one, so each
+# address or context key is only normalized once
+normalize_cache_size = 1 << 20
+
+# Patterns of the lines normalized when a configuration is parsed, compiled
+# once rather than for every line
+es_id_re = re.compile(r"(evpn mh es-id|evpn mh es-sys-mac) (?P<esi>\S*)")
+route_key_re = re.compile(r"(ip|ipv6)\s+route\s+([A-Fa-f:.0-9/]+)(.*)$")
+prefix_list_key_re = re.compile(
+    r"(ip|ipv6)\s+prefix-list(.*)(permit|deny)\s+([A-Fa-f:.0-9/]+)(.*)$"
+)
+le_ge_re = re.compile(r"(.*)le\s+(\d+)\s+ge\s+(\d+)(.*)")
+bgp_network_re = re.compile(r"network\s+([A-Fa-f:.0-9/]+)(.*)$")
+null0_re = re.compile(r"\s+null0(\s*$)")
+Null0_re = re.compile(r"\s+Null0(\s*$)")
+
+# The IPv4 prefix lengths as they can be written, e.g. "8" or "08", with their
+# value and network mask, and the packing of IPv4 addresses
+ipv4_prefixlens = dict(
+    (fmt % prefixlen, (prefixlen, (0xFFFFFFFF << (32 - prefixlen)) & 0xFFFFFFFF))
+    for prefixlen in range(33)
+    for fmt in ("%d", "%02d")
+)
+ipv4_struct = struct.Struct("!I")
+
+
+@functools.lru_cache(maxsize=normalize_cache_size)
+def normalize_prefix(addr):
+    """
+    Return the network part of a prefix, e.g. 10.0.0.0/8 for 10.1.1.1/8, as
+    ip_network(strict=False) would, or None if addr is not a prefix
+    """
+    (host, _, prefixlen) = addr.partition("/")
+    if prefixlen in ipv4_prefixlens:
+        # The common case, without the cost of an ip_network object;
+        # inet_pton() rejects octets with leading zeros like ip_network
+        try:
+            value = ipv4_struct.unpack(socket.inet_pton(socket.AF_INET, host))[0]
+        except (OSError, ValueError):
+            pass
+        else:
+            (prefixlen, mask) = ipv4_prefixlens[prefixlen]
+            value &= mask
+            return "%s/%d" % (
+                socket.inet_ntop(socket.AF_INET, ipv4_struct.pack(value)),
+                prefixlen,
+            )
+
+    try:
+        network = ip_network(addr, strict=False)
+    except ValueError:
+        return None
+    return "%s/%s" % (str(network.network_address), network.prefixlen)
+
+
+@functools.lru_cache(maxsize=normalize_cache_size)
+def normalize_ipv6_word(word):
+    """
+    Return an IPv6 address or prefix as frr shows it, other words unchanged
+    """
+    if "/" in word:
+        norm_word = normalize_prefix(word)
+        if norm_word:
+            return norm_word
+    try:
+        return "%s" % IPv6Address(word)
+    except ValueError:
+        return word
+
+
+def normalize_route_key(key):
+    m = route_key_re.match(key)
+    if m and "/" in m.group(2):
+        addr = normalize_prefix(m.group(2))
+        if addr:
+            key = "%s route %s%s" % (m.group(1), addr, m.group(3))
+
+    # "null0" in routes must be replaced by Null0
+    if "null0" in key:
+        key = null0_re.sub(" Null0", key)
+    return key
+
+
+def normalize_prefix_list_key(key):
+    m = prefix_list_key_re.match(key)
+    if not m:
+        return key
+
+    addr = m.group(4)
+    if "/" in addr:
+        addr = normalize_prefix(addr) or addr
+
+    legestr = m.group(5)
+    m_lege = le_ge_re.search(legestr)
+    if m_lege:
+        legestr = "%sge %s le %s%s" % (
+            m_lege.group(1),
+            m_lege.group(3),
+            m_lege.group(2),
+            m_lege.group(4),
+        )
+
+    return "%s prefix-list%s%s %s%s" % (
+        m.group(1),
+        m.group(2),
+        m.group(3),
+        addr,
+        legestr,
+    )
+
+
+# The normalizers of the "ip ..." and "ipv6 ..." context keys, by second word
+key_normalizers = {
+    "route": normalize_route_key,
+    "prefix-list": normalize_prefix_list_key,
+}
+
+
+@functools.lru_cache(maxsize=normalize_cache_size)
+def normalize_context_key(key):
+    """
+    Return the first key of a context as the running configuration shows it
+    """
+    words = key.split(None, 2)
+    if len(words) > 1 and words[0] in ("ip", "ipv6"):
+        normalizer = key_normalizers.get(words[1])
+        if normalizer:
+            return normalizer(key)
+    return key
+
+
+@functools.lru_cache(maxsize=normalize_cache_size)
+def normalize_bgp_network(line):
+    m = bgp_network_re.match(line)
+    if not m:
+        return line
+
+    addr = m.group(1)
+    if "/" not in addr:
+        # This is most likely an error because with no
+        # prefixlen, BGP treats the prefixlen as 8
+        addr = addr + "/8"
+
+    addr = normalize_prefix(addr)
+    if not addr:
+        # Really this should be an error. Whats a network
+        # without an IP Address following it ?
+        return line
+    return "network %s %s" % (addr, m.group(2))
+
+
+def normalize_vrf_route(line):
+    # A static route in a vrf turns into a blackhole nexthop for both null0
+    # and Null0
+    if not line.startswith(("ip route ", "ipv6 route ")):
+        return line
+    if "null0" in line:
+        return null0_re.sub(" blackhole", line)
+    if "Null0" in line:
+        return Null0_re.sub(" blackhole", line)
+    return line
+
+
+# The normalizers of the lines of the contexts whose first key starts with
+# one of these, by the first word of the line
+line_normalizers = (
+    ("router bgp", {"network": normalize_bgp_network}),
+    ("vrf ", {"ip": normalize_vrf_route, "ipv6": normalize_vrf_route}),
+)
 
 
 def get_normalized_es_id(line):
     """
     The es-id or es-sys-mac need to be converted to lower case
     """
-    sub_strs = ["evpn mh es-id", "evpn mh es-sys-mac"]
-    for sub_str in sub_strs:
-        obj = re.match(sub_str + " (?P<esi>\S*)", line)
-        if obj:
-            line = "%s %s" % (sub_str, obj.group("esi").lower())
-            break
+    obj = es_id_re.match(line)
+    if obj:
+        line = "%s %s" % (obj.group(1), obj.group("esi").lower())
     return line
 
 
@@ -242,21 +1221,30 @@ class Config(object):
     """
 
     def __init__(self, vtysh):
-        self.lines = []
         self.contexts = OrderedDict()
         self.vtysh = vtysh
 
     def load_from_file(self, filename):
         """
-        Read configuration from specified file and slurp it into internal memory
+        Read configuration from specified file and parse it into contexts
         The internal representation has been marked appropriately by passing it
         through vtysh with the -m parameter
         """
         log.info("Loading Config object from file %s", filename)
 
-        file_output = self.vtysh.mark_file(filename)
+        with timer.phase("parse"):
+            marked_lines = timer.iterate(
+                "mark-file", self.vtysh.mark_file_lines(filename)
+            )
+            self.load_contexts(self.file_lines(marked_lines))
+        timer.count("contexts", len(self.contexts))
 
-        for line in file_output.split("\n"):
+    @staticmethod
+    def file_lines(marked_lines):
+        """
+        Normalize the lines of a marked configuration file as they are read
+        """
+        for line in marked_lines:
             line = line.strip()
 
             # Compress duplicate whitespaces
@@ -289,26 +1277,35 @@ class Config(object):
                 vrf_ctx = newline[vrf_index] + " " + newline[vrf_index + 1]
                 del newline[vrf_index : vrf_index + 2]
                 newline = " ".join(newline)
-                self.lines.append(vrf_ctx)
-                self.lines.append(newline)
-                self.lines.append("exit-vrf")
+                yield vrf_ctx
+                yield newline
+                yield "exit-vrf"
                 line = "end"
 
-            self.lines.append(line)
-
-        self.load_contexts()
+            yield line
 
     def load_from_show_running(self, daemon):
         """
-        Read running configuration and slurp it into internal memory
+        Read running configuration and parse it into contexts
         The internal representation has been marked appropriately by passing it
         through vtysh with the -m parameter
         """
         log.info("Loading Config object from vtysh show running")
 
-        config_text = self.vtysh.mark_show_run(daemon)
+        # the running configuration is marked as it is fetched
+        with timer.phase("parse"):
+            marked_lines = timer.iterate(
+                "show-running", self.vtysh.mark_show_run_lines(daemon)
+            )
+            self.load_contexts(self.show_running_lines(marked_lines))
+        timer.count("running_contexts", len(self.contexts))
 
-        for line in config_text.split("\n"):
+    @staticmethod
+    def show_running_lines(marked_lines):
+        """
+        Strip the lines of a marked running configuration as they are read
+        """
+        for line in marked_lines:
             line = line.strip()
 
             if (
@@ -318,16 +1315,40 @@ class Config(object):
             ):
                 continue
 
-            self.lines.append(line)
+            yield line
+
+    def filtered(self, daemons):
+        """
+        Return a Config with only the contexts owned by one of `daemons`,
+        see context_daemon()
+        """
+        config = Config(self.vtysh)
+        for (ctx_keys, ctx) in iteritems(self.contexts):
+            if context_daemon(ctx_keys) in daemons:
+                config.contexts[ctx_keys] = ctx
+        return config
 
-        self.load_contexts()
+    def subset(self, top_keys):
+        """
+        Return a Config with only the contexts (and their sub-contexts)
+        starting with one of `top_keys`
+        """
+        config = Config(self.vtysh)
+        for (ctx_keys, ctx) in iteritems(self.contexts):
+            if ctx_keys[0] in top_keys:
+                config.contexts[ctx_keys] = ctx
+        return config
 
     def get_lines(self):
         """
-        Return the lines read in from the configuration
+        Return the configuration as parsed into contexts
         """
 
-        return "\n".join(self.lines)
+        lines = []
+        for ctx_keys, ctx in iteritems(self.contexts):
+            lines.extend(ctx_keys)
+            lines.extend(ctx.lines)
+        return "\n".join(lines)
 
     def get_contexts(self):
         """
@@ -353,127 +1374,32 @@ class Config(object):
             11.1.1.0/24. Ensure we don't do a needless operation for such
             lines. IS-IS & OSPFv3 have no "network" support.
         """
-        re_key_rt = re.match(r"(ip|ipv6)\s+route\s+([A-Fa-f:.0-9/]+)(.*)$", key[0])
-        if re_key_rt:
-            addr = re_key_rt.group(2)
-            if "/" in addr:
-                try:
-                    newaddr = ip_network(addr, strict=False)
-                    key[0] = "%s route %s/%s%s" % (
-                        re_key_rt.group(1),
-                        str(newaddr.network_address),
-                        newaddr.prefixlen,
-                        re_key_rt.group(3),
-                    )
-                except ValueError:
-                    pass
-
-        re_key_rt = re.match(
-            r"(ip|ipv6)\s+prefix-list(.*)(permit|deny)\s+([A-Fa-f:.0-9/]+)(.*)$", key[0]
-        )
-        if re_key_rt:
-            addr = re_key_rt.group(4)
-            if "/" in addr:
-                try:
-                    network_addr = ip_network(addr, strict=False)
-                    newaddr = "%s/%s" % (
-                        str(network_addr.network_address),
-                        network_addr.prefixlen,
-                    )
-                except ValueError:
-                    newaddr = addr
-            else:
-                newaddr = addr
-
-            legestr = re_key_rt.group(5)
-            re_lege = re.search(r"(.*)le\s+(\d+)\s+ge\s+(\d+)(.*)", legestr)
-            if re_lege:
-                legestr = "%sge %s le %s%s" % (
-                    re_lege.group(1),
-                    re_lege.group(3),
-                    re_lege.group(2),
-                    re_lege.group(4),
-                )
-
-            key[0] = "%s prefix-list%s%s %s%s" % (
-                re_key_rt.group(1),
-                re_key_rt.group(2),
-                re_key_rt.group(3),
-                newaddr,
-                legestr,
-            )
-
-        if lines and key[0].startswith("router bgp"):
-            newlines = []
-            for line in lines:
-                re_net = re.match(r"network\s+([A-Fa-f:.0-9/]+)(.*)$", line)
-                if re_net:
-                    addr = re_net.group(1)
-                    if "/" not in addr and key[0].startswith("router bgp"):
-                        # This is most likely an error because with no
-                        # prefixlen, BGP treats the prefixlen as 8
-                        addr = addr + "/8"
-
-                    try:
-                        network_addr = ip_network(addr, strict=False)
-                        line = "network %s/%s %s" % (
-                            str(network_addr.network_address),
-                            network_addr.prefixlen,
-                            re_net.group(2),
-                        )
-                        newlines.append(line)
-                    except ValueError:
-                        # Really this should be an error. Whats a network
-                        # without an IP Address following it ?
-                        newlines.append(line)
-                else:
-                    newlines.append(line)
-            lines = newlines
-
-        """
-          More fixups in user specification and what running config shows.
-          "null0" in routes must be replaced by Null0.
-        """
-        if (
-            key[0].startswith("ip route")
-            or key[0].startswith("ipv6 route")
-            and "null0" in key[0]
-        ):
-            key[0] = re.sub(r"\s+null0(\s*$)", " Null0", key[0])
-
-        """
-          Similar to above, but when the static is in a vrf, it turns into a
-          blackhole nexthop for both null0 and Null0.  Fix it accordingly
-        """
-        if lines and key[0].startswith("vrf "):
-            newlines = []
-            for line in lines:
-                if line.startswith("ip route ") or line.startswith("ipv6 route "):
-                    if "null0" in line:
-                        line = re.sub(r"\s+null0(\s*$)", " blackhole", line)
-                    elif "Null0" in line:
-                        line = re.sub(r"\s+Null0(\s*$)", " blackhole", line)
-                    newlines.append(line)
-                else:
-                    newlines.append(line)
-            lines = newlines
+        key[0] = normalize_context_key(key[0])
 
         if lines:
-            if tuple(key) not in self.contexts:
-                ctx = Context(tuple(key), lines)
-                self.contexts[tuple(key)] = ctx
-            else:
-                ctx = self.contexts[tuple(key)]
-                ctx.add_lines(lines)
+            for (prefix, normalizers) in line_normalizers:
+                if key[0].startswith(prefix):
+                    newlines = []
+                    for line in lines:
+                        normalizer = normalizers.get(line.split(" ", 1)[0])
+                        if normalizer:
+                            line = normalizer(line)
+                        newlines.append(line)
+                    lines = newlines
 
-        else:
-            if tuple(key) not in self.contexts:
-                ctx = Context(tuple(key), [])
-                self.contexts[tuple(key)] = ctx
+        key = tuple(key)
+        ctx = self.contexts.get(key)
+        if ctx is None:
+            self.contexts[key] = Context(key, lines)
+        elif lines:
+            ctx.add_lines(lines)
 
-    def load_contexts(self):
+    def load_contexts(self, lines):
         """
         Parse the configuration and create contexts for each appropriate block
+
+        `lines` may be any iterable, the lines are consumed one at a time and
+        only the contexts built from them are kept.
         """
 
         """
@@ -583,15 +1509,19 @@ end
         ctx_keys = []
         # stack of context keywords
         cur_ctx_keywords = [ctx_keywords]
+        # the same keywords as tuples, to tell at once if a line starts with
+        # one of them
+        cur_ctx_prefixes = [tuple(ctx_keywords)]
         # list of stored commands
         cur_ctx_lines = []
+        debug = log.isEnabledFor(logging.DEBUG)
 
-        for line in self.lines:
+        for line in lines:
 
             if not line:
                 continue
 
-            if line.startswith("!") or line.startswith("#"):
+            if line[0] in "!#":
                 continue
 
             if line.startswith("exit"):
@@ -603,10 +1533,12 @@ end
                 self.save_contexts(ctx_keys, cur_ctx_lines)
 
                 # exit current context
-                log.debug("LINE %-50s: exit context %-50s", line, ctx_keys)
+                if debug:
+                    log.debug("LINE %-50s: exit context %-50s", line, ctx_keys)
 
                 ctx_keys.pop()
                 cur_ctx_keywords.pop()
+                cur_ctx_prefixes.pop()
                 cur_ctx_lines = []
 
                 continue
@@ -618,10 +1550,12 @@ end
                     self.save_contexts(ctx_keys, cur_ctx_lines)
 
                     # exit current context
-                    log.debug("LINE %-50s: exit context %-50s", line, ctx_keys)
+                    if debug:
+                        log.debug("LINE %-50s: exit context %-50s", line, ctx_keys)
 
                     ctx_keys.pop()
                     cur_ctx_keywords.pop()
+                    cur_ctx_prefixes.pop()
                     cur_ctx_lines = []
 
                 continue
@@ -629,7 +1563,11 @@ end
             new_ctx = False
 
             # check if the line is a context-entering keyword
-            for k, v in cur_ctx_keywords[-1].items():
+            if line.startswith(cur_ctx_prefixes[-1]):
+                keywords = cur_ctx_keywords[-1].items()
+            else:
+                keywords = ()
+            for k, v in keywords:
                 if line.startswith(k):
                     # candidate-path is a special case. It may be a node and
                     # may be a single-line command. The distinguisher is the
@@ -647,19 +1585,25 @@ end
                     new_ctx = True
                     ctx_keys.append(line)
                     cur_ctx_keywords.append(v)
+                    cur_ctx_prefixes.append(tuple(v))
                     cur_ctx_lines = []
 
-                    log.debug("LINE %-50s: enter context %-50s", line, ctx_keys)
+                    if debug:
+                        log.debug("LINE %-50s: enter context %-50s", line, ctx_keys)
                     break
 
             if new_ctx:
                 continue
 
             if len(ctx_keys) == 0:
-                log.debug("LINE %-50s: single-line context", line)
+                if debug:
+                    log.debug("LINE %-50s: single-line context", line)
                 self.save_contexts([line], [])
             else:
-                log.debug("LINE %-50s: add to current context %-50s", line, ctx_keys)
+                if debug:
+                    log.debug(
+                        "LINE %-50s: add to current context %-50s", line, ctx_keys
+                    )
                 cur_ctx_lines.append(line)
 
         # Save the context of the last one
@@ -711,6 +1655,46 @@ def lines_to_config(ctx_keys, line, delete):
     return cmd
 
 
+def config_file_lines(changes):
+    """
+    Return the lines of a file applying the (ctx_keys, line, delete) changes
+    in order, e.g. with "vtysh -f".
+
+    Like in frr.conf, a change is applied without entering its CLI node again
+    if the previous change left us in that node or in one of its parents, so
+    the context lines of consecutive changes in the same node are only
+    written once.  Going back to a parent node re-enters the node from the
+    top, the way the changes are given one by one.
+    """
+    lines = []
+    current = ()
+
+    for (ctx_keys, line, delete) in changes:
+        if line == "!":
+            continue
+
+        cmd = lines_to_config(ctx_keys, line, delete)
+        if line:
+            path = tuple(ctx_keys)
+        else:
+            path = tuple(ctx_keys[:-1])
+
+        if current and path[: len(current)] == current:
+            cmd = cmd[len(current) :]
+        lines.extend(cmd)
+
+        # adding a whole context enters its node, "exit-vrf" and the like
+        # leave it
+        if not line and not delete:
+            current = tuple(ctx_keys)
+        elif line and (line.startswith("exit") or line == "end"):
+            current = ()
+        else:
+            current = path
+
+    return lines
+
+
 def get_normalized_ipv6_line(line):
     """
     Return a normalized IPv6 line as produced by frr,
@@ -718,42 +1702,92 @@ def get_normalized_ipv6_line(line):
     zeros removed, and only the network portion present if
     the IPv6 word is a network
     """
-    norm_line = ""
-    words = line.split(" ")
-    for word in words:
-        if ":" in word:
-            norm_word = None
-            if "/" in word:
-                try:
-                    v6word = ip_network(word, strict=False)
-                    norm_word = "%s/%s" % (
-                        str(v6word.network_address),
-                        v6word.prefixlen,
-                    )
-                except ValueError:
-                    pass
-            if not norm_word:
-                try:
-                    norm_word = "%s" % IPv6Address(word)
-                except ValueError:
-                    norm_word = word
-        else:
-            norm_word = word
-        norm_line = norm_line + " " + norm_word
+    return " ".join(
+        normalize_ipv6_word(word) if ":" in word else word
+        for word in line.split(" ")
+    ).strip()
+
+
+class ConfigLines(object):
+    """
+    The list of (ctx_keys, line) tuples to add or to delete.
+
+    This behaves like a list without duplicates, but the lines are also
+    indexed by their tuple and by context, so that looking up or removing a
+    line does not need to scan the whole list.  Configs with hundreds of
+    thousands of prefix-list entries or static routes would otherwise make
+    the diff quadratic.
+    """
+
+    def __init__(self, lines=None):
+        self.lines = LineSet()
+        # ctx_keys -> LineSet of the lines in that context
+        self.contexts = {}
+        if lines:
+            self.extend(lines)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __bool__(self):
+        return bool(self.lines)
+
+    __nonzero__ = __bool__
+
+    def __contains__(self, item):
+        return item in self.lines
+
+    def __repr__(self):
+        return "ConfigLines(%r)" % list(self.lines)
+
+    def append(self, item):
+        if item in self.lines:
+            return
+        (ctx_keys, line) = item
+        self.lines[item] = None
+        self.contexts.setdefault(ctx_keys, LineSet())[line] = None
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def discard(self, item):
+        if item not in self.lines:
+            return
+        (ctx_keys, line) = item
+        del self.lines[item]
+        ctx_lines = self.contexts[ctx_keys]
+        del ctx_lines[line]
+        if not ctx_lines:
+            del self.contexts[ctx_keys]
 
-    return norm_line.strip()
+    def remove(self, item):
+        if item not in self.lines:
+            raise ValueError("%r not in ConfigLines" % (item,))
+        self.discard(item)
+
+    def move_to_end(self, item):
+        self.remove(item)
+        self.append(item)
+
+    def has_context(self, ctx_keys):
+        return ctx_keys in self.contexts
+
+    def exists(self, target_ctx_keys, target_line, exact_match=True):
+        if exact_match:
+            return (target_ctx_keys, target_line) in self.lines
+
+        for line in self.contexts.get(target_ctx_keys, ()):
+            if line and line.startswith(target_line):
+                return True
+        return False
 
 
 def line_exist(lines, target_ctx_keys, target_line, exact_match=True):
-    for (ctx_keys, line) in lines:
-        if ctx_keys == target_ctx_keys:
-            if exact_match:
-                if line == target_line:
-                    return True
-            else:
-                if line.startswith(target_line):
-                    return True
-    return False
+    return lines.exists(target_ctx_keys, target_line, exact_match)
 
 
 def check_for_exit_vrf(lines_to_add, lines_to_del):
@@ -763,13 +1797,13 @@ def check_for_exit_vrf(lines_to_add, lines_to_del):
     # right context changes.  If exit-vrf exists in both the running and
     # new config, we cannot delete it or it will break context changes.
     add_exit_vrf = False
-    index = 0
+    new_lines_to_add = ConfigLines()
 
     for (ctx_keys, line) in lines_to_add:
         if add_exit_vrf == True:
             if ctx_keys[0] != prior_ctx_key:
                 insert_key = ((prior_ctx_key),)
-                lines_to_add.insert(index, ((insert_key, "exit-vrf")))
+                new_lines_to_add.append((insert_key, "exit-vrf"))
                 add_exit_vrf = False
 
         if ctx_keys[0].startswith("vrf") and line:
@@ -778,9 +1812,12 @@ def check_for_exit_vrf(lines_to_add, lines_to_del):
                 prior_ctx_key = ctx_keys[0]
             else:
                 add_exit_vrf = False
-        index += 1
 
-    for (ctx_keys, line) in lines_to_del:
+        new_lines_to_add.append((ctx_keys, line))
+
+    lines_to_add = new_lines_to_add
+
+    for (ctx_keys, line) in list(lines_to_del):
         if line == "exit-vrf":
             if line_exist(lines_to_add, ctx_keys, line):
                 lines_to_del.remove((ctx_keys, line))
@@ -800,9 +1837,9 @@ def delete_move_lines(lines_to_add, lines_to_del):
 
     del_dict = dict()
     # Stores the lines to move to the end of the pending list.
-    lines_to_del_to_del = []
+    lines_to_del_to_del = ConfigLines()
     # Stores the lines to move to end of the pending list.
-    lines_to_del_to_app = []
+    lines_to_del_to_app = ConfigLines()
     found_pg_del_cmd = False
 
     """
@@ -899,8 +1936,7 @@ def delete_move_lines(lines_to_add, lines_to_del):
                 del_dict[ctx_keys[0]][re_pg.group(1)] = list()
 
     for (ctx_keys, line) in lines_to_del_to_app:
-        lines_to_del.remove((ctx_keys, line))
-        lines_to_del.append((ctx_keys, line))
+        lines_to_del.move_to_end((ctx_keys, line))
 
     if found_pg_del_cmd == False:
         return (lines_to_add, lines_to_del)
@@ -926,7 +1962,7 @@ def delete_move_lines(lines_to_add, lines_to_del):
                     ):
                         del_dict[ctx_keys[0]][pg_key].append(re_nbr_pg.group(1))
 
-    lines_to_del_to_app = []
+    lines_to_del_to_app = ConfigLines()
     for (ctx_keys, line) in lines_to_del:
         if (
             ctx_keys[0].startswith("router bgp")
@@ -948,11 +1984,10 @@ def delete_move_lines(lines_to_add, lines_to_del):
                         lines_to_del_to_app.append((ctx_keys, line))
 
     for (ctx_keys, line) in lines_to_del_to_del:
-        lines_to_del.remove((ctx_keys, line))
+        lines_to_del.discard((ctx_keys, line))
 
     for (ctx_keys, line) in lines_to_del_to_app:
-        lines_to_del.remove((ctx_keys, line))
-        lines_to_del.append((ctx_keys, line))
+        lines_to_del.move_to_end((ctx_keys, line))
 
     return (lines_to_add, lines_to_del)
 
@@ -960,8 +1995,8 @@ def delete_move_lines(lines_to_add, lines_to_del):
 def ignore_delete_re_add_lines(lines_to_add, lines_to_del):
 
     # Quite possibly the most confusing (while accurate) variable names in history
-    lines_to_add_to_del = []
-    lines_to_del_to_del = []
+    lines_to_add_to_del = ConfigLines()
+    lines_to_del_to_del = ConfigLines()
 
     for (ctx_keys, line) in lines_to_del:
         deleted = False
@@ -1260,11 +2295,10 @@ def ignore_delete_re_add_lines(lines_to_add, lines_to_del):
                 + re_acl_pfxlst.group(5)
                 + re_acl_pfxlst.group(6)
             )
-            for ctx in lines_to_add:
-                if ctx[0][0] == tmpline:
-                    lines_to_del_to_del.append((ctx_keys, None))
-                    lines_to_add_to_del.append(((tmpline,), None))
-                    found = True
+            if lines_to_add.has_context((tmpline,)):
+                lines_to_del_to_del.append((ctx_keys, None))
+                lines_to_add_to_del.append(((tmpline,), None))
+                found = True
             """
             If prefix-lists or access-lists are being deleted and
             not added (see comment above), add command with 'no' to
@@ -1365,10 +2399,10 @@ def ignore_delete_re_add_lines(lines_to_add, lines_to_del):
                         lines_to_add_to_del.append((tmp_ctx_keys, line))
 
     for (ctx_keys, line) in lines_to_del_to_del:
-        lines_to_del.remove((ctx_keys, line))
+        lines_to_del.discard((ctx_keys, line))
 
     for (ctx_keys, line) in lines_to_add_to_del:
-        lines_to_add.remove((ctx_keys, line))
+        lines_to_add.discard((ctx_keys, line))
 
     return (lines_to_add, lines_to_del)
 
@@ -1378,7 +2412,7 @@ def ignore_unconfigurable_lines(lines_to_add, lines_to_del):
     There are certain commands that cannot be removed.  Remove
     those commands from lines_to_del.
     """
-    lines_to_del_to_del = []
+    lines_to_del_to_del = ConfigLines()
 
     for (ctx_keys, line) in lines_to_del:
 
@@ -1399,19 +2433,20 @@ def ignore_unconfigurable_lines(lines_to_add, lines_to_del):
             lines_to_del_to_del.append((ctx_keys, line))
 
     for (ctx_keys, line) in lines_to_del_to_del:
-        lines_to_del.remove((ctx_keys, line))
+        lines_to_del.discard((ctx_keys, line))
 
     return (lines_to_add, lines_to_del)
 
 
+@timer.timed("compare")
 def compare_context_objects(newconf, running):
     """
     Create a context diff for the two specified contexts
     """
 
     # Compare the two Config objects to find the lines that we need to add/del
-    lines_to_add = []
-    lines_to_del = []
+    lines_to_add = ConfigLines()
+    lines_to_del = ConfigLines()
     pollist_to_del = []
     seglist_to_del = []
     pceconf_to_del = []
@@ -1547,98 +2582,1465 @@ def compare_context_objects(newconf, running):
             ):
                 pcclist_to_del.append((running_ctx_keys, None))
 
-            # Non-global context
-            elif running_ctx_keys and not any(
-                "address-family" in key for key in running_ctx_keys
-            ):
-                lines_to_del.append((running_ctx_keys, None))
+            # Non-global context
+            elif running_ctx_keys and not any(
+                "address-family" in key for key in running_ctx_keys
+            ):
+                lines_to_del.append((running_ctx_keys, None))
+
+            elif running_ctx_keys and not any("vni" in key for key in running_ctx_keys):
+                lines_to_del.append((running_ctx_keys, None))
+
+            # Global context
+            else:
+                for line in running_ctx.lines:
+                    lines_to_del.append((running_ctx_keys, line))
+
+    # if we have some policies commands to delete, append them to lines_to_del
+    if len(pollist_to_del) > 0:
+        lines_to_del.extend(pollist_to_del)
+
+    # if we have some segment list commands to delete, append them to lines_to_del
+    if len(seglist_to_del) > 0:
+        lines_to_del.extend(seglist_to_del)
+
+    # if we have some pce list commands to delete, append them to lines_to_del
+    if len(pceconf_to_del) > 0:
+        lines_to_del.extend(pceconf_to_del)
+
+    # if we have some pcc list commands to delete, append them to lines_to_del
+    if len(pcclist_to_del) > 0:
+        lines_to_del.extend(pcclist_to_del)
+
+    # Find the lines within each context to add
+    # Find the lines within each context to del
+    for (newconf_ctx_keys, newconf_ctx) in iteritems(newconf.contexts):
+
+        if newconf_ctx_keys in running.contexts:
+            running_ctx = running.contexts[newconf_ctx_keys]
+
+            for line in newconf_ctx.lines:
+                if line not in running_ctx.dlines:
+
+                    # candidate paths can only be added after the policy and segment list,
+                    # so add them to a separate array that is going to be appended at the end
+                    if (
+                        len(newconf_ctx_keys) == 3
+                        and newconf_ctx_keys[0].startswith("segment-routing")
+                        and newconf_ctx_keys[2].startswith("policy ")
+                        and line.startswith("candidate-path ")
+                    ):
+                        candidates_to_add.append((newconf_ctx_keys, line))
+
+                    else:
+                        lines_to_add.append((newconf_ctx_keys, line))
+
+            for line in running_ctx.lines:
+                if line not in newconf_ctx.dlines:
+                    lines_to_del.append((newconf_ctx_keys, line))
+
+    for (newconf_ctx_keys, newconf_ctx) in iteritems(newconf.contexts):
+
+        if newconf_ctx_keys not in running.contexts:
+
+            # candidate paths can only be added after the policy and segment list,
+            # so add them to a separate array that is going to be appended at the end
+            if (
+                len(newconf_ctx_keys) == 4
+                and newconf_ctx_keys[0].startswith("segment-routing")
+                and newconf_ctx_keys[3].startswith("candidate-path")
+            ):
+                candidates_to_add.append((newconf_ctx_keys, None))
+                for line in newconf_ctx.lines:
+                    candidates_to_add.append((newconf_ctx_keys, line))
+
+            else:
+                lines_to_add.append((newconf_ctx_keys, None))
+
+                for line in newconf_ctx.lines:
+                    lines_to_add.append((newconf_ctx_keys, line))
+
+    # if we have some candidate paths commands to add, append them to lines_to_add
+    if len(candidates_to_add) > 0:
+        lines_to_add.extend(candidates_to_add)
+
+    (lines_to_add, lines_to_del) = check_for_exit_vrf(lines_to_add, lines_to_del)
+    (lines_to_add, lines_to_del) = ignore_delete_re_add_lines(
+        lines_to_add, lines_to_del
+    )
+    (lines_to_add, lines_to_del) = delete_move_lines(lines_to_add, lines_to_del)
+    (lines_to_add, lines_to_del) = ignore_unconfigurable_lines(
+        lines_to_add, lines_to_del
+    )
+
+    timer.count("lines_to_add", len(lines_to_add))
+    timer.count("lines_to_del", len(lines_to_del))
+    return (lines_to_add, lines_to_del)
+
+
+class ConfigDiff(object):
+    """
+    The differences between a new and a running configuration, as computed
+    by compare_context_objects()
+
+    lines_to_add and lines_to_del are the (ctx_keys, line) tuples, commands()
+    gives the commands that make the running configuration match the new
+    one, in the order they have to be applied.  lines_to_readd are the lines
+    that the deletions may remove as a side effect, see readd_lines().
+    """
+
+    def __init__(self, lines_to_add, lines_to_del, lines_to_readd=None):
+        self.lines_to_add = lines_to_add
+        self.lines_to_del = lines_to_del
+        self.lines_to_readd = lines_to_readd or []
+
+    def __bool__(self):
+        return bool(self.lines_to_add) or bool(self.lines_to_del)
+
+    __nonzero__ = __bool__
+
+    def deletes(self):
+        """
+        Return the commands removing configuration, each command as the list
+        of its context lines followed by the "no" command
+        """
+        return [
+            lines_to_config(ctx_keys, line, True)
+            for (ctx_keys, line) in self.lines_to_del
+            if line != "!"
+        ]
+
+    def adds(self):
+        """
+        Return the commands adding configuration, each command as the list
+        of its context lines followed by the command
+        """
+        return [
+            lines_to_config(ctx_keys, line, False)
+            for (ctx_keys, line) in self.lines_to_add
+            if line != "!"
+        ]
+
+    def commands(self):
+        """
+        Return the deletions and then the additions, each command as a string
+        with one line per context level
+        """
+        return ["\n".join(cmd) for cmd in self.deletes() + self.adds()]
+
+    def to_dict(self):
+        return {
+            "add": [[list(ctx_keys), line] for (ctx_keys, line) in self.lines_to_add],
+            "delete": [
+                [list(ctx_keys), line] for (ctx_keys, line) in self.lines_to_del
+            ],
+            "commands": self.commands(),
+        }
+
+    patch_version = 2
+
+    def to_patch(self, generation):
+        """
+        Return the diff as a patch for --apply-patch, computed against the
+        running configuration of the given generation (see
+        config_generation()): the (ctx_keys, line, op) changes in the order
+        they are applied and the commands that are sent, the deletions one
+        at a time, the additions and then the lines to put back like the
+        second pass of reload_config() as the lines of the files applied
+        with "vtysh -f"
+        """
+        changes = (
+            [
+                {"ctx_keys": list(ctx_keys), "line": line, "op": "delete"}
+                for (ctx_keys, line) in self.lines_to_del
+            ]
+            + [
+                {"ctx_keys": list(ctx_keys), "line": line, "op": "add"}
+                for (ctx_keys, line) in self.lines_to_add
+            ]
+            + [
+                {"ctx_keys": list(ctx_keys), "line": line, "op": "readd"}
+                for (ctx_keys, line) in self.lines_to_readd
+            ]
+        )
+
+        readd = []
+        if self.lines_to_readd:
+            # the additions are made again, without the "no" commands, like
+            # reload_config() does
+            readd = config_file_lines(
+                (ctx_keys, line, False)
+                for (ctx_keys, line) in self.lines_to_readd
+                + [
+                    (ctx_keys, line)
+                    for (ctx_keys, line) in self.lines_to_add
+                    if not ctx_keys[0].startswith("no ")
+                ]
+            )
+
+        return {
+            "version": self.patch_version,
+            "generation": generation,
+            "changes": changes,
+            "commands": {
+                "delete": self.deletes(),
+                "add": config_file_lines(
+                    (ctx_keys, line, False) for (ctx_keys, line) in self.lines_to_add
+                ),
+                "readd": readd,
+            },
+        }
+
+    @classmethod
+    def from_patch(cls, patch):
+        """
+        Rebuild the diff from the output of to_patch(), checking that it has
+        all that apply_patch() needs
+        """
+        if patch.get("version") != cls.patch_version:
+            raise ValueError("unsupported patch version %r" % patch.get("version"))
+        if not patch.get("generation"):
+            raise ValueError("the patch has no running configuration generation")
+        for key in ("delete", "add", "readd"):
+            if not isinstance(patch["commands"][key], list):
+                raise ValueError("the %s commands of the patch are not a list" % key)
+
+        lines = {"add": [], "delete": [], "readd": []}
+        for change in patch["changes"]:
+            if change["op"] not in lines:
+                raise ValueError("unknown patch operation %r" % change["op"])
+            lines[change["op"]].append((tuple(change["ctx_keys"]), change["line"]))
+        return cls(lines["add"], lines["delete"], lines["readd"])
+
+
+def apply_patch(vtysh, patch, rundir, daemon=""):
+    """
+    Apply a patch computed elsewhere (see ConfigDiff.to_patch()), e.g. loaded
+    from --apply-patch, without marking and comparing the running
+    configuration.  The patch is refused unless the running configuration of
+    `daemon` (of all daemons if empty) is still the generation it was
+    computed from.  The recorded commands are then sent as they are: the
+    deletions one by one, a rejected one being retried like in
+    delete_lines(), the additions and the lines to put back with "vtysh -f".
+
+    Returns False if some of the changes could not be applied.
+    """
+    generation = running_generation(vtysh, daemon)
+    if generation != patch["generation"]:
+        log.error(
+            "The running configuration (%s) is not the one the patch was "
+            "computed from (%s)",
+            generation,
+            patch["generation"],
+        )
+        return False
+
+    commands = patch["commands"]
+    if not commands["delete"] and not commands["add"]:
+        log.info("No changes to apply")
+        return True
+
+    timer.count("lines_to_add", len(commands["add"]))
+    timer.count("lines_to_del", len(commands["delete"]))
+
+    reload_ok = True
+    if commands["delete"]:
+        with timer.phase("delete"):
+            session = vtysh.session()
+            for cmd in commands["delete"]:
+                if delete_command(session, cmd) is None:
+                    reload_ok = False
+            session.close()
+            log.info(
+                "vtysh session: %d commands executed, %d failed",
+                session.executed,
+                session.failed,
+            )
+
+    for key in ("add", "readd"):
+        if commands[key] and not apply_file_lines(vtysh, rundir, commands[key]):
+            reload_ok = False
+    return reload_ok
+
+
+def readd_lines(newconf, running, lines_to_del):
+    """
+    Return the (ctx_keys, line) tuples that removing lines_to_del may remove
+    as a side effect, e.g. "no neighbor 1.1.1.1 remote-as 50" also removes
+    the other lines of the neighbor: the lines that are kept unchanged in the
+    contexts lines are deleted from and in their sub-contexts.  The second
+    pass of reload_config() finds them by comparing again, a patch has to
+    carry them.
+    """
+    touched = set(ctx_keys for (ctx_keys, line) in lines_to_del if line is not None)
+    if not touched:
+        return []
+
+    lines = []
+    for (ctx_keys, ctx) in iteritems(newconf.contexts):
+        if not any(ctx_keys[:n] in touched for n in range(1, len(ctx_keys) + 1)):
+            continue
+        old = running.contexts.get(ctx_keys)
+        if old is not None:
+            lines.extend((ctx_keys, line) for line in ctx.lines if line in old.dlines)
+    return lines
+
+
+def compare_marked_text(new_text, running_text):
+    """
+    Compare two configurations that were already marked with "vtysh -m" and
+    return a ConfigDiff.  new_text is normalized like a configuration file,
+    running_text like "show running-config" output.  No vtysh is needed, so
+    this can be used as a library.
+    """
+    newconf = Config(None)
+    newconf.load_contexts(Config.file_lines(new_text.splitlines()))
+
+    running = Config(None)
+    running.load_contexts(Config.show_running_lines(running_text.splitlines()))
+
+    (lines_to_add, lines_to_del) = compare_context_objects(newconf, running)
+    return ConfigDiff(
+        lines_to_add, lines_to_del, readd_lines(newconf, running, lines_to_del)
+    )
+
+
+# The daemon owning the top-level contexts starting with these keywords, more
+# specific keywords first.  Contexts that are not listed here are either
+# zebra's or shared by several daemons (interface, vrf, route-map, prefix and
+# access lists, logging, ...); they are owned by None.
+context_daemons = (
+    ("router bgp ", "bgpd"),
+    ("bgp ", "bgpd"),
+    ("ip as-path ", "bgpd"),
+    ("ip community-list ", "bgpd"),
+    ("ip extcommunity-list ", "bgpd"),
+    ("ip large-community-list ", "bgpd"),
+    ("rpki", "bgpd"),
+    ("router ospf6", "ospf6d"),
+    ("router ospf", "ospfd"),
+    ("router isis ", "isisd"),
+    ("router openfabric ", "fabricd"),
+    ("router ripng", "ripngd"),
+    ("router rip", "ripd"),
+    ("router eigrp ", "eigrpd"),
+    ("router babel", "babeld"),
+    ("mpls ldp", "ldpd"),
+    ("l2vpn ", "ldpd"),
+    ("ip route ", "staticd"),
+    ("ipv6 route ", "staticd"),
+    ("bfd", "bfdd"),
+    ("pbr-map ", "pbrd"),
+    ("ip pim ", "pimd"),
+    ("ip msdp ", "pimd"),
+)
+
+# Order in which --parallel reloads the daemons.  Each stage is finished
+# before the next one starts, the daemons within a stage are reloaded
+# concurrently.  The additions to the shared and zebra contexts (None) are
+# made first so that interfaces, VRFs, route-maps and lists exist before the
+# routing daemons refer to them, their deletions last so that the routing
+# daemons no longer refer to them; daemons that are not listed here are
+# reloaded in the last stage.
+reload_stages = (
+    (None,),
+    ("staticd", "bfdd"),
+)
+
+
+def context_daemon(ctx_keys):
+    """
+    Return the name of the daemon owning a context, None for the contexts
+    that are zebra's or shared by several daemons
+    """
+    for (keyword, daemon) in context_daemons:
+        if ctx_keys[0].startswith(keyword):
+            return daemon
+    return None
+
+
+def reload_parallel(vtysh, newconf, rundir, contexts=None, reload=None, running=None):
+    """
+    Reload each daemon on its own, fetching, comparing and applying the
+    configuration of the daemons of a stage (see reload_stages) concurrently.
+    When `contexts` is given, only those top-level contexts are compared and
+    only the daemons owning them are reloaded.  Each daemon is reloaded with
+    `reload` (reload_config() by default), comparing first with its part of
+    the Config `running` if it is given.
+
+    The shared contexts are added to before the first stage and reloaded,
+    i.e. deleted from, after the last one, see reload_stages.
+
+    Returns False if some of the changes could not be applied.
+    """
+    if reload is None:
+        reload = reload_config
+    running_daemons = vtysh.daemons()
+    owners = set(context_daemon(ctx_keys) for ctx_keys in newconf.contexts)
+
+    stages = []
+    staged = set()
+    for stage in reload_stages:
+        stages.append([d for d in stage if d is None or d in running_daemons])
+        staged.update(stage)
+    # zebra, vrrpd, ... only have shared contexts, reloaded with None
+    owning = set(daemon for (_, daemon) in context_daemons)
+    stages.append([d for d in running_daemons if d in owning and d not in staged])
+
+    if contexts is not None:
+        involved = set(context_daemon((key,)) for key in contexts)
+        stages = [[d for d in stage if d in involved] for stage in stages]
+
+    reload_ok = True
+    for daemon in sorted(d for d in owners if d and d not in running_daemons):
+        log.error("%s is not running, cannot reload its configuration", daemon)
+        reload_ok = False
+
+    if None in stages[0]:
+        log.info("Adding to the shared configuration")
+        shared = load_running(vtysh, "", [None], contexts, running)
+        lines_to_add = compare_context_objects(newconf.filtered([None]), shared)[0]
+        # the prefix-list and access-list deletions are made as additions
+        lines_to_add = [
+            (ctx_keys, line)
+            for (ctx_keys, line) in lines_to_add
+            if line is not None or not ctx_keys[0].startswith("no ")
+        ]
+        if lines_to_add and not add_lines(vtysh, rundir, lines_to_add):
+            log.error("Adding to the shared configuration failed")
+            reload_ok = False
+        stages = [[d for d in stages[0] if d is not None]] + stages[1:] + [[None]]
+
+    workers = max([1] + [len(stage) for stage in stages])
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for stage in stages:
+            futures = {}
+            for daemon in stage:
+                log.info("Reloading %s", daemon or "shared configuration")
+                futures[daemon] = pool.submit(
+                    reload,
+                    vtysh,
+                    newconf.filtered([daemon]),
+                    rundir,
+                    daemon or "",
+                    [daemon],
+                    contexts,
+                    # the shared contexts changed since they were added to
+                    running if daemon is not None else None,
+                )
+
+            for (daemon, future) in iteritems(futures):
+                if not future.result():
+                    log.error("Reloading %s failed", daemon or "shared configuration")
+                    reload_ok = False
+    finally:
+        pool.shutdown()
+
+    return reload_ok
+
+
+def config_digests(config):
+    """
+    Return the digest of each context of a Config, by context keys joined
+    with newlines
+    """
+    return dict(
+        ("\n".join(ctx_keys), ctx.digest())
+        for (ctx_keys, ctx) in iteritems(config.contexts)
+    )
+
+
+def config_generation(text):
+    """
+    Return a hash of the text of a running configuration, as shown by "show
+    running-config" with or without its header, used to tell if it was
+    changed
+    """
+    digest = hashlib.sha256()
+    for line in Config.show_running_lines(text.splitlines()):
+        digest.update(line.encode("UTF-8") + b"\n")
+    return digest.hexdigest()
+
+
+def running_generation(vtysh, daemon=""):
+    """
+    Return the generation of the (unmarked) running configuration of
+    `daemon` (of all daemons if empty), see config_generation()
+    """
+    return config_generation(vtysh.show_running(daemon))
+
+
+def owning_daemons(contexts):
+    """
+    Return the daemons whose running configuration has to be fetched to
+    compare the top-level `contexts`, None if it is the whole running
+    configuration because some of them are shared by several daemons
+    """
+    if contexts is None:
+        return None
+    owners = set(context_daemon((key,)) for key in contexts)
+    if None in owners:
+        return None
+    return sorted(owners)
+
+
+def refresh_running(vtysh, running, contexts):
+    """
+    Return the Config `running` with its top-level `contexts` fetched again,
+    only from the daemons owning them when possible, or the whole running
+    configuration if `running` or `contexts` is None
+    """
+    if running is None or contexts is None:
+        return load_running(vtysh)
+
+    fresh = Config(vtysh)
+    daemons = owning_daemons(contexts)
+    for daemon in daemons or [""]:
+        owned = [daemon] if daemon else None
+        fresh.contexts.update(load_running(vtysh, daemon, owned, contexts).contexts)
+
+    # keep the order of the contexts, the deletions are made in that order
+    config = Config(vtysh)
+    for ctx_keys in running.contexts:
+        if ctx_keys[0] not in contexts:
+            config.contexts[ctx_keys] = running.contexts[ctx_keys]
+            continue
+        for fresh_keys in list(fresh.contexts):
+            if fresh_keys[0] == ctx_keys[0]:
+                config.contexts[fresh_keys] = fresh.contexts.pop(fresh_keys)
+    config.contexts.update(fresh.contexts)
+    return config
+
+
+def reload_incremental(
+    vtysh, newconf, rundir, state, parallel=False, reload=None, keep_running=False
+):
+    """
+    Reload only the top-level contexts whose digest changed since the last
+    successful reload, as recorded in the `state` dict, which is updated
+    after a successful reload and emptied after a failed one.  This is only
+    done if the running configuration is still the one that reload left,
+    otherwise (or with an empty state) everything is compared.
+
+    Unless some of the changed contexts are shared by several daemons (see
+    context_daemon()), only the running configuration of the daemons owning
+    them is fetched, marked and compared.  The contexts are reloaded with
+    `reload` (reload_config() by default).
+
+    With `keep_running`, the parsed running configuration is also kept in
+    the state, as "running", and the first pass compares with it rather than
+    fetching it again.  After the reload, only the changed contexts are
+    fetched again to keep it up to date.  The whole running configuration is
+    only fetched when it changed since the last reload.
+
+    Returns False if some of the changes could not be applied.
+    """
+    digests = config_digests(newconf)
+    contexts = None
+    running = None
+
+    if state:
+        if state.get("generation") != running_generation(vtysh):
+            log.info(
+                "Running configuration changed since last reload, doing a full reload"
+            )
+        else:
+            old_digests = state.get("contexts", {})
+            changed = set(
+                key for key in digests if old_digests.get(key) != digests[key]
+            )
+            changed.update(key for key in old_digests if key not in digests)
+
+            # compare whole top-level contexts, a change in one part of e.g.
+            # "router bgp" can have an effect on its address-families
+            contexts = set(key.split("\n")[0] for key in changed)
+            log.info(
+                "%d of %d contexts changed since last reload",
+                len(changed),
+                len(digests),
+            )
+            if not contexts:
+                return True
+            newconf = newconf.subset(contexts)
+            running = state.get("running")
+
+    if keep_running and running is None:
+        running = load_running(vtysh)
+
+    if reload is None:
+        reload = reload_config
+    daemons = owning_daemons(contexts)
+    if parallel:
+        reload_ok = reload_parallel(vtysh, newconf, rundir, contexts, reload, running)
+    elif daemons is None:
+        reload_ok = reload(vtysh, newconf, rundir, contexts=contexts, running=running)
+    else:
+        reload_ok = True
+        for daemon in daemons:
+            log.info("Reloading the changed contexts of %s", daemon)
+            if not reload(
+                vtysh,
+                newconf.filtered([daemon]),
+                rundir,
+                daemon,
+                [daemon],
+                contexts,
+                running,
+            ):
+                reload_ok = False
+
+    state.clear()
+    if reload_ok:
+        if keep_running:
+            state["running"] = refresh_running(vtysh, running, contexts)
+        state["generation"] = running_generation(vtysh)
+        state["contexts"] = digests
+    return reload_ok
+
+
+def load_reload_state(state_file):
+    """
+    Return the state of the last --incremental reload saved in state_file,
+    an empty one if there is none
+    """
+    try:
+        with open(state_file, "r") as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError) as e:
+        log.info(
+            "No usable reload state in %s (%s), doing a full reload", state_file, e
+        )
+        return {}
+
+
+def save_reload_state(state_file, state):
+    """
+    Save the state of an --incremental reload to state_file, or remove it
+    if the state is empty
+    """
+    if not state:
+        if os.path.exists(state_file):
+            os.unlink(state_file)
+        return
+
+    with open(state_file + ".tmp", "w") as fh:
+        json.dump(state, fh)
+    os.rename(state_file + ".tmp", state_file)
+
+
+def write_reload_file(rundir, lines_to_configure):
+    """
+    Write the commands to a new file in rundir, to be applied with "vtysh -f"
+    """
+    random_string = "".join(
+        random.SystemRandom().choice(string.ascii_uppercase + string.digits)
+        for _ in range(6)
+    )
+
+    filename = rundir + "/reload-%s.txt" % random_string
+    log.info("%s content\n%s" % (filename, pformat(lines_to_configure)))
+
+    with open(filename, "w") as fh:
+        for line in lines_to_configure:
+            fh.write(line + "\n")
+    return filename
+
+
+def load_running(vtysh, daemon="", daemons=None, contexts=None, running=None):
+    """
+    Return the running configuration of `daemon` (of all daemons if empty),
+    with only the contexts owned by `daemons` and the top-level `contexts`
+    when they are given.  The running configuration is only fetched if it is
+    not given as the Config `running`.
+    """
+    if running is None:
+        running = Config(vtysh)
+        running.load_from_show_running(daemon)
+    if daemons is not None:
+        running = running.filtered(daemons)
+    if contexts is not None:
+        running = running.subset(contexts)
+    return running
+
+
+def transaction_deletions(vtysh, lines_to_del):
+    """
+    Return lines_to_del if the command table (see ConfigMarker.deletion())
+    says that vtysh accepts all of their "no" commands as they are, so that
+    they can be put in a transaction file.  Returns None if there is no
+    command table or one of them may be rejected: such deletions have to be
+    run one by one by delete_lines(), which retries them until vtysh accepts
+    them.
+    """
+    if vtysh.marker is None:
+        return None
+
+    resolved = []
+    for (ctx_keys, line) in lines_to_del:
+        if line == "!":
+            continue
+        found = vtysh.marker.deletion(lines_to_config(ctx_keys, line, True))
+        if found is None or found[1]:
+            return None
+        resolved.append((ctx_keys, line))
+    return resolved
+
+
+def reload_transaction(
+    vtysh, newconf, rundir, daemon="", daemons=None, contexts=None, running=None
+):
+    """
+    Like reload_config(), but apply the changes as one configuration
+    transaction (see Vtysh.transaction()), so that the daemons validate and
+    commit all of their northbound changes at once instead of one command at
+    a time.  The deletions are part of the transaction when the command table
+    says that vtysh accepts all of them as they are (see
+    transaction_deletions()), otherwise they are run one by one first, and
+    only the additions are applied in the transaction.  If the transaction
+    fails, fall back to reload_config().
+
+    Returns False if some of the changes could not be applied.
+    """
+    reload_ok = True
+    running = load_running(vtysh, daemon, daemons, contexts, running)
+    diff = ConfigDiff(*compare_context_objects(newconf, running))
+    if not diff:
+        log.info("No changes to apply")
+        return True
+
+    deletions = transaction_deletions(vtysh, diff.lines_to_del)
+    if deletions is None:
+        deletions = []
+        if diff.lines_to_del and not delete_lines(vtysh, diff.lines_to_del):
+            reload_ok = False
+
+    commands = config_file_lines(
+        [(ctx_keys, line, True) for (ctx_keys, line) in deletions]
+        + [(ctx_keys, line, False) for (ctx_keys, line) in diff.lines_to_add]
+    )
+    if commands:
+        filename = write_reload_file(rundir, commands)
+        start = time.time()
+        try:
+            commits = vtysh.transaction(filename)
+        except VtyshException as e:
+            # Part of the file may have been applied, e.g. the commands that
+            # are not converted to the northbound: reload_config() compares
+            # with the running configuration again and only applies what is
+            # still missing.
+            log.warning(
+                "Transaction failed, applying the changes one by one\n%s" % e.args
+            )
+            return reload_config(vtysh, newconf, rundir, daemon, daemons, contexts)
+        finally:
+            os.unlink(filename)
+
+        log.info(
+            "Applied %d changes in one transaction in %.3fs",
+            len(deletions) + len(diff.lines_to_add),
+            time.time() - start,
+        )
+        for (name, elapsed) in sorted(iteritems(commits)):
+            log.info("Commit in %s took %.3fs", name, elapsed)
+
+    # Put back what the deletions removed as a side effect, see the second
+    # pass of reload_config()
+    running = load_running(vtysh, daemon, daemons, contexts)
+    lines_to_add = compare_context_objects(newconf, running)[0]
+    if lines_to_add and not add_lines(
+        vtysh,
+        rundir,
+        [
+            (ctx_keys, line)
+            for (ctx_keys, line) in list(lines_to_add) + list(diff.lines_to_add)
+            if not ctx_keys[0].startswith("no ")
+        ],
+    ):
+        reload_ok = False
+    return reload_ok
+
+
+def delete_lines(vtysh, lines_to_del):
+    """
+    Run the "no" commands removing lines_to_del, the (ctx_keys, line)
+    tuples from compare_context_objects(), one at a time.  A command that is
+    rejected is retried without its last word until it is accepted.  With a
+    command table (see --mark-table), a rejected command is retried in the
+    form that the table says vtysh accepts, if it knows one, skipping the
+    retries in between; the command as it is is always tried first.
+
+    Returns False if some of the lines could not be removed.
+    """
+    ok = True
+    saved = 0
+    with timer.phase("delete"):
+        session = vtysh.session()
+
+        for (ctx_keys, line) in lines_to_del:
+
+            if line == "!":
+                continue
+
+            # 'no' commands are tricky, we can't just put them in a file and
+            # vtysh -f that file. See delete_command() for an explanation
+            # of their quirks
+            cmd = lines_to_config(ctx_keys, line, True)
+
+            resolved = None
+            if vtysh.marker is not None:
+                resolved = vtysh.marker.deletion(cmd)
+                if resolved is not None and resolved[1] < 2:
+                    # no retry to skip
+                    resolved = None
+
+            accepted = delete_command(
+                session, cmd, resolved[0] if resolved else None
+            )
+            if accepted is None:
+                ok = False
+            elif resolved and accepted == resolved[0]:
+                saved += resolved[1] - 1
+
+        session.close()
+        log.info(
+            "vtysh session: %d commands executed, %d failed",
+            session.executed,
+            session.failed,
+        )
+        if saved:
+            log.info("%d deletion retries avoided with the command table", saved)
+            timer.count("delete_retries_saved", saved)
+    return ok
+
+
+def delete_command(session, cmd, shorter=None):
+    """
+    Run a "no" command, the list of its context lines followed by the
+    command, in a vtysh session.  A command that is rejected is retried
+    without its last word until it is accepted; if it is given, the
+    `shorter` form of the command is tried right after the first failure.
+
+    Returns the command that was accepted, None if none was.
+    """
+    original_cmd = cmd
+    cmd = list(cmd)
+
+    # Some commands in frr are picky about taking a "no" of the entire line.
+    # OSPF is bad about this, you can't "no" the entire line, you have to "no"
+    # only the beginning. If we hit one of these command an exception will be
+    # thrown.  Catch it and remove the last word from cmd and try again.
+    #
+    # Example:
+    # frr(config-if)# ip ospf authentication message-digest 1.1.1.1
+    # frr(config-if)# no ip ospf authentication message-digest 1.1.1.1
+    #  % Unknown command.
+    # frr(config-if)# no ip ospf authentication message-digest
+    #  % Unknown command.
+    # frr(config-if)# no ip ospf authentication
+    # frr(config-if)#
+
+    stdouts = []
+    while True:
+        try:
+            session(cmd, stdouts)
+
+        except VtyshException:
+
+            # - Pull the last entry from cmd (this would be
+            #   'no ip ospf authentication message-digest 1.1.1.1' in
+            #   our example above
+            # - Split that last entry by whitespace and drop the last word
+            log.info("Failed to execute %s", " ".join(cmd))
+            timer.count("delete_retries")
+            if shorter is not None:
+                log.info('Retrying with "%s"', " ".join(shorter))
+                cmd = list(shorter)
+                shorter = None
+                continue
+
+            last_arg = cmd[-1].split(" ")
+
+            if len(last_arg) <= 2:
+                log.error(
+                    '"%s" we failed to remove this command',
+                    " -- ".join(original_cmd),
+                )
+                # Log first error msg for original_cmd
+                if stdouts:
+                    log.error(stdouts[0])
+                return None
+
+            new_last_arg = last_arg[0:-1]
+            cmd[-1] = " ".join(new_last_arg)
+        else:
+            log.info('Executed "%s"', " ".join(cmd))
+            return cmd
+
+
+def add_lines(vtysh, rundir, lines_to_add):
+    """
+    Apply lines_to_add, the (ctx_keys, line) tuples from
+    compare_context_objects(), with one "vtysh -f" of a temporary file in
+    rundir.
+
+    Returns False if the file could not be applied.
+    """
+    lines_to_configure = config_file_lines(
+        (ctx_keys, line, False) for (ctx_keys, line) in lines_to_add
+    )
+    if not lines_to_configure:
+        return True
+    return apply_file_lines(vtysh, rundir, lines_to_configure)
+
+
+def apply_file_lines(vtysh, rundir, lines_to_configure):
+    """
+    Apply the lines of a configuration file with one "vtysh -f" of a
+    temporary file in rundir.
+
+    Returns False if the file could not be applied.
+    """
+    filename = write_reload_file(rundir, lines_to_configure)
+    try:
+        vtysh.exec_file(filename)
+    except VtyshException as e:
+        log.warning("frr-reload.py failed due to\n%s" % e.args)
+        return False
+    finally:
+        os.unlink(filename)
+    return True
+
+
+def reload_config(
+    vtysh, newconf, rundir, daemon="", daemons=None, contexts=None, running=None
+):
+    """
+    Apply the differences between newconf and the running configuration of
+    `daemon` (of all daemons if empty).  When `daemons` is given, only the
+    contexts owned by those daemons (see context_daemon()) are compared, when
+    `contexts` is given only those top-level contexts are.  The first pass
+    compares with the Config `running` if it is given, instead of fetching
+    the running configuration.
+
+    Returns False if some of the changes could not be applied.
+    """
+    reload_ok = True
+
+    # This looks a little odd but we have to do this twice...here is why
+    # If the user had this running bgp config:
+    #
+    # router bgp 10
+    #  neighbor 1.1.1.1 remote-as 50
+    #  neighbor 1.1.1.1 route-map FOO out
+    #
+    # and this config in the newconf config file
+    #
+    # router bgp 10
+    #  neighbor 1.1.1.1 remote-as 999
+    #  neighbor 1.1.1.1 route-map FOO out
+    #
+    #
+    # Then the script will do
+    # - no neighbor 1.1.1.1 remote-as 50
+    # - neighbor 1.1.1.1 remote-as 999
+    #
+    # The problem is the "no neighbor 1.1.1.1 remote-as 50" will also remove
+    # the "neighbor 1.1.1.1 route-map FOO out" line...so we compare the
+    # configs again to put this line back.
+
+    # There are many keywords in FRR that can only appear one time under
+    # a context, take "bgp router-id" for example. If the config that we are
+    # reloading against has the following:
+    #
+    # router bgp 10
+    #   bgp router-id 1.1.1.1
+    #   bgp router-id 2.2.2.2
+    #
+    # The final config needs to contain "bgp router-id 2.2.2.2". On the
+    # first pass we will add "bgp router-id 2.2.2.2" but then on the second
+    # pass we will see that "bgp router-id 1.1.1.1" is missing and add that
+    # back which cancels out the "bgp router-id 2.2.2.2". The fix is for the
+    # second pass to include all of the "adds" from the first pass.
+    lines_to_add_first_pass = []
+    first_running = running
+
+    for x in range(2):
+        running = load_running(
+            vtysh, daemon, daemons, contexts, first_running if x == 0 else None
+        )
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Running Frr Config (Pass #%d)\n%s", x, running.get_lines())
+
+        (lines_to_add, lines_to_del) = compare_context_objects(newconf, running)
+
+        if x == 0:
+            lines_to_add_first_pass = lines_to_add
+        else:
+            lines_to_add.extend(lines_to_add_first_pass)
+
+        # Only do deletes on the first pass. The reason being if we
+        # configure a bgp neighbor via "neighbor swp1 interface" FRR
+        # will automatically add:
+        #
+        # interface swp1
+        #  ipv6 nd ra-interval 10
+        #  no ipv6 nd suppress-ra
+        # !
+        #
+        # but those lines aren't in the config we are reloading against so
+        # on the 2nd pass they will show up in lines_to_del.  This could
+        # apply to other scenarios as well where configuring FOO adds BAR
+        # to the config.
+        if lines_to_del and x == 0:
+            if not delete_lines(vtysh, lines_to_del):
+                reload_ok = False
+
+        if lines_to_add:
+            # Don't run "no" commands twice since they can error
+            # out the second time due to first deletion
+            if x == 1:
+                lines_to_add = [
+                    (ctx_keys, line)
+                    for (ctx_keys, line) in lines_to_add
+                    if not ctx_keys[0].startswith("no ")
+                ]
+            if not add_lines(vtysh, rundir, lines_to_add):
+                reload_ok = False
+
+    return reload_ok
+
+
+def reload_with_args(vtysh, newconf, args, incremental=False, state=None):
+    """
+    Apply newconf the way the command line arguments ask for, see --reload,
+    and make the changes persistent.  With `incremental`, the state of the
+    incremental reloads is saved in a file in args.rundir, unless it is kept
+    in memory in the `state` dict, with the running configuration (see
+    reload_incremental()).
 
-            elif running_ctx_keys and not any("vni" in key for key in running_ctx_keys):
-                lines_to_del.append((running_ctx_keys, None))
+    Returns False if some of the changes could not be applied.
+    """
+    # We will not be able to do anything
+    if not vtysh.is_config_available():
+        return False
 
-            # Global context
-            else:
-                for line in running_ctx.lines:
-                    lines_to_del.append((running_ctx_keys, line))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("New Frr Config\n%s", newconf.get_lines())
 
-    # if we have some policies commands to delete, append them to lines_to_del
-    if len(pollist_to_del) > 0:
-        lines_to_del.extend(pollist_to_del)
+    reload_ok = True
+    reload = reload_transaction if args.transaction else reload_config
+    if incremental and state is not None:
+        if not reload_incremental(
+            vtysh, newconf, args.rundir, state, args.parallel, reload, True
+        ):
+            reload_ok = False
+    elif incremental:
+        if args.pathspace:
+            state_file = "frr-reload-%s.state" % args.pathspace
+        else:
+            state_file = "frr-reload.state"
+        state_file = os.path.join(args.rundir, state_file)
+        state = load_reload_state(state_file)
+        if not reload_incremental(
+            vtysh, newconf, args.rundir, state, args.parallel, reload
+        ):
+            reload_ok = False
+        save_reload_state(state_file, state)
+    elif args.parallel:
+        if not reload_parallel(vtysh, newconf, args.rundir, reload=reload):
+            reload_ok = False
+    elif not reload(vtysh, newconf, args.rundir, args.daemon):
+        reload_ok = False
 
-    # if we have some segment list commands to delete, append them to lines_to_del
-    if len(seglist_to_del) > 0:
-        lines_to_del.extend(seglist_to_del)
+    # Make these changes persistent
+    target = os.path.join(args.confdir, args.pathspace or "", "frr.conf")
+    if args.overwrite or (not args.daemon and args.filename != target):
+        vtysh("write")
 
-    # if we have some pce list commands to delete, append them to lines_to_del
-    if len(pceconf_to_del) > 0:
-        lines_to_del.extend(pceconf_to_del)
+    return reload_ok
 
-    # if we have some pcc list commands to delete, append them to lines_to_del
-    if len(pcclist_to_del) > 0:
-        lines_to_del.extend(pcclist_to_del)
 
-    # Find the lines within each context to add
-    # Find the lines within each context to del
-    for (newconf_ctx_keys, newconf_ctx) in iteritems(newconf.contexts):
+class FileWatcher(object):
+    """
+    Wait for a file to be written or replaced.  The directory of the file is
+    watched with inotify, so that files written to a temporary file and
+    renamed are seen as well; without inotify, the file is polled.
+    """
 
-        if newconf_ctx_keys in running.contexts:
-            running_ctx = running.contexts[newconf_ctx_keys]
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
 
-            for line in newconf_ctx.lines:
-                if line not in running_ctx.dlines:
+    # struct inotify_event, without the name
+    event_struct = struct.Struct("iIII")
 
-                    # candidate paths can only be added after the policy and segment list,
-                    # so add them to a separate array that is going to be appended at the end
-                    if (
-                        len(newconf_ctx_keys) == 3
-                        and newconf_ctx_keys[0].startswith("segment-routing")
-                        and newconf_ctx_keys[2].startswith("policy ")
-                        and line.startswith("candidate-path ")
-                    ):
-                        candidates_to_add.append((newconf_ctx_keys, line))
+    def __init__(self, filename, poll_interval=1.0):
+        self.dirname = os.path.dirname(os.path.abspath(filename))
+        self.basename = os.fsencode(os.path.basename(filename))
+        self.filename = filename
+        self.poll_interval = poll_interval
+        self.fd = None
+        self.last_stat = self._stat()
 
-                    else:
-                        lines_to_add.append((newconf_ctx_keys, line))
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            log.info("inotify not available (%s), polling %s", e, filename)
+            return
+        if fd < 0:
+            log.info("inotify_init1: %s", os.strerror(ctypes.get_errno()))
+            return
 
-            for line in running_ctx.lines:
-                if line not in newconf_ctx.dlines:
-                    lines_to_del.append((newconf_ctx_keys, line))
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(fd, os.fsencode(self.dirname), mask) < 0:
+            log.info("inotify_add_watch: %s", os.strerror(ctypes.get_errno()))
+            os.close(fd)
+            return
+        self.fd = fd
 
-    for (newconf_ctx_keys, newconf_ctx) in iteritems(newconf.contexts):
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
 
-        if newconf_ctx_keys not in running.contexts:
+    def _stat(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def wait(self, timeout=None):
+        """
+        Wait up to `timeout` seconds (forever if None) for the file to be
+        written, return the number of writes seen, 0 on timeout
+        """
+        if self.fd is None:
+            return self._poll(timeout)
+
+        deadline = None if timeout is None else time.time() + timeout
+        count = 0
+        while not count:
+            if deadline is None:
+                remaining = None
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+            if not select.select([self.fd], [], [], remaining)[0]:
+                break
+
+            # the events of the other files in the directory are ignored
+            data = os.read(self.fd, 65536)
+            offset = 0
+            while offset < len(data):
+                (_, _, _, length) = self.event_struct.unpack_from(data, offset)
+                offset += self.event_struct.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+                if name == self.basename:
+                    count += 1
+        return count
+
+    def _poll(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            current = self._stat()
+            if current != self.last_stat:
+                self.last_stat = current
+                return 1
+
+            if deadline is None:
+                time.sleep(self.poll_interval)
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return 0
+            time.sleep(min(self.poll_interval, remaining))
 
-            # candidate paths can only be added after the policy and segment list,
-            # so add them to a separate array that is going to be appended at the end
-            if (
-                len(newconf_ctx_keys) == 4
-                and newconf_ctx_keys[0].startswith("segment-routing")
-                and newconf_ctx_keys[3].startswith("candidate-path")
-            ):
-                candidates_to_add.append((newconf_ctx_keys, None))
-                for line in newconf_ctx.lines:
-                    candidates_to_add.append((newconf_ctx_keys, line))
 
+class WatchStatus(object):
+    """
+    The state of --watch, reported as JSON to every client connecting to
+    the status socket
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = "starting"
+        self.queue_depth = 0
+        self.applies = 0
+        self.failures = 0
+        self.last_apply = None
+        self.last_apply_latency = None
+        self.last_error = None
+        self.server = None
+
+    def update(self, **kwargs):
+        with self.lock:
+            for (name, value) in iteritems(kwargs):
+                setattr(self, name, value)
+
+    def queued(self, writes):
+        with self.lock:
+            self.queue_depth += writes
+
+    def applied(self, ok, latency, error=None):
+        with self.lock:
+            self.state = "idle"
+            self.queue_depth = 0
+            self.applies += 1
+            if not ok:
+                self.failures += 1
+                self.last_error = error
+            self.last_apply = time.time()
+            self.last_apply_latency = latency
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "pid": os.getpid(),
+                "state": self.state,
+                "queue_depth": self.queue_depth,
+                "applies": self.applies,
+                "failures": self.failures,
+                "last_apply": self.last_apply,
+                "last_apply_latency": self.last_apply_latency,
+                "last_error": self.last_error,
+            }
+
+    def serve(self, path):
+        """
+        Listen on a unix socket at `path` in a background thread
+        """
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(8)
+
+        thread = threading.Thread(
+            target=self._serve, args=(self.server,), name="status"
+        )
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self, server):
+        while True:
+            try:
+                conn = server.accept()[0]
+            except (OSError, socket.error):
+                # closed
+                return
+            try:
+                conn.sendall(json.dumps(self.to_dict()).encode("UTF-8") + b"\n")
+            except (OSError, socket.error):
+                pass
+            finally:
+                conn.close()
+
+    def close(self):
+        if self.server is not None:
+            path = self.server.getsockname()
+            # wake up the thread blocked in accept()
+            try:
+                self.server.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+            self.server.close()
+            self.server = None
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+def watch_config(vtysh, args, status):
+    """
+    Apply args.filename, then apply it again each time it is written,
+    waiting for args.debounce seconds without writes first so that a burst
+    of writes is applied once.  The running configuration is kept in memory
+    between the applies, and only the contexts that changed since the
+    previous apply are compared (see reload_incremental()).  An apply that
+    fails is reported, the next one compares everything.  Runs until
+    interrupted.
+    """
+    watcher = FileWatcher(args.filename)
+    state = {}
+    try:
+        while True:
+            status.update(state="applying")
+            start = time.time()
+            error = None
+            newconf = Config(vtysh)
+            try:
+                newconf.load_from_file(args.filename)
+                reload_ok = reload_with_args(
+                    vtysh, newconf, args, incremental=True, state=state
+                )
+                if not reload_ok:
+                    error = "some of the changes could not be applied"
+            except Exception as e:
+                log.debug("Applying %s failed", args.filename, exc_info=True)
+                state.clear()
+                reload_ok = False
+                error = str(e) or e.__class__.__name__
+            latency = time.time() - start
+            status.applied(reload_ok, latency, error)
+            if reload_ok:
+                log.info("Applied %s in %.3fs", args.filename, latency)
             else:
-                lines_to_add.append((newconf_ctx_keys, None))
+                log.error("Applying %s failed: %s", args.filename, error)
 
-                for line in newconf_ctx.lines:
-                    lines_to_add.append((newconf_ctx_keys, line))
+            status.update(state="idle")
+            writes = watcher.wait()
+            status.update(state="debouncing")
+            while writes:
+                status.queued(writes)
+                writes = watcher.wait(args.debounce)
+    finally:
+        watcher.close()
 
-    # if we have some candidate paths commands to add, append them to lines_to_add
-    if len(candidates_to_add) > 0:
-        lines_to_add.extend(candidates_to_add)
 
-    (lines_to_add, lines_to_del) = check_for_exit_vrf(lines_to_add, lines_to_del)
-    (lines_to_add, lines_to_del) = ignore_delete_re_add_lines(
-        lines_to_add, lines_to_del
-    )
-    (lines_to_add, lines_to_del) = delete_move_lines(lines_to_add, lines_to_del)
-    (lines_to_add, lines_to_del) = ignore_unconfigurable_lines(
-        lines_to_add, lines_to_del
+def pathspace_names(confdir, pattern):
+    """
+    Return the names of the pathspaces whose directory in confdir matches
+    the shell pattern
+    """
+    try:
+        entries = os.listdir(confdir)
+    except OSError:
+        return []
+    return sorted(
+        name
+        for name in entries
+        if fnmatch.fnmatch(name, pattern)
+        and os.path.isdir(os.path.join(confdir, name))
     )
 
-    return (lines_to_add, lines_to_del)
+
+default_log_file = "/var/log/frr/frr-reload.log"
+
+# The options that reload_pathspaces() passes on to the process reloading each
+# pathspace, when they are set.  The pathspaces, --log-file and the options
+# of --watch, which cannot be used with several pathspaces, are not.
+forwarded_options = (
+    "--input",
+    "--reload",
+    "--test",
+    "--apply-patch",
+    "--debug",
+    "--log-level",
+    "--stdout",
+    "--overwrite",
+    "--bindir",
+    "--confdir",
+    "--rundir",
+    "--vty_socket",
+    "--native-vty",
+    "--mark-table",
+    "--daemon",
+    "--parallel",
+    "--incremental",
+    "--transaction",
+    "--timing",
+    "--profile-json",
+    "--profile",
+    "--diff-format",
+    "--test-reset",
+)
+
+
+def forward_args(args, pathspace):
+    """
+    Return the forwarded_options that are set in `args`, with their values,
+    for the process reloading `pathspace`: "{pathspace}" in the values is
+    replaced by its name.
+    """
+    argv = []
+    for option in forwarded_options:
+        value = getattr(args, option.lstrip("-").replace("-", "_"))
+        if value is True:
+            argv.append(option)
+        elif value:
+            argv.extend([option, str(value).replace("{pathspace}", pathspace)])
+    return argv
+
+
+def pathspace_log_file(log_file, pathspace):
+    """
+    Return the log file of the process reloading `pathspace`: `log_file`
+    with "{pathspace}" replaced by its name if it has it, otherwise
+    frr-reload-NAME.log in the directory of `log_file`
+    """
+    if "{pathspace}" in log_file:
+        return log_file.replace("{pathspace}", pathspace)
+    return os.path.join(os.path.dirname(log_file), "frr-reload-%s.log" % pathspace)
+
+
+def reload_pathspaces(args, pathspaces):
+    """
+    Run frr-reload.py for each of the pathspaces, at most args.jobs of them
+    at a time.  Each pathspace is reloaded by its own process, which logs to
+    its own file (see pathspace_log_file()).  With --test, the output of each
+    pathspace is printed after its name.
+
+    Returns the names of the pathspaces that failed.
+    """
+
+    def run(name):
+        argv = [sys.executable, os.path.abspath(__file__)]
+        argv.extend(forward_args(args, name))
+        argv.extend(["--pathspace", name])
+        if not args.test and not args.stdout:
+            log_file = pathspace_log_file(args.log_file or default_log_file, name)
+            argv.extend(["--log-file", log_file])
+        if args.filename:
+            argv.append(args.filename.replace("{pathspace}", name))
+        elif not args.apply_patch:
+            argv.append(os.path.join(args.confdir, name, "frr.conf"))
+
+        log.info("Reloading pathspace %s", name)
+        start = time.time()
+        proc = subprocess.Popen(
+            argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True
+        )
+        (stdout, stderr) = proc.communicate()
+        return (proc.returncode, time.time() - start, stdout, stderr)
+
+    failed = []
+    pool = ThreadPoolExecutor(max_workers=max(1, args.jobs))
+    try:
+        futures = [(name, pool.submit(run, name)) for name in pathspaces]
+        for (name, future) in futures:
+            (returncode, elapsed, stdout, stderr) = future.result()
+            stdout = stdout.decode("UTF-8", "replace")
+            stderr = stderr.decode("UTF-8", "replace")
+            if args.test:
+                print("\n=== %s" % name)
+                sys.stdout.write(stdout)
+                sys.stdout.flush()
+            if returncode == 0:
+                log.info("Pathspace %s: ok in %.3fs", name, elapsed)
+                continue
+            failed.append(name)
+            log.error(
+                "Pathspace %s: failed (exit %d) in %.3fs\n%s",
+                name,
+                returncode,
+                elapsed,
+                (stderr if args.test else stdout + stderr).rstrip(),
+            )
+    finally:
+        pool.shutdown()
+
+    log.info(
+        "Finished %d pathspaces, %d failed%s",
+        len(pathspaces),
+        len(failed),
+        ": " + ", ".join(failed) if failed else "",
+    )
+    return failed
 
 
 if __name__ == "__main__":
@@ -1656,6 +4058,12 @@ if __name__ == "__main__":
     group.add_argument(
         "--test", action="store_true", help="Show the deltas", default=False
     )
+    group.add_argument(
+        "--apply-patch",
+        metavar="FILE",
+        help="Apply the deltas from --test --diff-format json without comparing",
+        default=None,
+    )
     level_group = parser.add_mutually_exclusive_group()
     level_group.add_argument(
         "--debug",
@@ -1676,10 +4084,33 @@ if __name__ == "__main__":
         "--pathspace",
         "-N",
         metavar="NAME",
-        help="Reload specified path/namespace",
+        action="append",
+        help="Reload specified path/namespace, can be given several times",
+        default=None,
+    )
+    parser.add_argument(
+        "--pathspace-glob",
+        metavar="PATTERN",
+        help="Reload the path/namespaces with a directory in CONFDIR matching PATTERN",
         default=None,
     )
-    parser.add_argument("filename", help="Location of new frr config file")
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        metavar="N",
+        type=int,
+        help="with several path/namespaces, how many to reload at the same time",
+        default=os.cpu_count() or 1,
+    )
+    parser.add_argument(
+        "--log-file",
+        metavar="FILE",
+        help="log to FILE instead of %s" % default_log_file,
+        default=None,
+    )
+    parser.add_argument(
+        "filename", nargs="?", help="Location of new frr config file"
+    )
     parser.add_argument(
         "--overwrite",
         action="store_true",
@@ -1700,9 +4131,84 @@ if __name__ == "__main__":
         help="socket to be used by vtysh to connect to the daemons",
         default=None,
     )
+    parser.add_argument(
+        "--native-vty",
+        action="store_true",
+        help="talk to the daemons' vty sockets directly instead of running vtysh",
+        default=False,
+    )
+    parser.add_argument(
+        "--mark-table",
+        metavar="FILE",
+        help="look up deletions with the command table from python/marktable.py",
+        default=None,
+    )
     parser.add_argument(
         "--daemon", help="daemon for which want to replace the config", default=""
     )
+    parser.add_argument(
+        "--parallel",
+        action="store_true",
+        help="reload the configuration of each daemon on its own, in parallel",
+        default=False,
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only compare the contexts changed since the last reload",
+        default=False,
+    )
+    parser.add_argument(
+        "--transaction",
+        action="store_true",
+        help="apply the changes as one configuration transaction",
+        default=False,
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running, apply the file again every time it is written",
+        default=False,
+    )
+    parser.add_argument(
+        "--debounce",
+        metavar="SECONDS",
+        type=float,
+        help="with --watch, wait for this long without writes before applying",
+        default=1.0,
+    )
+    parser.add_argument(
+        "--status-socket",
+        metavar="PATH",
+        help="with --watch, report the reload status on a unix socket at PATH",
+        default=None,
+    )
+    parser.add_argument(
+        "--timing",
+        action="store_true",
+        help="log the time spent in each phase of the reload",
+        default=False,
+    )
+    parser.add_argument(
+        "--profile-json",
+        metavar="FILE",
+        help="write the time spent in each phase and counters to FILE as JSON",
+        default=None,
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        nargs="?",
+        const="-",
+        help="run under cProfile, print the stats or dump them to FILE",
+        default=None,
+    )
+    parser.add_argument(
+        "--diff-format",
+        choices=("text", "json"),
+        help="with --test, show the deltas as text or as a JSON patch",
+        default="text",
+    )
     parser.add_argument(
         "--test-reset",
         action="store_true",
@@ -1725,12 +4231,12 @@ if __name__ == "__main__":
             logging.WARNING, "\033[91m%s\033[0m" % logging.getLevelName(logging.WARNING)
         )
 
-    elif args.reload:
+    elif args.reload or args.apply_patch:
         if not os.path.isdir("/var/log/frr/"):
             os.makedirs("/var/log/frr/")
 
         logging.basicConfig(
-            filename="/var/log/frr/frr-reload.log",
+            filename=args.log_file or default_log_file,
             format="%(asctime)s %(levelname)5s: %(message)s",
         )
 
@@ -1744,7 +4250,7 @@ if __name__ == "__main__":
     else:
         log.setLevel(args.log_level.upper())
 
-    if args.reload and not args.stdout:
+    if (args.reload or args.apply_patch) and not args.stdout:
         # Additionally send errors and above to STDOUT, with no metadata,
         # when we are logging to a file. This specifically does not follow
         # args.log_level, and is analagous to behaviour in earlier versions
@@ -1755,12 +4261,47 @@ if __name__ == "__main__":
         stdout_hdlr.setFormatter(logging.Formatter())
         log.addHandler(stdout_hdlr)
 
+    # Several pathspaces are reloaded by one frr-reload.py each
+    pathspaces = args.pathspace or []
+    if args.pathspace_glob:
+        pathspaces = pathspaces + [
+            name
+            for name in pathspace_names(args.confdir, args.pathspace_glob)
+            if name not in pathspaces
+        ]
+    if len(pathspaces) > 1 or args.pathspace_glob:
+        if not pathspaces:
+            log.error(
+                "No pathspace in %s matches %s" % (args.confdir, args.pathspace_glob)
+            )
+            sys.exit(1)
+        if args.watch:
+            log.error("--watch cannot be used with several pathspaces")
+            sys.exit(1)
+        if reload_pathspaces(args, pathspaces):
+            sys.exit(1)
+        sys.exit(0)
+    args.pathspace = pathspaces[0] if pathspaces else None
+
+    if args.apply_patch:
+        try:
+            with open(args.apply_patch, "r") as fh:
+                patch = json.load(fh)
+            ConfigDiff.from_patch(patch)
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            log.error("Cannot load patch %s: %s" % (args.apply_patch, e))
+            sys.exit(1)
+
     # Verify the new config file is valid
-    if not os.path.isfile(args.filename):
+    elif not args.filename:
+        log.error("The new config file must be given with --reload and --test")
+        sys.exit(1)
+
+    elif not os.path.isfile(args.filename):
         log.error("Filename %s does not exist" % args.filename)
         sys.exit(1)
 
-    if not os.path.getsize(args.filename):
+    elif not os.path.getsize(args.filename):
         log.error("Filename %s is an empty file" % args.filename)
         sys.exit(1)
 
@@ -1803,7 +4344,34 @@ if __name__ == "__main__":
         log.error(msg)
         sys.exit(1)
 
-    vtysh = Vtysh(args.bindir, args.confdir, args.vty_socket, args.pathspace)
+    if args.parallel and args.daemon:
+        log.error("--parallel cannot be used with --daemon")
+        sys.exit(1)
+
+    if args.incremental and args.daemon:
+        log.error("--incremental cannot be used with --daemon")
+        sys.exit(1)
+
+    if args.watch and (args.test or args.daemon):
+        log.error("--watch requires --reload and cannot be used with --daemon")
+        sys.exit(1)
+
+    marker = None
+    if args.mark_table:
+        try:
+            marker = ConfigMarker.from_file(args.mark_table)
+        except (IOError, OSError, ValueError, KeyError) as e:
+            log.error("Cannot load mark table %s: %s" % (args.mark_table, e))
+            sys.exit(1)
+
+    vtysh = Vtysh(
+        args.bindir,
+        args.confdir,
+        args.vty_socket,
+        args.pathspace,
+        args.native_vty,
+        marker,
+    )
 
     # Verify that 'service integrated-vtysh-config' is configured
     if args.pathspace:
@@ -1829,16 +4397,69 @@ if __name__ == "__main__":
 
     log.info('Called via "%s"', str(args))
 
-    # Create a Config object from the config generated by newconf
-    newconf = Config(vtysh)
-    try:
-        newconf.load_from_file(args.filename)
-        reload_ok = True
-    except VtyshException as ve:
-        log.error("vtysh failed to process new configuration: {}".format(ve))
-        reload_ok = False
+    if args.timing or args.profile_json:
+        timer.enabled = True
+        timer.reset()
+
+    if args.profile:
+        import cProfile
+
+        profile = cProfile.Profile()
+        profile.enable()
+
+    if args.watch:
+        status = WatchStatus()
+        if args.status_socket:
+            status.serve(args.status_socket)
+        # let "finally" clean up when stopped
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            watch_config(vtysh, args, status)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            status.close()
+        sys.exit(0)
+
+    if args.apply_patch:
+        reload_ok = vtysh.is_config_available() and apply_patch(
+            vtysh, patch, args.rundir, args.daemon
+        )
+
+        # Make these changes persistent, but not a partly applied patch
+        if not reload_ok:
+            log.error("Patch not fully applied, configuration not written")
+        elif args.overwrite or not args.daemon:
+            vtysh("write")
+    else:
+        # Create a Config object from the config generated by newconf
+        newconf = Config(vtysh)
+        try:
+            newconf.load_from_file(args.filename)
+            reload_ok = True
+        except VtyshException as ve:
+            log.error("vtysh failed to process new configuration: {}".format(ve))
+            reload_ok = False
 
-    if args.test:
+    if args.test and args.diff_format == "json":
+        running = Config(vtysh)
+
+        if args.input:
+            with open(args.input, "r") as fh:
+                generation = config_generation(fh.read())
+            running.load_from_file(args.input)
+        else:
+            generation = running_generation(vtysh, args.daemon)
+            running.load_from_show_running(args.daemon)
+
+        (lines_to_add, lines_to_del) = compare_context_objects(newconf, running)
+        diff = ConfigDiff(
+            lines_to_add, lines_to_del, readd_lines(newconf, running, lines_to_del)
+        )
+        json.dump(diff.to_patch(generation), sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+    elif args.test:
 
         # Create a Config object from the running config
         running = Config(vtysh)
@@ -1900,175 +4521,29 @@ if __name__ == "__main__":
                 print(cmd)
 
     elif args.reload:
-        lines_to_configure = []
-
-        # We will not be able to do anything, go ahead and exit(1)
-        if not vtysh.is_config_available():
-            sys.exit(1)
-
-        log.debug("New Frr Config\n%s", newconf.get_lines())
-
-        # This looks a little odd but we have to do this twice...here is why
-        # If the user had this running bgp config:
-        #
-        # router bgp 10
-        #  neighbor 1.1.1.1 remote-as 50
-        #  neighbor 1.1.1.1 route-map FOO out
-        #
-        # and this config in the newconf config file
-        #
-        # router bgp 10
-        #  neighbor 1.1.1.1 remote-as 999
-        #  neighbor 1.1.1.1 route-map FOO out
-        #
-        #
-        # Then the script will do
-        # - no neighbor 1.1.1.1 remote-as 50
-        # - neighbor 1.1.1.1 remote-as 999
-        #
-        # The problem is the "no neighbor 1.1.1.1 remote-as 50" will also remove
-        # the "neighbor 1.1.1.1 route-map FOO out" line...so we compare the
-        # configs again to put this line back.
-
-        # There are many keywords in FRR that can only appear one time under
-        # a context, take "bgp router-id" for example. If the config that we are
-        # reloading against has the following:
-        #
-        # router bgp 10
-        #   bgp router-id 1.1.1.1
-        #   bgp router-id 2.2.2.2
-        #
-        # The final config needs to contain "bgp router-id 2.2.2.2". On the
-        # first pass we will add "bgp router-id 2.2.2.2" but then on the second
-        # pass we will see that "bgp router-id 1.1.1.1" is missing and add that
-        # back which cancels out the "bgp router-id 2.2.2.2". The fix is for the
-        # second pass to include all of the "adds" from the first pass.
-        lines_to_add_first_pass = []
-
-        for x in range(2):
-            running = Config(vtysh)
-            running.load_from_show_running(args.daemon)
-            log.debug("Running Frr Config (Pass #%d)\n%s", x, running.get_lines())
-
-            (lines_to_add, lines_to_del) = compare_context_objects(newconf, running)
-
-            if x == 0:
-                lines_to_add_first_pass = lines_to_add
-            else:
-                lines_to_add.extend(lines_to_add_first_pass)
-
-            # Only do deletes on the first pass. The reason being if we
-            # configure a bgp neighbor via "neighbor swp1 interface" FRR
-            # will automatically add:
-            #
-            # interface swp1
-            #  ipv6 nd ra-interval 10
-            #  no ipv6 nd suppress-ra
-            # !
-            #
-            # but those lines aren't in the config we are reloading against so
-            # on the 2nd pass they will show up in lines_to_del.  This could
-            # apply to other scenarios as well where configuring FOO adds BAR
-            # to the config.
-            if lines_to_del and x == 0:
-                for (ctx_keys, line) in lines_to_del:
-
-                    if line == "!":
-                        continue
-
-                    # 'no' commands are tricky, we can't just put them in a file and
-                    # vtysh -f that file. See the next comment for an explanation
-                    # of their quirks
-                    cmd = lines_to_config(ctx_keys, line, True)
-                    original_cmd = cmd
-
-                    # Some commands in frr are picky about taking a "no" of the entire line.
-                    # OSPF is bad about this, you can't "no" the entire line, you have to "no"
-                    # only the beginning. If we hit one of these command an exception will be
-                    # thrown.  Catch it and remove the last '-c', 'FOO' from cmd and try again.
-                    #
-                    # Example:
-                    # frr(config-if)# ip ospf authentication message-digest 1.1.1.1
-                    # frr(config-if)# no ip ospf authentication message-digest 1.1.1.1
-                    #  % Unknown command.
-                    # frr(config-if)# no ip ospf authentication message-digest
-                    #  % Unknown command.
-                    # frr(config-if)# no ip ospf authentication
-                    # frr(config-if)#
-
-                    stdouts = []
-                    while True:
-                        try:
-                            vtysh(["configure"] + cmd, stdouts)
-
-                        except VtyshException:
-
-                            # - Pull the last entry from cmd (this would be
-                            #   'no ip ospf authentication message-digest 1.1.1.1' in
-                            #   our example above
-                            # - Split that last entry by whitespace and drop the last word
-                            log.info("Failed to execute %s", " ".join(cmd))
-                            last_arg = cmd[-1].split(" ")
-
-                            if len(last_arg) <= 2:
-                                log.error(
-                                    '"%s" we failed to remove this command',
-                                    " -- ".join(original_cmd),
-                                )
-                                # Log first error msg for original_cmd
-                                if stdouts:
-                                    log.error(stdouts[0])
-                                reload_ok = False
-                                break
+        if not reload_with_args(vtysh, newconf, args, args.incremental):
+            reload_ok = False
 
-                            new_last_arg = last_arg[0:-1]
-                            cmd[-1] = " ".join(new_last_arg)
-                        else:
-                            log.info('Executed "%s"', " ".join(cmd))
-                            break
-
-            if lines_to_add:
-                lines_to_configure = []
-
-                for (ctx_keys, line) in lines_to_add:
-
-                    if line == "!":
-                        continue
-
-                    # Don't run "no" commands twice since they can error
-                    # out the second time due to first deletion
-                    if x == 1 and ctx_keys[0].startswith("no "):
-                        continue
-
-                    cmd = "\n".join(lines_to_config(ctx_keys, line, False)) + "\n"
-                    lines_to_configure.append(cmd)
-
-                if lines_to_configure:
-                    random_string = "".join(
-                        random.SystemRandom().choice(
-                            string.ascii_uppercase + string.digits
-                        )
-                        for _ in range(6)
-                    )
-
-                    filename = args.rundir + "/reload-%s.txt" % random_string
-                    log.info("%s content\n%s" % (filename, pformat(lines_to_configure)))
-
-                    with open(filename, "w") as fh:
-                        for line in lines_to_configure:
-                            fh.write(line + "\n")
-
-                    try:
-                        vtysh.exec_file(filename)
-                    except VtyshException as e:
-                        log.warning("frr-reload.py failed due to\n%s" % e.args)
-                        reload_ok = False
-                    os.unlink(filename)
+    if args.profile:
+        profile.disable()
+        if args.profile == "-":
+            profile.print_stats(sort="cumtime")
+        else:
+            profile.dump_stats(args.profile)
 
-        # Make these changes persistent
-        target = str(args.confdir + "/frr.conf")
-        if args.overwrite or (not args.daemon and args.filename != target):
-            vtysh("write")
+    if timer.enabled:
+        report = timer.report()
+        report["ok"] = reload_ok
+        if args.apply_patch:
+            report["mode"] = "apply-patch"
+        else:
+            report["mode"] = "reload" if args.reload else "test"
+        if args.timing:
+            timer.log_report(report)
+        if args.profile_json:
+            with open(args.profile_json, "w") as fh:
+                json.dump(report, fh, indent=2)
+                fh.write("\n")
 
     if not reload_ok:
         sys.exit(1)
@@ -0,0 +1,730 @@
+# Command table matcher for frr-reload.py
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; see the file COPYING; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""
+Match configuration lines against the command table that python/marktable.py
+writes, the way lib/command_match.c matches them against the command graph:
+ConfigMarker marks configurations like "vtysh -m" and looks up the form of
+the "no" commands that vtysh accepts.
+"""
+
+from __future__ import print_function, unicode_literals
+import bisect
+import json
+import re
+import socket
+from collections import OrderedDict
+
+
+# Python 3
+def iteritems(d):
+    return iter(d.items())
+
+
+class MarkException(Exception):
+    pass
+
+
+class CommandToken(object):
+    """
+    A node of the graph of a CLI command string, as built by
+    lib/command_parse.y
+    """
+
+    __slots__ = ("kind", "text", "min", "max", "allowrepeat", "next", "_nexthops")
+
+    def __init__(self, kind, text=None):
+        self.kind = kind
+        self.text = text
+        self.min = self.max = 0
+        self.allowrepeat = False
+        self.next = []
+        self._nexthops = None
+
+    def __repr__(self):
+        return "<%s %s>" % (self.kind, self.text)
+
+    def nexthops(self, neg):
+        """
+        The tokens that can follow this one, skipping over the forks, joins
+        and "no"-only branches like add_nexthops() in lib/command_match.c
+        """
+        if self._nexthops is None:
+            self._nexthops = (self._expand(False), self._expand(True))
+        return self._nexthops[neg]
+
+    def _expand(self, neg):
+        result = []
+        for child in self.next:
+            if child.kind == "neg_only" and not neg:
+                continue
+            if child.kind in ("fork", "join", "neg_only"):
+                result.extend(child._expand(neg))
+            else:
+                result.append(child)
+        return result
+
+
+class CommandParser(object):
+    """
+    Turn a CLI command string like "router bgp [(1-4294967295)]" into its
+    token graph, following lib/command_lex.l and lib/command_parse.y
+    """
+
+    # Same order as the flex rules: the longest match wins and the first
+    # rule wins among matches of the same length
+    lexer_rules = (
+        ("ipv4", re.compile(r"A\.B\.C\.D")),
+        ("ipv4_prefix", re.compile(r"A\.B\.C\.D/M")),
+        ("ipv6", re.compile(r"X:X::X:X")),
+        ("ipv6_prefix", re.compile(r"X:X::X:X/M")),
+        ("mac", re.compile(r"X:X:X:X:X:X")),
+        ("mac_prefix", re.compile(r"X:X:X:X:X:X/M")),
+        ("variable", re.compile(r"[A-Z][-_A-Z:0-9]+")),
+        ("word", re.compile(r"[-+]?[a-zA-Z0-9*][-+_a-zA-Z0-9*]*")),
+        ("range", re.compile(r"\([-+]?[0-9]{1,20} ?- ?[-+]?[0-9]{1,20}\)")),
+        ("![", re.compile(r"!\[")),
+    )
+    range_re = re.compile(r"\(([-+]?[0-9]+) ?- ?([-+]?[0-9]+)\)")
+
+    def __init__(self, string):
+        self.string = string
+        self.tokens = list(self.lex(string))
+        self.pos = 0
+
+    @classmethod
+    def lex(cls, string):
+        pos = 0
+        while pos < len(string):
+            if string[pos] in " \t":
+                pos += 1
+                continue
+
+            best = None
+            for (kind, regex) in cls.lexer_rules:
+                m = regex.match(string, pos)
+                if m and (best is None or m.end() > best[1].end()):
+                    best = (kind, m)
+
+            if best is None:
+                yield (string[pos], string[pos])
+                pos += 1
+            else:
+                yield (best[0], best[1].group(0))
+                pos = best[1].end()
+
+    def error(self, msg):
+        raise ValueError('%s in command "%s"' % (msg, self.string))
+
+    def peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset][0]
+        return None
+
+    def take(self, kind=None):
+        if kind is not None and self.peek() != kind:
+            self.error('expected "%s"' % kind)
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def varname(self):
+        if self.peek() == "$":
+            self.take()
+            self.take("word")
+
+    def simple_token(self):
+        (kind, text) = self.take()
+        token = CommandToken(kind, text)
+        if kind == "range":
+            m = self.range_re.match(text)
+            token.min = int(m.group(1))
+            token.max = int(m.group(2))
+            if token.min > token.max:
+                self.error("invalid range")
+        self.varname()
+        return token
+
+    def selector(self):
+        opening = self.take()[0]
+        closing = {"<": ">", "{": "}", "[": "]", "![": "]"}[opening]
+
+        fork = CommandToken("fork")
+        join = CommandToken("join")
+        while True:
+            (start, end) = self.token_seq((closing, "|"))
+            fork.next.append(start)
+            end.next.append(join)
+            if self.peek() != "|":
+                break
+            self.take()
+        self.take(closing)
+        self.varname()
+
+        if opening == "[":
+            fork.next.append(join)
+        elif opening == "{":
+            join.next.append(fork)
+        elif opening == "![":
+            neg_only = CommandToken("neg_only")
+            fork.next.append(neg_only)
+            neg_only.next.append(join)
+        return (fork, join)
+
+    def selector_token(self):
+        if self.peek() in ("<", "{", "[", "!["):
+            return self.selector()
+        if self.peek() not in (
+            "word",
+            "variable",
+            "range",
+            "ipv4",
+            "ipv4_prefix",
+            "ipv6",
+            "ipv6_prefix",
+            "mac",
+            "mac_prefix",
+        ):
+            self.error('unexpected "%s"' % self.peek())
+        token = self.simple_token()
+        return (token, token)
+
+    def token_seq(self, stops):
+        (start, end) = self.selector_token()
+        while self.peek() is not None and self.peek() not in stops:
+            (nstart, nend) = self.selector_token()
+            end.next.append(nstart)
+            end = nend
+        return (start, end)
+
+    def parse(self):
+        start = CommandToken("start")
+        current = start
+        while self.peek() is not None:
+            (first, last) = self.selector_token()
+            current.next.append(first)
+            current = last
+
+            if self.peek() == "." and self.peek(1) == "." and self.peek(2) == ".":
+                if first is not last or first.kind == "word":
+                    self.error("only placeholders can be repeated")
+                self.pos += 3
+                current.allowrepeat = True
+                current.next.append(current)
+                if self.peek() is not None:
+                    self.error("repeated placeholder is not last")
+
+        end = CommandToken("end", self.string)
+        current.next.append(end)
+        return start
+
+
+# Match levels and matcher results from lib/command_match.c, in order
+(NO_MATCH, PARTLY_MATCH, EXACT_MATCH) = range(1, 4)
+(MATCHER_NO_MATCH, MATCHER_INCOMPLETE, MATCHER_AMBIGUOUS, MATCHER_OK) = range(4)
+
+_token_precedence = {
+    "ipv4": 2,
+    "ipv4_prefix": 2,
+    "ipv6": 2,
+    "ipv6_prefix": 2,
+    "mac": 2,
+    "mac_prefix": 2,
+    "range": 2,
+    "word": 3,
+    "variable": 4,
+}
+_number_re = re.compile(r"[-+]?[0-9]+$")
+_digits_re = re.compile(r"[0-9]*$")
+_ipv6_addr_chars = frozenset("0123456789abcdefABCDEF:.")
+_ipv6_prefix_chars = frozenset("0123456789abcdefABCDEF:./")
+_mac_chars = "ABCDEFabcdef0123456789:"
+
+
+def _match_ipv4(word, prefix):
+    # Ports of match_ipv4() and match_ipv4_prefix(), quirks included
+    s = word + "\0"
+    i = 0
+    dots = nums = 0
+    stop = "/\0" if prefix else "\0"
+    while True:
+        sp = i
+        while s[i] not in stop:
+            if s[i] == ".":
+                if dots == 3:
+                    return NO_MATCH
+                if s[i + 1] == "." or (prefix and s[i + 1] == "/"):
+                    return NO_MATCH
+                if s[i + 1] == "\0":
+                    return PARTLY_MATCH
+                dots += 1
+                break
+            if not "0" <= s[i] <= "9":
+                return NO_MATCH
+            i += 1
+
+        if i - sp > 3:
+            return NO_MATCH
+        buf = s[sp:i]
+        v = int(buf) if buf else 0
+        if v > 255 or (v > 0 and buf[0] == "0"):
+            return NO_MATCH
+        nums += 1
+
+        if prefix:
+            if dots == 3:
+                if s[i] == "/":
+                    if s[i + 1] == "\0":
+                        return PARTLY_MATCH
+                    i += 1
+                    break
+                elif s[i] == "\0":
+                    return PARTLY_MATCH
+            if s[i] == "\0":
+                return PARTLY_MATCH
+        elif s[i] == "\0":
+            break
+        i += 1
+
+    if not prefix:
+        return PARTLY_MATCH if nums < 4 else EXACT_MATCH
+
+    mask = s[i:-1]
+    if not _digits_re.match(mask) or int(mask or "0") > 32:
+        return NO_MATCH
+    return EXACT_MATCH
+
+
+def _match_ipv6(word, prefix):
+    # Port of match_ipv6_prefix()
+    (START, COLON, DOUBLE, ADDR, DOT, SLASH, MASK) = range(1, 8)
+
+    if not set(word) <= (_ipv6_prefix_chars if prefix else _ipv6_addr_chars):
+        return NO_MATCH
+
+    s = word + "\0"
+    i = 0
+    state = START
+    colons = nums = double_colon = 0
+    sp = 0
+    while s[i] != "\0" and state != MASK:
+        if state == START:
+            if s[i] == ":":
+                if s[i + 1] != ":" and s[i + 1] != "\0":
+                    return NO_MATCH
+                colons -= 1
+                state = COLON
+            else:
+                sp = i
+                state = ADDR
+            continue
+        elif state == COLON:
+            colons += 1
+            if s[i + 1] == "/":
+                return NO_MATCH
+            elif s[i + 1] == ":":
+                state = DOUBLE
+            else:
+                sp = i + 1
+                state = ADDR
+        elif state == DOUBLE:
+            if double_colon or s[i + 1] == ":":
+                return NO_MATCH
+            if s[i + 1] != "\0" and s[i + 1] != "/":
+                colons += 1
+            sp = i + 1
+            state = SLASH if s[i + 1] == "/" else ADDR
+            double_colon += 1
+            nums += 1
+        elif state == ADDR:
+            if s[i + 1] in ":./\0":
+                if i - sp > 3 or "/" in s[sp : i + 1]:
+                    return NO_MATCH
+                nums += 1
+                if s[i + 1] == ":":
+                    state = COLON
+                elif s[i + 1] == ".":
+                    if colons or double_colon:
+                        state = DOT
+                    else:
+                        return NO_MATCH
+                elif s[i + 1] == "/":
+                    state = SLASH
+        elif state == DOT:
+            state = ADDR
+        elif state == SLASH:
+            if s[i + 1] == "\0":
+                return PARTLY_MATCH
+            state = MASK
+
+        if nums > 11 or colons > 7:
+            return NO_MATCH
+        i += 1
+
+    if not prefix:
+        try:
+            socket.inet_pton(socket.AF_INET6, word)
+        except (socket.error, ValueError):
+            return PARTLY_MATCH
+        return EXACT_MATCH
+
+    if state < MASK:
+        return PARTLY_MATCH
+    mask = s[i:-1]
+    if not _number_re.match(mask) or not 0 <= int(mask) <= 128:
+        return NO_MATCH
+    return EXACT_MATCH
+
+
+def _match_mac(word, prefix):
+    # Port of match_mac()
+    if len(word) > 17 + (3 if prefix else 0):
+        return NO_MATCH
+
+    s = word + "\0"
+    i = 0
+    while i < 17:
+        if s[i] == "\0" or s[i] not in _mac_chars:
+            break
+        if ((i + 1) % 3 == 0) != (s[i] == ":"):
+            return NO_MATCH
+        i += 1
+
+    if i < 17:
+        return PARTLY_MATCH if s[i] == "\0" else NO_MATCH
+
+    if prefix:
+        if s[i] == "\0":
+            return PARTLY_MATCH
+        if s[i] != "/":
+            return NO_MATCH
+        mask = s[i + 1 : -1]
+        if not mask:
+            return PARTLY_MATCH
+        if not _digits_re.match(mask) or int(mask) > 48:
+            return NO_MATCH
+    return EXACT_MATCH
+
+
+def match_token(token, word):
+    """
+    How well an input word matches a command token, see match_token() in
+    lib/command_match.c
+    """
+    kind = token.kind
+    if kind == "word":
+        if not word:
+            return PARTLY_MATCH
+        if len(word) < len(token.text):
+            return PARTLY_MATCH if token.text.startswith(word) else NO_MATCH
+        return EXACT_MATCH if word == token.text else NO_MATCH
+    if kind == "variable":
+        return EXACT_MATCH
+    if kind == "range":
+        if not _number_re.match(word):
+            return NO_MATCH
+        return EXACT_MATCH if token.min <= int(word) <= token.max else NO_MATCH
+    if kind == "ipv4":
+        return _match_ipv4(word, False)
+    if kind == "ipv4_prefix":
+        return _match_ipv4(word, True)
+    if kind == "ipv6":
+        return _match_ipv6(word, False)
+    if kind == "ipv6_prefix":
+        return _match_ipv6(word, True)
+    if kind == "mac":
+        return _match_mac(word, False)
+    if kind == "mac_prefix":
+        return _match_mac(word, True)
+    return NO_MATCH
+
+
+def _disambiguate(first, second, vline, n):
+    for (i, (ftok, stok)) in enumerate(zip(first, second), n):
+        if i >= len(vline):
+            break
+        if ftok.kind != stok.kind:
+            fprec = _token_precedence.get(ftok.kind, 10)
+            sprec = _token_precedence.get(stok.kind, 10)
+            if fprec != sprec:
+                return first if fprec < sprec else second
+            continue
+        fmatch = match_token(ftok, vline[i])
+        smatch = match_token(stok, vline[i])
+        if fmatch != smatch:
+            return first if fmatch > smatch else second
+    return None
+
+
+class NodeCommands(object):
+    """
+    The commands installed in one CLI node, indexed by their first word so
+    that an input line is only matched against the few commands it can be
+    """
+
+    def __init__(self, strings):
+        self.starts = []
+        self.by_word = {}
+        self.anywhere = []
+
+        for string in OrderedDict.fromkeys(strings):
+            start = CommandParser(string).parse()
+            index = len(self.starts)
+            self.starts.append(start)
+
+            first = start.nexthops(False) + start.nexthops(True)
+            for token in first:
+                if token.kind == "word":
+                    self.by_word.setdefault(token.text, set()).add(index)
+                elif index not in self.anywhere:
+                    self.anywhere.append(index)
+
+        self.words = sorted(self.by_word)
+
+    def candidates(self, word):
+        """
+        The start tokens of the commands whose first word can match `word`
+        """
+        indexes = set(self.anywhere)
+        pos = bisect.bisect_left(self.words, word)
+        while pos < len(self.words) and self.words[pos].startswith(word):
+            indexes.update(self.by_word[self.words[pos]])
+            pos += 1
+        return [self.starts[index] for index in sorted(indexes)]
+
+    def match(self, vline):
+        """
+        Match the words of an input line, return the matcher result and the
+        "end" token of the command that was matched, like command_match()
+        """
+        vline = ["dummy"] + vline
+        neg = len(vline) > 1 and vline[1] == "no"
+        children = []
+        for start in self.candidates(vline[1]):
+            children.extend(start.nexthops(neg))
+
+        stack = [None] * (len(vline) + 1)
+        (status, best) = self._match_children(children, vline, 0, stack, neg)
+        if status != MATCHER_OK:
+            return (status, None)
+        return (status, best[-1])
+
+    def _match_r(self, token, vline, n, stack, neg):
+        if n == 256:
+            return (MATCHER_NO_MATCH, None)
+        if not token.allowrepeat and token in stack[:n]:
+            return (MATCHER_NO_MATCH, None)
+
+        minmatch = PARTLY_MATCH if token.kind == "word" else EXACT_MATCH
+        if match_token(token, vline[n]) < minmatch:
+            return (MATCHER_NO_MATCH, None)
+
+        stack[n] = token
+        (status, best) = self._match_children(
+            token.nexthops(neg), vline, n, stack, neg
+        )
+        if best is not None:
+            best.insert(0, token)
+        return (status, best)
+
+    def _match_children(self, children, vline, n, stack, neg):
+        status = MATCHER_NO_MATCH
+        best = None
+        last = n + 1 == len(vline)
+
+        for child in children:
+            if last:
+                if child.kind == "end":
+                    if best is not None:
+                        status = MATCHER_AMBIGUOUS
+                        break
+                    status = MATCHER_OK
+                    best = [child]
+                continue
+
+            (rstat, result) = self._match_r(child, vline, n + 1, stack, neg)
+            if result is not None and best is not None:
+                newbest = _disambiguate(best, result, vline, n + 1)
+                if newbest is None:
+                    status = MATCHER_AMBIGUOUS
+                elif newbest is best and status == MATCHER_AMBIGUOUS:
+                    status = MATCHER_AMBIGUOUS
+                elif newbest is result and rstat == MATCHER_AMBIGUOUS:
+                    status = MATCHER_AMBIGUOUS
+                else:
+                    status = MATCHER_OK
+                if newbest is not None:
+                    best = newbest
+            elif result is not None:
+                status = rstat
+                best = result
+            elif best is None:
+                status = max(rstat, status)
+
+        if best is None and last and status == MATCHER_NO_MATCH:
+            status = MATCHER_INCOMPLETE
+        return (status, best)
+
+
+class ConfigMarker(object):
+    """
+    Marks configuration text the way "vtysh -m" does, without running vtysh.
+
+    This needs the table of CLI nodes, of the commands installed in each of
+    them and of the node changes vtysh makes for them, that
+    python/marktable.py writes from frr.xref and the vtysh sources.  Like
+    vtysh_mark_file(), every line is looked up in the current node and then
+    in its parents, "exit" lines are added for each level that was walked
+    up, and the marked text ends with "end".
+    """
+
+    split_re = re.compile(r"[\n\r\t ]+")
+
+    def __init__(self, table):
+        self.index = {}
+        self.parent = {}
+        for (name, node) in iteritems(table["nodes"]):
+            self.index[name] = node["index"]
+            self.parent[name] = node.get("parent")
+        self.config_index = self.index["CONFIG_NODE"]
+
+        self.strings = table["commands"]
+        self.transitions = table.get("transitions", {})
+        self.nodes = {}
+        self.deletions = {}
+
+    @classmethod
+    def from_file(cls, filename):
+        with open(filename, "r") as fh:
+            return cls(json.load(fh))
+
+    def node_commands(self, node):
+        commands = self.nodes.get(node)
+        if commands is None:
+            commands = NodeCommands(self.strings.get(node, []))
+            self.nodes[node] = commands
+        return commands
+
+    def match(self, node, vline):
+        """
+        Look an input line up in a node, return the matcher result and the
+        node vtysh is in afterwards
+        """
+        (status, end) = self.node_commands(node).match(vline)
+        if status == MATCHER_OK:
+            node = self.transitions.get(node, {}).get(end.text, node)
+        return (status, node)
+
+    def lookup(self, node, vline):
+        """
+        Look an input line up in a node and, while it does not match, in the
+        parents of the node, like vtysh does.  Return the matcher result, the
+        node vtysh is in afterwards and the number of levels walked up.
+        """
+        (status, next_node) = self.match(node, vline)
+        saved_status = status
+        tried = 0
+        while status == MATCHER_NO_MATCH and self.index[node] > self.config_index:
+            parent = self.parent.get(node)
+            if parent is None:
+                break
+            node = parent
+            (status, next_node) = self.match(node, vline)
+            tried += 1
+
+        if status != MATCHER_OK:
+            return (saved_status, None, 0)
+        return (status, next_node, tried)
+
+    def deletion(self, cmd):
+        """
+        Return the form of the "no" command `cmd`, as given by
+        lines_to_config(), that vtysh accepts and the number of words dropped
+        from it.  The words are dropped from the end of the last line one at
+        a time, like reload_config() does when a deletion fails, but without
+        sending anything to vtysh.  Returns None if the context of the
+        command is not known or no form of it is accepted.
+        """
+        key = tuple(cmd)
+        if key in self.deletions:
+            return self.deletions[key]
+
+        result = None
+        node = "CONFIG_NODE"
+        for line in cmd[:-1]:
+            (status, node, _) = self.lookup(node, line.split())
+            if status != MATCHER_OK:
+                break
+        else:
+            last = cmd[-1]
+            dropped = 0
+            while True:
+                if self.lookup(node, last.split())[0] == MATCHER_OK:
+                    result = (cmd[:-1] + [last], dropped)
+                    break
+                words = last.split(" ")
+                if len(words) <= 2:
+                    break
+                last = " ".join(words[:-1])
+                dropped += 1
+
+        self.deletions[key] = result
+        return result
+
+    def mark(self, lines):
+        """
+        Mark the given lines, which keep their line endings, and yield the
+        marked ones.  Raises MarkException for lines that vtysh would not
+        accept, with the same message vtysh prints.
+        """
+        node = "CONFIG_NODE"
+        lineno = 0
+        for line in lines:
+            lineno += 1
+            trimmed = line.strip(" \t\n\r\v\f")
+            if trimmed.startswith("!") or trimmed.startswith("#"):
+                yield line
+                continue
+
+            vline = [word for word in self.split_re.split(trimmed) if word]
+            if not vline:
+                yield line
+                continue
+
+            if trimmed == "end":
+                continue
+
+            (status, next_node, tried) = self.lookup(node, vline)
+            for _ in range(tried):
+                yield "exit\n"
+
+            if status == MATCHER_AMBIGUOUS:
+                raise MarkException(
+                    "line %d: %% Ambiguous command: %s" % (lineno, line)
+                )
+            elif status == MATCHER_INCOMPLETE:
+                raise MarkException(
+                    "line %d: %% Command incomplete: %s" % (lineno, line)
+                )
+            elif status != MATCHER_OK:
+                raise MarkException("line %d: %% Unknown command: %s" % (lineno, line))
+
+            node = next_node
+            yield line
+            if trimmed == "exit-vrf":
+                yield "end\n"
+
+        yield "\nend\n"
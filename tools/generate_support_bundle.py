@@ -21,31 +21,72 @@
 ### Python Script to generate the FRR support bundle ###
 ########################################################
 import argparse
+import difflib
+import gzip
+import hashlib
+import json
 import logging
 import os
+import re
+import select
+import shutil
 import subprocess
+import sys
 import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-def open_with_backup(path):
+MANIFEST = "support_bundle_manifest.json"
+SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+# --delta bundles are numbered, the last output of each command is kept in
+# OBJECTS by its sha256
+DELTA_MANIFEST_RE = re.compile(r"support_bundle_manifest\.(\d+)\.json$")
+OBJECTS = "support_bundle_objects"
+# larger outputs are not diffed, as difflib needs both versions in memory
+DIFF_MAX_BYTES = 4 * 1024 * 1024
+
+
+class Uncompressed(object):
+    def __init__(self, fileobj):
+        self.write = fileobj.write
+
+    def close(self):
+        pass
+
+
+class Hashing(object):
+    """
+    Write to `fileobj`, computing the sha256 of what is written
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self.fileobj.write(data)
+
+
+def open_with_backup(path, mode="w"):
     if os.path.exists(path):
         print("Making backup of " + path)
-        subprocess.check_call("mv {0} {0}.prev".format(path))
-    return open(path, "w")
+        os.rename(path, path + ".prev")
+    return open(path, mode)
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-c", "--config", default="/etc/frr/support_bundle_commands.conf", help="input config")
-    parser.add_argument("-l", "--log-dir", default="/var/log/frr", help="directory for logfiles")
-    args = parser.parse_args()
 
-    collecting = False # file format has sentinels (seem superfluous)
-    proc_cmds = {}
+def read_commands(path):
+    """
+    Read the command list file, return the commands of each daemon in order
+    """
+    collecting = False  # file format has sentinels (seem superfluous)
+    proc_cmds = OrderedDict()
     proc = None
-    temp = None
 
-    # Collect all the commands for each daemon
-    try:
-        for line in open(args.config):
+    with open(path) as fd:
+        for line in fd:
             line = line.rstrip()
             if len(line) == 0 or line[0] == "#":
                 continue
@@ -53,37 +94,530 @@ def main():
             cmd_line = line.split(":")
             if cmd_line[0] == "PROC_NAME":
                 proc = cmd_line[1]
-                temp = tempfile.NamedTemporaryFile("w+")
+                proc_cmds[proc] = []
                 collecting = False
             elif cmd_line[0] == "CMD_LIST_START":
                 collecting = True
             elif cmd_line[0] == "CMD_LIST_END":
                 collecting = False
-                temp.flush()
-                proc_cmds[proc] = open(temp.name)
-                temp.close()
-            elif collecting:
-                temp.write(line + "\n")
+            elif collecting and proc is not None:
+                proc_cmds[proc].append(line)
             else:
                 print("Ignoring unexpected input " + line.rstrip())
+    return proc_cmds
+
+
+def compressor(compress, fileobj):
+    """
+    Return a file object compressing what is written to it into `fileobj`,
+    closing it does not close `fileobj`.  Each compressor writes a complete
+    gzip member or zstd frame, so that their outputs can be concatenated.
+    """
+    if compress == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode="wb")
+    if compress == "zstd":
+        import zstandard
+
+        return zstandard.ZstdCompressor().stream_writer(fileobj, closefd=False)
+    return Uncompressed(fileobj)
+
+
+def decompress(compress, data):
+    """
+    Decompress one gzip member or zstd frame written by compressor()
+    """
+    if compress == "gzip":
+        return gzip.decompress(data)
+    if compress == "zstd":
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def make_diff(old, new):
+    """
+    Return a unified diff turning the bytes `old` into `new`, see
+    apply_diff().  Lines are split on newlines only, so that the last line
+    does not need to end with one.
+    """
+    old_lines = old.decode("UTF-8", "surrogateescape").split("\n")
+    new_lines = new.decode("UTF-8", "surrogateescape").split("\n")
+    diff = difflib.unified_diff(old_lines, new_lines, lineterm="")
+    return "\n".join(diff).encode("UTF-8", "surrogateescape") + b"\n"
+
+
+def apply_diff(old, diff):
+    """
+    Apply a unified diff written by make_diff() to the bytes `old`
+    """
+    old_lines = old.decode("UTF-8", "surrogateescape").split("\n")
+    # skip the "---" and "+++" lines
+    diff_lines = diff.decode("UTF-8", "surrogateescape").split("\n")[2:-1]
+    new_lines = []
+    pos = 0
+    for line in diff_lines:
+        if line.startswith("@@"):
+            start = int(line.split()[1][1:].split(",")[0])
+            # an empty range starts after the line it names
+            if line.split()[1].endswith(",0"):
+                start += 1
+            new_lines.extend(old_lines[pos : start - 1])
+            pos = start - 1
+        elif line.startswith(" "):
+            new_lines.append(old_lines[pos])
+            pos += 1
+        elif line.startswith("-"):
+            pos += 1
+        elif line.startswith("+"):
+            new_lines.append(line[1:])
+    new_lines.extend(old_lines[pos:])
+    return "\n".join(new_lines).encode("UTF-8", "surrogateescape")
+
+
+def run_command(vtysh, command, output, timeout=None, max_bytes=None):
+    """
+    Run one command with vtysh and stream its output to the binary file
+    object `output`, stopping after `timeout` seconds or `max_bytes` bytes
+    of output.  Returns the manifest entry of the command.
+    """
+    entry = {
+        "command": command,
+        "start": time.time(),
+        "bytes": 0,
+        "truncated": False,
+        "timed_out": False,
+    }
+
+    try:
+        proc = subprocess.Popen(
+            vtysh + ["-c", command],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+    except OSError as error:
+        entry["error"] = str(error)
+        output.write(("%% %s\n" % error).encode())
+        entry["duration"] = time.time() - entry["start"]
+        return entry
+
+    fd = proc.stdout.fileno()
+    deadline = entry["start"] + timeout if timeout else None
+    try:
+        while True:
+            wait = None if deadline is None else max(0, deadline - time.time())
+            if not select.select([fd], [], [], wait)[0]:
+                entry["timed_out"] = True
+                break
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            if max_bytes and entry["bytes"] + len(chunk) > max_bytes:
+                chunk = chunk[: max_bytes - entry["bytes"]]
+                entry["truncated"] = True
+            output.write(chunk)
+            entry["bytes"] += len(chunk)
+            if entry["truncated"]:
+                break
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        entry["returncode"] = proc.wait()
+
+    if entry["timed_out"]:
+        output.write(b"\n% Timed out after " + str(timeout).encode() + b"s\n")
+    elif entry["truncated"]:
+        output.write(b"\n% Truncated at " + str(max_bytes).encode() + b" bytes\n")
+    entry["duration"] = time.time() - entry["start"]
+    return entry
+
+
+def delta_runs(log_dir):
+    """
+    Return the numbers of the --delta bundles in log_dir, in order
+    """
+    runs = []
+    for name in os.listdir(log_dir):
+        m = DELTA_MANIFEST_RE.match(name)
+        if m:
+            runs.append(int(m.group(1)))
+    return sorted(runs)
+
+
+def load_manifest(log_dir, run=None):
+    name = MANIFEST if run is None else "support_bundle_manifest.%d.json" % run
+    with open(os.path.join(log_dir, name)) as fd:
+        return json.load(fd, object_pairs_hook=OrderedDict)
+
+
+def collect(
+    proc_cmds,
+    log_dir,
+    vtysh=("vtysh",),
+    jobs=4,
+    timeout=None,
+    max_bytes=None,
+    compress="none",
+    delta=False,
+    max_file_bytes=None,
+):
+    """
+    Run the commands of all daemons, at most `jobs` at a time, and write
+    the output of the commands of each daemon in order to
+    DAEMON_support_bundle.log in log_dir, compressed with `compress`.  Each
+    command is compressed on its own as soon as it is run, into a temporary
+    file, and the files are concatenated once all commands of the daemon are
+    done.  The timing, size and truncation of every command, and where its
+    output is in the file, is written to the manifest.
+
+    `max_bytes` bounds the output of each command, `max_file_bytes` the
+    size of each file: the output of a command that would take the file
+    past it is replaced by a note, and the command marked as skipped.
+
+    With `delta`, the bundles are numbered (DAEMON_support_bundle.N.log)
+    and only the first one holds the full output of every command.  The
+    later ones hold a unified diff from the output of the command in the
+    previous bundle, or a note that it did not change, whichever is the
+    smallest.  See rebuild().
+
+    Returns the manifest.
+    """
+    vtysh = list(vtysh)
+    suffix = SUFFIXES[compress]
+    start = time.time()
+
+    run_id = None
+    previous = {}
+    if delta:
+        runs = delta_runs(log_dir)
+        run_id = runs[-1] + 1 if runs else 1
+        if runs:
+            for (proc, daemon) in load_manifest(log_dir, runs[-1])["daemons"].items():
+                for entry in daemon["commands"]:
+                    # a skipped output is not in the bundle to rebuild it from
+                    if entry["delta"] != "skipped":
+                        previous[(proc, entry["command"])] = entry["sha256"]
+        objects = os.path.join(log_dir, OBJECTS)
+        if not os.path.isdir(objects):
+            os.mkdir(objects)
+
+    def store(sha256, raw):
+        """
+        Keep the output spooled in `raw` in OBJECTS, in delta mode.  Commands
+        with the same output are stored under the same name, so each one is
+        written to its own temporary file and renamed over the others.
+        """
+        stored = os.path.join(objects, sha256 + ".gz")
+        if os.path.exists(stored):
+            return
+        (tmpfd, tmpname) = tempfile.mkstemp(dir=objects, suffix=".tmp")
+        try:
+            with os.fdopen(tmpfd, "wb") as fd:
+                with gzip.GzipFile(fileobj=fd, mode="wb") as gz:
+                    raw.seek(0)
+                    shutil.copyfileobj(raw, gz)
+            os.replace(tmpname, stored)
+        except Exception:
+            os.unlink(tmpname)
+            raise
+
+    def payload(entry, key, raw, size):
+        """
+        Return the note and the data to write for the output spooled in
+        `raw`, of `size` bytes, in delta mode.  The data is None, bytes, or
+        `raw` itself to copy all of it.
+        """
+        sha256 = entry["sha256"]
+        base = previous.get(key)
+        if base == sha256:
+            entry["delta"] = "unchanged"
+            return ("%% Unchanged since bundle %d\n" % (run_id - 1), None)
+        based = os.path.join(objects, str(base) + ".gz")
+        if base is not None and size <= DIFF_MAX_BYTES:
+            if os.path.exists(based):
+                raw.seek(0)
+                content = raw.read()
+                with gzip.open(based, "rb") as fd:
+                    diff = make_diff(fd.read(), content)
+                if len(diff) < len(content):
+                    entry["delta"] = "diff"
+                    return ("%% Changes since bundle %d\n" % (run_id - 1), diff)
+        entry["delta"] = "full"
+        return ("", raw)
+
+    def run(proc, command):
+        spool = tempfile.TemporaryFile(dir=log_dir)
+        try:
+            output = compressor(compress, spool)
+            header = "%% %s %s\n" % (time.strftime("%Y/%m/%d %H:%M:%S"), command)
+            if not delta:
+                output.write(header.encode())
+                entry = run_command(vtysh, command, output, timeout, max_bytes)
+            else:
+                with tempfile.TemporaryFile(dir=log_dir) as raw:
+                    hashing = Hashing(raw)
+                    entry = run_command(vtysh, command, hashing, timeout, max_bytes)
+                    entry["sha256"] = hashing.sha256.hexdigest()
+                    # the size of the output, notes included
+                    size = raw.tell()
+                    store(entry["sha256"], raw)
+                    (note, data) = payload(entry, (proc, command), raw, size)
+                    header += note
+                    output.write(header.encode())
+                    if data is raw:
+                        raw.seek(0)
+                        shutil.copyfileobj(raw, output)
+                    elif data:
+                        output.write(data)
+            entry["header_bytes"] = len(header.encode())
+            output.close()
+        except Exception:
+            spool.close()
+            raise
+        return (entry, spool)
+
+    def skip(entry, filename, fd):
+        """
+        Write a note instead of the output of the command of `entry`, which
+        would take `filename` past max_file_bytes.
+        """
+        entry["skipped"] = True
+        if delta:
+            entry["delta"] = "skipped"
+        start = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(entry["start"]))
+        header = "%% %s %s\n" % (start, entry["command"])
+        note = "%% Skipped, %s reached %d bytes\n" % (filename, max_file_bytes)
+        output = compressor(compress, fd)
+        output.write((header + note).encode())
+        output.close()
+        entry["header_bytes"] = len(header.encode())
+
+    manifest = OrderedDict()
+    manifest["version"] = 1
+    if delta:
+        manifest["run"] = run_id
+    manifest["start"] = start
+    manifest["compress"] = compress
+    manifest["timeout"] = timeout
+    manifest["max_bytes"] = max_bytes
+    manifest["max_file_bytes"] = max_file_bytes
+    manifest["daemons"] = OrderedDict()
+
+    pool = ThreadPoolExecutor(max_workers=max(1, jobs))
+    try:
+        futures = OrderedDict(
+            (proc, [pool.submit(run, proc, command) for command in commands])
+            for (proc, commands) in proc_cmds.items()
+        )
+        for (proc, results) in futures.items():
+            if delta:
+                filename = "%s_support_bundle.%d.log%s" % (proc, run_id, suffix)
+            else:
+                filename = proc + "_support_bundle.log" + suffix
+            entries = []
+            with open_with_backup(os.path.join(log_dir, filename), "wb") as fd:
+                for future in results:
+                    (entry, spool) = future.result()
+                    entry["skipped"] = False
+                    with spool:
+                        size = spool.seek(0, os.SEEK_END)
+                        entry["offset"] = fd.tell()
+                        if max_file_bytes and entry["offset"] + size > max_file_bytes:
+                            skip(entry, filename, fd)
+                        else:
+                            spool.seek(0)
+                            shutil.copyfileobj(spool, fd)
+                        entry["length"] = fd.tell() - entry["offset"]
+                    entries.append(entry)
+                    for reason in ("skipped", "timed_out", "truncated"):
+                        if entry[reason]:
+                            logging.warning(
+                                "%s: %s %s",
+                                proc,
+                                entry["command"],
+                                reason.replace("_", " "),
+                            )
+                            break
+            manifest["daemons"][proc] = {"file": filename, "commands": entries}
+    finally:
+        pool.shutdown()
+
+    manifest["duration"] = time.time() - start
+    if delta:
+        name = "support_bundle_manifest.%d.json" % run_id
+    else:
+        name = MANIFEST
+    with open_with_backup(os.path.join(log_dir, name)) as fd:
+        json.dump(manifest, fd, indent=2)
+        fd.write("\n")
+
+    if delta:
+        # only the last output of each command is needed for the next diff
+        keep = set(
+            entry["sha256"] + ".gz"
+            for daemon in manifest["daemons"].values()
+            for entry in daemon["commands"]
+        )
+        for name in os.listdir(objects):
+            if name not in keep:
+                os.unlink(os.path.join(objects, name))
+    return manifest
+
+
+def rebuild(log_dir, run, out_dir=None):
+    """
+    Rebuild the full DAEMON_support_bundle.log files of --delta bundle
+    `run` into out_dir (log_dir by default) as
+    DAEMON_support_bundle.RUN.full.log, applying the diffs of each bundle
+    in turn to the output of the last full one.  Raises ValueError if an
+    output does not match its recorded sha256.
+
+    Returns the names of the files written.
+    """
+    outputs = {}
+    for number in delta_runs(log_dir):
+        if number > run:
+            break
+        manifest = load_manifest(log_dir, number)
+        for (proc, daemon) in manifest["daemons"].items():
+            with open(os.path.join(log_dir, daemon["file"]), "rb") as fd:
+                data = fd.read()
+            for entry in daemon["commands"]:
+                member = data[entry["offset"] : entry["offset"] + entry["length"]]
+                member = decompress(manifest["compress"], member)
+                body = member[entry["header_bytes"] :]
+                key = (proc, entry["command"])
+                if entry["delta"] == "skipped":
+                    # the header and the note, in place of the output
+                    outputs[key] = (member[: entry["header_bytes"]], body)
+                    continue
+                if entry["delta"] == "unchanged":
+                    content = outputs[key][1]
+                elif entry["delta"] == "diff":
+                    content = apply_diff(outputs[key][1], body)
+                else:
+                    content = body
+                if hashlib.sha256(content).hexdigest() != entry["sha256"]:
+                    raise ValueError(
+                        "bundle %d: %s: %s does not match its sha256"
+                        % (number, proc, entry["command"])
+                    )
+                outputs[key] = (member[: entry["header_bytes"]], content)
+    if run not in delta_runs(log_dir):
+        raise ValueError("no bundle %d in %s" % (run, log_dir))
+
+    written = []
+    for (proc, daemon) in load_manifest(log_dir, run)["daemons"].items():
+        filename = "%s_support_bundle.%d.full.log" % (proc, run)
+        with open(os.path.join(out_dir or log_dir, filename), "wb") as fd:
+            for entry in daemon["commands"]:
+                (header, content) = outputs[(proc, entry["command"])]
+                fd.write(header.split(b"\n", 1)[0] + b"\n")
+                fd.write(content)
+        written.append(filename)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c",
+        "--config",
+        default="/etc/frr/support_bundle_commands.conf",
+        help="input config",
+    )
+    parser.add_argument(
+        "-l", "--log-dir", default="/var/log/frr", help="directory for logfiles"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="number of commands to run at the same time",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        default=60,
+        help="seconds after which a command is stopped (0 for no limit)",
+    )
+    parser.add_argument(
+        "-m",
+        "--max-bytes",
+        type=int,
+        default=64 << 20,
+        help="bytes of output after which a command is stopped (0 for no limit)",
+    )
+    parser.add_argument(
+        "--max-file-bytes",
+        type=int,
+        default=256 << 20,
+        help="size past which the outputs of a daemon are skipped (0 for no limit)",
+    )
+    parser.add_argument(
+        "-z",
+        "--compress",
+        choices=sorted(SUFFIXES),
+        default="none",
+        help="compression of the logfiles",
+    )
+    parser.add_argument("--vtysh", default="vtysh", help="vtysh executable")
+    parser.add_argument(
+        "-d",
+        "--delta",
+        action="store_true",
+        help="number the bundles, only write what changed since the previous one",
+    )
+    parser.add_argument(
+        "--rebuild",
+        type=int,
+        metavar="N",
+        help="rebuild the full logfiles of --delta bundle N instead of collecting",
+    )
+    parser.add_argument(
+        "-o", "--output", help="directory for the --rebuild logfiles (--log-dir)"
+    )
+    args = parser.parse_args()
+
+    if args.rebuild is not None:
+        try:
+            for filename in rebuild(args.log_dir, args.rebuild, args.output):
+                print("Rebuilt " + filename)
+        except (IOError, OSError, ValueError, KeyError) as error:
+            logging.fatal("Cannot rebuild bundle %d: %s", args.rebuild, error)
+            sys.exit(1)
+        return
+
+    # Collect all the commands for each daemon
+    try:
+        proc_cmds = read_commands(args.config)
     except IOError as error:
         logging.fatal("Cannot read config file: %s: %s", args.config, str(error))
         return
 
-    # Spawn a vtysh to fetch each set of commands
-    procs = []
-    for proc in proc_cmds:
-        ofn = os.path.join(args.log_dir, proc + "_support_bundle.log")
-        p = subprocess.Popen(
-            ["/usr/bin/env", "vtysh", "-t"],
-            stdin=proc_cmds[proc],
-            stdout=open_with_backup(ofn),
-            stderr=subprocess.STDOUT,
-        )
-        procs.append(p)
+    if args.compress == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            sys.stderr.write("zstd compression needs the zstandard module\n")
+            sys.exit(1)
+
+    collect(
+        proc_cmds,
+        args.log_dir,
+        ["/usr/bin/env", args.vtysh],
+        args.jobs,
+        args.timeout or None,
+        args.max_bytes or None,
+        args.compress,
+        args.delta,
+        args.max_file_bytes or None,
+    )
 
-    for p in procs:
-        p.wait()
 
 if __name__ == "__main__":
     main()